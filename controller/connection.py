@@ -0,0 +1,326 @@
+"""
+A connection to the ship which keeps all socket I/O off the GUI thread.
+"""
+import json
+import queue
+import random
+import socket
+import struct
+from collections import deque
+from itertools import count
+from threading import Event, Lock, Thread
+from time import monotonic
+
+from wire import is_binary_frame, is_reply, BINARY_VERSION
+
+LENGTH_HEADER = struct.Struct("!I")
+
+CONNECT_TIMEOUT = 3.0  # Seconds allowed for each connection attempt, including agreeing the format.
+RESOLVE_TTL = 300.0  # Seconds a resolved ship address is trusted before looking it up again.
+RECONNECT_DELAY = 0.05  # First wait before reconnecting, doubled after each failed attempt...
+RECONNECT_MAX_DELAY = 5.0  # ...up to this.
+
+
+class AddressCache:
+    """
+    Remembers what host names resolved to, as resolving "USS-Lux.local" over mDNS can take
+    seconds. If a lookup fails once the entry has expired, the old addresses are used anyway,
+    since the ship has most likely kept its address.
+    """
+    def __init__(self, ttl=RESOLVE_TTL):
+        self.ttl = ttl
+        self.__entries = {}  # (host, port) -> (expiry, addresses)
+        self.__lock = Lock()
+
+    def resolve(self, host, port):
+        """Returns a list of (family, sockaddr) for the host, newest lookup permitting."""
+        key = (host, port)
+        with self.__lock:
+            entry = self.__entries.get(key)
+        if entry is not None and entry[0] > monotonic():
+            return entry[1]
+        try:
+            addresses = [
+                (family, sockaddr)
+                for family, _, _, _, sockaddr in socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+            ]
+        except socket.gaierror:
+            if entry is None:
+                raise
+            return entry[1]
+        with self.__lock:
+            self.__entries[key] = (monotonic() + self.ttl, addresses)
+        return addresses
+
+    def forget(self, host, port):
+        with self.__lock:
+            self.__entries.pop((host, port), None)
+
+
+ADDRESSES = AddressCache()
+
+
+class ShipConnection:
+    """
+    request() queues a command and returns at once; a writer thread sends it and a reader
+    thread picks up the response. Requests carry an id which the ship echoes back, so any
+    number can be in flight, and each result is passed to its callback through dispatch
+    as it arrives. With wx.CallAfter as dispatch, every callback runs on the GUI thread.
+
+    open() connects in the background as well, calling on_connect once connected, or
+    on_error(exception) if the first attempt fails. State the ship pushes goes to on_state.
+    If an established connection drops, on_close is called and a fresh socket is connected
+    again, after a wait which starts short and doubles with each failed attempt, until
+    on_connect is called again or close() is. Nothing sent while disconnected is kept, so
+    on_connect should subscribe again, which also brings the state back up to date.
+
+    Ships which don't understand request ids answer in the order they were asked, so their
+    responses are matched to callbacks in that order instead.
+    """
+    def __init__(self, on_state, on_close, on_connect=None, on_error=None, dispatch=None, binary_state=True,
+                 addresses=ADDRESSES):
+        self.on_state = on_state
+        self.on_close = on_close
+        self.on_connect = on_connect
+        self.on_error = on_error
+        self.dispatch = dispatch or (lambda function, *args: function(*args))
+        self.want_binary_state = binary_state
+        self.addresses = addresses
+        self.host = None
+        self.port = None
+        self.reconnects = 0
+        self.socket = None
+        self.stream = None
+        self.length_prefixed = False
+        self.binary_state = False
+        self.request_ids = False
+        self.connected = False
+        self.__ids = count(1)
+        self.__pending = {}  # request id -> callback
+        self.__unnumbered = deque()  # callbacks for requests sent without an id, oldest first
+        self.__lock = Lock()
+        self.__outgoing = queue.Queue()
+        self.__closing = Event()
+
+    def open(self, host, port):
+        """Starts connecting to the ship in the background, returning at once."""
+        self.host = host
+        self.port = port
+        self.__closing.clear()
+        thread = Thread(target=self.__run, name="ship reader")
+        thread.daemon = True
+        thread.start()
+
+    def connect(self, host, port):
+        """
+        Connects to the ship and settles the wire format, raising if this can't be done
+        within CONNECT_TIMEOUT. Blocks, so is only called from the reader thread.
+        """
+        self.socket = self.__open_socket(host, port)
+        try:
+            self.socket.settimeout(CONNECT_TIMEOUT)
+            self.stream = self.socket.makefile("rb")
+            self.length_prefixed = False
+            self.binary_state = False
+            self.request_ids = False
+            self.__outgoing = queue.Queue()
+            if self.want_binary_state:
+                self.negotiate_format()
+            self.socket.settimeout(None)
+        except (OSError, ValueError):
+            self.__close_socket()
+            raise
+        self.connected = True
+        thread = Thread(target=self.__write_messages, args=(self.socket, self.__outgoing), name="ship writer")
+        thread.daemon = True
+        thread.start()
+
+    def __open_socket(self, host, port):
+        error = None
+        for family, address in self.addresses.resolve(host, port):
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.settimeout(CONNECT_TIMEOUT)
+            try:
+                sock.connect(address)
+            except OSError as e:
+                sock.close()
+                error = e
+                continue
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.__keep_alive(sock)
+            return sock
+        # The ship may have moved, so look it up again next time.
+        self.addresses.forget(host, port)
+        raise error or ConnectionError(f"No addresses found for {host}.")
+
+    @staticmethod
+    def __keep_alive(sock):
+        """
+        The ship only sends when its state changes, so a dead link would otherwise go
+        unnoticed until the next command. Where the platform allows, probe it after a few
+        idle seconds instead of the default two hours.
+        """
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in (("TCP_KEEPIDLE", 5), ("TCP_KEEPINTVL", 2), ("TCP_KEEPCNT", 3)):
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+    def __run(self):
+        try:
+            self.connect(self.host, self.port)
+        except (OSError, ValueError) as e:
+            if self.on_error is not None:
+                self.dispatch(self.on_error, e)
+            return
+        while True:
+            if self.on_connect is not None:
+                self.dispatch(self.on_connect)
+            self.__read_messages()
+            if self.__closing.is_set():
+                return
+            self.dispatch(self.on_close)
+            if not self.__reconnect():
+                return
+
+    def __reconnect(self):
+        """Tries to connect again until it works, or close() is called."""
+        delay = RECONNECT_DELAY
+        while not self.__closing.wait(delay * random.uniform(0.8, 1.2)):
+            try:
+                self.connect(self.host, self.port)
+            except (OSError, ValueError):
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                continue
+            self.reconnects += 1
+            return True
+        return False
+
+    def negotiate_format(self):
+        """
+        Asks the ship for binary state. Ships which agree switch to length-prefixed framing,
+        so the reply starts with a zero byte; anything else is a plain JSON reply.
+        """
+        self.socket.sendall(self.frame(json.dumps(f"format binary {BINARY_VERSION}").encode()))
+        if self.stream.peek(1)[:1] == b"\x00":
+            self.length_prefixed = True
+            reply = json.loads(self.read_frame())
+            self.binary_state = reply.get("format") == "binary"
+            self.request_ids = reply.get("request_ids", False)
+        else:
+            self.read_frame()
+
+    def frame(self, payload):
+        if self.length_prefixed:
+            return LENGTH_HEADER.pack(len(payload)) + payload
+        return payload + b"\n"
+
+    def read_frame(self):
+        if self.length_prefixed:
+            header = self.stream.read(LENGTH_HEADER.size)
+            if len(header) < LENGTH_HEADER.size:
+                raise ConnectionError("Ship closed the connection.")
+            (length,) = LENGTH_HEADER.unpack(header)
+            payload = self.stream.read(length)
+            if len(payload) < length:
+                raise ConnectionError("Ship closed the connection.")
+            return payload
+        line = self.stream.readline()
+        if not line:
+            raise ConnectionError("Ship closed the connection.")
+        return line
+
+    def request(self, command, callback=None):
+        """
+        Sends a command, without waiting. If given, callback(result) is dispatched once the
+        ship answers it.
+        """
+        if not self.connected:
+            return
+        with self.__lock:
+            if self.request_ids:
+                request_id = next(self.__ids)
+                self.__pending[request_id] = callback
+                command = {"id": request_id, "command": command}
+            else:
+                self.__unnumbered.append(callback)
+            self.__outgoing.put(self.frame(json.dumps(command).encode()))
+
+    def send(self, command):
+        """Sends a command the ship doesn't answer, such as "ack"."""
+        if self.connected:
+            self.__outgoing.put(self.frame(json.dumps(command).encode()))
+
+    def close(self):
+        """Closes the connection for good, rather than reconnecting."""
+        self.__closing.set()
+        self.__close_socket()
+
+    def __close_socket(self):
+        if self.socket is not None:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.socket.close()
+
+    @staticmethod
+    def __write_messages(sock, outgoing):
+        try:
+            while True:
+                data = outgoing.get()
+                if data is None:
+                    return
+                # Send whatever else has queued up meanwhile in the same call.
+                while not outgoing.empty():
+                    more = outgoing.get_nowait()
+                    if more is None:
+                        outgoing.put(None)
+                        break
+                    data += more
+                sock.sendall(data)
+        except (ConnectionError, OSError):
+            # Wakes the reader, which deals with the connection having gone.
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def __read_messages(self):
+        try:
+            while True:
+                payload = self.read_frame()
+                if is_binary_frame(payload):
+                    if is_reply(payload):
+                        self.__respond(None, payload)
+                    else:
+                        self.dispatch(self.on_state, payload)
+                    continue
+                message = json.loads(payload)
+                if type(message) is dict:
+                    if message.get("event") == "state":
+                        self.dispatch(self.on_state, message["state"])
+                        continue
+                    if "event" in message:
+                        # Other events, such as timeline progress, aren't for us.
+                        continue
+                    if "id" in message and "result" in message:
+                        self.__respond(message["id"], message["result"])
+                        continue
+                self.__respond(None, message)
+        except (ConnectionError, OSError, ValueError):
+            pass
+        self.connected = False
+        self.__outgoing.put(None)
+        with self.__lock:
+            self.__pending.clear()
+            self.__unnumbered.clear()
+        self.__close_socket()
+
+    def __respond(self, request_id, result):
+        with self.__lock:
+            if request_id is None:
+                callback = self.__unnumbered.popleft() if self.__unnumbered else None
+            else:
+                callback = self.__pending.pop(request_id, None)
+        if callback is not None:
+            self.dispatch(callback, result)
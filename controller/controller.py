@@ -1,11 +1,17 @@
-import json
-import time
+import argparse
 import wx
 import socket
 
+from connection import ShipConnection
+from fleet import Fleet, parse_address
+from observer import StateListener, MULTICAST_GROUP, MULTICAST_PORT
+from wire import StateDecoder
+
 
 DEFAULT_SHIP_ADDR = "USS-Lux.local"
 DEFAULT_SHIP_PORT = 3141
+MAX_STATE_RATE = 20  # Most state updates per second the ship should push to us.
+USE_BINARY_STATE = True  # Ask for the compact binary state format. Ships without it carry on in JSON.
 
 ID_CONNECT = 10001
 ID_CABINS = 10002
@@ -15,19 +21,77 @@ ID_NACELLES_MODE = 10005
 ID_BLINKERS = 10006
 
 
+INDICATORS = 18
+UNLIT = (200, 200, 200)
+LIT = (0, 255, 0)
+ABSENT = (0, 0, 0)  # A cell past the end of the ship's cabin lights.
+CABIN_COLOURS = {"1": LIT, "0": UNLIT}
+
+
+class IndicatorStrip(wx.Panel):
+    """
+    The cabin light indicators, drawn as cells of one double buffered panel rather than a
+    panel each. set_colours() keeps what every cell shows, and only cells whose colour has
+    changed are invalidated, so repaints cost nothing while the lights are still.
+    """
+    def __init__(self, parent, count=INDICATORS, cell_size=(15, 30)):
+        super().__init__(parent, size=(cell_size[0] * count, cell_size[1]))
+        self.SetBackgroundStyle(wx.BG_STYLE_PAINT)
+        self.count = count
+        self.colours = [UNLIT] * count
+        self.__brushes = {}
+        self.__pen = wx.Pen(wx.Colour(120, 120, 120))
+        self.Bind(wx.EVT_PAINT, self.on_paint)
+        self.Bind(wx.EVT_SIZE, self.on_size)
+
+    def cell_rect(self, i):
+        width, height = self.GetClientSize()
+        left = width * i // self.count
+        return wx.Rect(left, 0, width * (i + 1) // self.count - left, height)
+
+    def set_colours(self, colours):
+        """Shows colours[i] in cell i, and ABSENT in any cells past the end of colours."""
+        for i in range(self.count):
+            colour = colours[i] if i < len(colours) else ABSENT
+            if colour != self.colours[i]:
+                self.colours[i] = colour
+                self.RefreshRect(self.cell_rect(i), eraseBackground=False)
+
+    def brush(self, colour):
+        brush = self.__brushes.get(colour)
+        if brush is None:
+            brush = self.__brushes[colour] = wx.Brush(wx.Colour(*colour))
+        return brush
+
+    def on_size(self, e):
+        self.Refresh(eraseBackground=False)
+        e.Skip()
+
+    def on_paint(self, e):
+        dc = wx.AutoBufferedPaintDC(self)
+        update = self.GetUpdateRegion().GetBox()
+        dc.SetPen(self.__pen)
+        for i, colour in enumerate(self.colours):
+            rect = self.cell_rect(i)
+            if rect.Intersects(update):
+                dc.SetBrush(self.brush(colour))
+                dc.DrawRectangle(rect)
+
+
 class ControlPanel(wx.Panel):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         main_sizer = wx.GridBagSizer(5, 5)
 
-        self.cabins = wx.CheckBox(self, id=ID_CABINS, label="Cabins")
+        # Three state, so a fleet whose ships don't agree can be shown as undetermined.
+        self.cabins = wx.CheckBox(self, id=ID_CABINS, label="Cabins", style=wx.CHK_3STATE)
         self.cabins_mode = wx.RadioBox(self, id=ID_CABINS_MODE, choices=("Random", "Static"))
 
-        self.nacelles = wx.CheckBox(self, id=ID_NACELLES, label="Nacelles")
+        self.nacelles = wx.CheckBox(self, id=ID_NACELLES, label="Nacelles", style=wx.CHK_3STATE)
         self.nacelles_mode = wx.RadioBox(self, id=ID_NACELLES_MODE, choices=("Pulse", "Static"))
 
-        self.blinkers = wx.CheckBox(self, id=ID_BLINKERS, label="Blinkers")
+        self.blinkers = wx.CheckBox(self, id=ID_BLINKERS, label="Blinkers", style=wx.CHK_3STATE)
 
         main_sizer.Add(
             self.cabins,
@@ -50,23 +114,9 @@ class ControlPanel(wx.Panel):
             pos=(0, 4)
         )
 
-        self.indicators = [
-            wx.Panel(
-                parent=self,
-                size=(15, 30),
-                style=wx.BORDER_RAISED
-            ) for i in range(18)
-        ]
-        indicators_sizer = wx.BoxSizer(wx.HORIZONTAL)
-        for i in self.indicators:
-            i.SetBackgroundColour((200, 200, 200))
-            indicators_sizer.Add(
-                i,
-                1,
-                wx.EXPAND
-            )
+        self.indicators = IndicatorStrip(self)
         main_sizer.Add(
-            indicators_sizer,
+            self.indicators,
             pos=(3, 0),
             span=(1, 5),
             flag=wx.EXPAND
@@ -76,29 +126,60 @@ class ControlPanel(wx.Panel):
         main_sizer.AddGrowableCol(3)
         self.SetSizer(main_sizer)
 
+        self.check_boxes = {"cabins": self.cabins, "nacelles": self.nacelles, "blinkers": self.blinkers}
+        self.radio_boxes = {"cabins_mode": self.cabins_mode, "nacelles_mode": self.nacelles_mode}
+        # Selection index of each mode name, worked out once rather than from the labels on every update.
+        self.mode_indices = {
+            key: {radio_box.GetItemLabel(i).lower(): i for i in range(radio_box.GetCount())}
+            for key, radio_box in self.radio_boxes.items()
+        }
+        self.shown = {}  # What each control last showed, by state key, so unchanged ones are left alone.
+        self.decoder = StateDecoder()
+
     def set_state(self, state):
+        """
+        Accepts a state dict, or a binary state frame from the ship which may be a delta
+        on top of an earlier one.
+        """
+        if type(state) is bytes:
+            state = self.decoder.decode(state)
         if type(state) is not dict:
             raise TypeError("Non-dict state given.")
-        self.cabins.SetValue(state["cabins"])
-        self.cabins_mode.SetSelection(
-            [self.cabins_mode.GetItemLabel(i).lower() for i in range(self.cabins_mode.GetCount())].index(state["cabins_mode"])
-        )
-        self.nacelles.SetValue(state["nacelles"])
-        self.nacelles_mode.SetSelection(
-            [self.nacelles_mode.GetItemLabel(i).lower() for i in range(self.nacelles_mode.GetCount())].index(
-                state["nacelles_mode"])
-        )
-        self.blinkers.SetValue(state["blinkers"])
-        cabin_states = [c == "1" for c in state["cabin_lights"]]
-        for i in range(len(self.indicators)):
-            if i >= len(cabin_states):
-                self.indicators[i].SetBackgroundColour((0, 0, 0))
-            else:
-                if cabin_states[i]:
-                    self.indicators[i].SetBackgroundColour((0, 255, 0))
+        self.show(state, lambda lights: [CABIN_COLOURS[c] for c in lights])
+
+    def set_fleet_state(self, state):
+        """
+        Shows a fleet's aggregated state: settings the ships differ on show as undetermined,
+        or keep their last selection for the modes, and each indicator is shaded by how many
+        of the ships have that cabin lit.
+        """
+        self.show(state, lambda lit: [
+            (int(200 * (1 - fraction)), int(200 + 55 * fraction), int(200 * (1 - fraction))) for fraction in lit
+        ])
+
+    def show(self, state, cabin_colours):
+        """
+        Updates only the controls whose part of state differs from what they show. A value of
+        None leaves a check box undetermined and a radio box as it was. cabin_colours turns
+        state["cabin_lights"] into the indicator colours.
+        """
+        for key, check_box in self.check_boxes.items():
+            value = state.get(key)
+            if key not in self.shown or self.shown[key] != value:
+                self.shown[key] = value
+                if value is None:
+                    check_box.Set3StateValue(wx.CHK_UNDETERMINED)
                 else:
-                    self.indicators[i].SetBackgroundColour((200, 200, 200))
-            self.indicators[i].Refresh()
+                    check_box.SetValue(value)
+        for key, radio_box in self.radio_boxes.items():
+            value = state.get(key)
+            if value is not None and self.shown.get(key) != value:
+                self.shown[key] = value
+                radio_box.SetSelection(self.mode_indices[key][value])
+        lights = state.get("cabin_lights", ())
+        if self.shown.get("cabin_lights") != lights:
+            self.shown["cabin_lights"] = lights
+            self.indicators.set_colours(cabin_colours(lights))
 
     def Enable(self, enable=True):
         super(ControlPanel, self).Enable(enable)
@@ -123,7 +204,7 @@ class Controller(wx.App):
         self.target_addr = DEFAULT_SHIP_ADDR
         self.target_port = DEFAULT_SHIP_PORT
 
-        self.socket: socket.socket = socket.socket()
+        self.connection = None
         self.connected = False
 
         connection_sizer = wx.BoxSizer(wx.HORIZONTAL)
@@ -212,58 +293,97 @@ class Controller(wx.App):
 
         self.main_frame.SetSizerAndFit(main_sizer)
 
-        self.update_timer = wx.Timer(self)
-
         self.Bind(wx.EVT_BUTTON, self.open_connection, id=ID_CONNECT)
         self.Bind(wx.EVT_CHECKBOX, self.state_change)
         self.Bind(wx.EVT_RADIOBOX, self.mode_change)
-        self.Bind(wx.EVT_TIMER, self.refresh_state)
 
         self.main_frame.Show()
 
     def open_connection(self, e=None):
-        if not self.connected:
+        if self.connection is None:
+            self.connection_label.SetLabel("Connecting...")
+            self.connection_label.SetForegroundColour((0, 0, 0))
+            self.host_box.Disable()
+            self.port_box.Disable()
+            self.connect_button.Disable()
             try:
-                self.connection_label.SetLabel("Connecting...")
-                self.socket.connect((self.host_box.GetValue(), int(self.port_box.GetValue())))
-                self.connected = True
-                self.connection_label.SetLabel("Connected")
-                self.connection_label.SetForegroundColour((0, 255, 0))
-                self.control_panel.Enable()
-                self.refresh_state()
-                self.host_box.Disable()
-                self.port_box.Disable()
-                self.connect_button.Disable()
-                self.update_timer.Start(200)
-            except ConnectionRefusedError:
-                self.connection_label.SetLabel("Host Refused Connection")
-                self.connection_label.SetForegroundColour((255, 0, 0))
-            except socket.gaierror:
-                self.connection_label.SetLabel("Could Not Resolve Host")
-                self.connection_label.SetForegroundColour((255, 0, 0))
+                port = int(self.port_box.GetValue())
+            except ValueError:
+                self.on_connect_error(ValueError("Bad port."))
+                return
+            self.connection = ShipConnection(
+                self.apply_state,
+                self.on_connection_fail,
+                on_connect=self.on_connect,
+                on_error=self.on_connect_error,
+                dispatch=wx.CallAfter,
+                binary_state=USE_BINARY_STATE
+            )
+            self.connection.open(self.host_box.GetValue(), port)
             self.main_frame.Layout()
 
-    def send_command(self, command):
+    def on_connect(self):
+        """Called on connecting, and again each time the connection comes back after a drop."""
+        self.connected = True
+        self.connection_label.SetLabel("Connected")
+        self.connection_label.SetForegroundColour((0, 255, 0))
+        self.control_panel.decoder = StateDecoder()
+        self.control_panel.Enable()
+        # Subscribing gets the full state pushed straight away, so a reconnect resyncs too.
+        self.subscribe()
+        self.main_frame.Layout()
+
+    def on_connect_error(self, error):
+        self.connection = None
+        if isinstance(error, ConnectionRefusedError):
+            self.connection_label.SetLabel("Host Refused Connection")
+        elif isinstance(error, socket.gaierror):
+            self.connection_label.SetLabel("Could Not Resolve Host")
+        elif isinstance(error, socket.timeout):
+            self.connection_label.SetLabel("Connection Timed Out")
+        else:
+            self.connection_label.SetLabel("Could Not Connect")
+        self.connection_label.SetForegroundColour((255, 0, 0))
+        self.host_box.Enable()
+        self.port_box.Enable()
+        self.connect_button.Enable()
+        self.main_frame.Layout()
+
+    def send_command(self, command, callback=None):
+        """
+        Sends a command without blocking the GUI. callback(response), if given, is called
+        on the GUI thread once the ship answers.
+        """
         if self.connected is False:
             return
-        data = json.dumps(command).encode() + b"\n"
+        self.connection.request(command, callback)
+
+    def apply_state(self, state):
         try:
-            self.socket.send(data)
-            resp = self.socket.recv(512)
-            resp = json.loads(resp.decode())
-            return resp
-        except (ConnectionError, OSError):
-            self.on_connection_fail()
+            self.control_panel.set_state(state)
+        except ValueError:
+            # A delta on a state we no longer have, so drop the base and fetch the full state.
+            self.connection.send("ack 0")
+            self.send_command("get_state", self.resync_state)
+            return
+        if self.connection.binary_state:
+            self.connection.send(f"ack {self.control_panel.decoder.seq}")
 
-    def refresh_state(self, e=None):
-        data = self.send_command("get_state")
-        self.control_panel.set_state(data)
+    def resync_state(self, state):
+        if state is not None:
+            self.apply_state(state)
+
+    def subscribe(self):
+        """Asks the ship to push its state whenever it changes, in place of polling it."""
+        self.send_command(f"subscribe {MAX_STATE_RATE}")
 
     def state_change(self, e: wx.Event):
         e_obj: wx.CheckBox = e.GetEventObject()
         command = f"{e_obj.GetLabel().lower()} {'on' if e_obj.GetValue() else 'off'}"
+        # The box now shows what was clicked, not the ship, so whatever the ship says next is shown.
+        self.control_panel.shown.pop(e_obj.GetLabel().lower(), None)
         print(command)
-        resp = self.send_command(command)
+        self.send_command(command)
 
     def mode_change(self, e: wx.Event):
         e_obj: wx.RadioBox = e.GetEventObject()
@@ -274,19 +394,151 @@ class Controller(wx.App):
         else:
             return
         command = f"{target} mode {e_obj.GetItemLabel(e_obj.GetSelection()).lower()}"
+        self.control_panel.shown.pop(f"{target}_mode", None)
         print(command)
-        resp = self.send_command(command)
+        self.send_command(command)
 
     def on_connection_fail(self):
-        self.update_timer.Stop()
+        """The connection dropped; it reconnects by itself, so just wait for on_connect."""
         self.connected = False
         self.control_panel.Disable()
-        self.host_box.Enable()
-        self.port_box.Enable()
-        self.connect_button.Enable()
+        self.connection_label.SetLabel("Reconnecting...")
+        self.connection_label.SetForegroundColour((255, 128, 0))
+        self.main_frame.Layout()
+
+
+class FleetController(Controller):
+    """
+    Controls many ships together: every command goes to all of them at once, and the panel
+    shows their combined state.
+    """
+    def __init__(self, addresses, redirect=False, filename=None):
+        """
+        :type addresses: list[tuple[str, int]]
+        """
+        self.addresses = addresses
+        self.fleet = None
+        self.shown_counts = None  # The (connected, ships) the connection label shows.
+        super().__init__(redirect, filename)
+        self.main_frame.SetTitle("USS Lux - Fleet of {}".format(len(addresses)))
+        self.host_box.SetValue(", ".join("{}:{}".format(host, port) for host, port in addresses))
+        self.host_box.Disable()
+        self.port_box.Disable()
+
+    def open_connection(self, e=None):
+        if self.fleet is None:
+            self.connect_button.Disable()
+            self.connection_label.SetLabel("Connecting to {} ships...".format(len(self.addresses)))
+            self.connection_label.SetForegroundColour((0, 0, 0))
+            self.shown_counts = None
+            self.fleet = Fleet(self.addresses, on_state=self.apply_fleet_state, dispatch=wx.CallAfter)
+            self.fleet.start()
+            self.main_frame.Layout()
+
+    def send_command(self, command, callback=None):
+        """Sends the command to every ship. callback, if given, gets a dict of ship -> response."""
+        if self.fleet is not None:
+            self.fleet.command(command, callback)
+
+    def apply_fleet_state(self, state):
+        """Like ControlPanel.show, only touches the label and panel when what they show changes."""
+        connected, ships = state["connected"], state["ships"]
+        if self.shown_counts != (connected, ships):
+            was_connected = self.shown_counts is not None and self.shown_counts[0] > 0
+            self.shown_counts = (connected, ships)
+            self.connected = connected > 0
+            self.connection_label.SetLabel("{} of {} Ships Connected".format(connected, ships))
+            if connected == ships:
+                self.connection_label.SetForegroundColour((0, 255, 0))
+            elif connected:
+                self.connection_label.SetForegroundColour((255, 128, 0))
+            else:
+                self.connection_label.SetForegroundColour((255, 0, 0))
+            if self.connected != was_connected:
+                self.control_panel.Enable(self.connected)
+            self.main_frame.Layout()
+        if self.connected:
+            self.control_panel.set_fleet_state(state)
+
+
+class ViewerController(Controller):
+    """
+    Only watches: shows the state a ship multicasts (pi_side.py --multicast), without
+    connecting to it, so the ship's connection is left free for whoever is controlling it.
+    """
+    def __init__(self, group, port, ship=None, redirect=False, filename=None):
+        self.group = group
+        self.multicast_port = port
+        self.ship = ship
+        self.listener = None
+        super().__init__(redirect, filename)
+        self.main_frame.SetTitle("USS Lux - Watching")
+        self.host_box.SetValue(ship or group)
+        self.port_box.SetValue(str(port))
+        self.host_box.Disable()
+        self.port_box.Disable()
+        self.connect_button.SetLabel("Watch")
+
+    def open_connection(self, e=None):
+        if self.listener is None:
+            self.connect_button.Disable()
+            self.connection_label.SetLabel("Waiting for the ship...")
+            self.connection_label.SetForegroundColour((0, 0, 0))
+            self.listener = StateListener(
+                self.control_panel.set_state,
+                self.on_signal,
+                self.group,
+                self.multicast_port,
+                ship=self.ship,
+                dispatch=wx.CallAfter
+            )
+            try:
+                self.listener.start()
+            except OSError as error:
+                self.listener = None
+                self.connect_button.Enable()
+                self.connection_label.SetLabel("Could Not Join {}: {}".format(self.group, error.strerror))
+                self.connection_label.SetForegroundColour((255, 0, 0))
+            self.main_frame.Layout()
 
+    def send_command(self, command, callback=None):
+        """Viewers never send anything."""
+
+    def on_signal(self, signal):
+        if signal:
+            self.connection_label.SetLabel("Watching {}".format(self.listener.ship))
+            self.connection_label.SetForegroundColour((0, 255, 0))
+        else:
+            self.connection_label.SetLabel("No Signal")
+            self.connection_label.SetForegroundColour((255, 128, 0))
+        self.main_frame.Layout()
 
 
 if __name__ == '__main__':
-    app = Controller()
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--fleet",
+        nargs="+",
+        metavar="HOST[:PORT]",
+        help="Control several ships at once, instead of one chosen in the window."
+    )
+    parser.add_argument(
+        "--watch",
+        nargs="?",
+        const="{}:{}".format(MULTICAST_GROUP, MULTICAST_PORT),
+        metavar="GROUP[:PORT]",
+        help="Only show the state a ship multicasts, without connecting to it."
+    )
+    parser.add_argument(
+        "--ship",
+        help="With --watch, which ship to follow when several multicast to the same group."
+    )
+    args = parser.parse_args()
+
+    if args.fleet:
+        app = FleetController([parse_address(address, DEFAULT_SHIP_PORT) for address in args.fleet])
+    elif args.watch:
+        app = ViewerController(*parse_address(args.watch, MULTICAST_PORT), ship=args.ship)
+    else:
+        app = Controller()
     app.MainLoop()
@@ -0,0 +1,270 @@
+"""
+Drives a fleet of ships at once, for events where several models run together.
+
+Every ship has one persistent connection, all served from a single asyncio loop on a
+background thread. Commands go to every ship in parallel, each with its own timeout,
+so one slow or missing ship costs the others nothing.
+
+Every ship's shared clock is also kept to this process's time.monotonic(), so their
+blinkers stay in phase (see pi_side/clock.py).
+"""
+import asyncio
+import json
+from itertools import count
+from threading import Thread
+from time import monotonic
+
+from connection import ADDRESSES, CONNECT_TIMEOUT, RECONNECT_DELAY, RECONNECT_MAX_DELAY
+
+SHIP_TIMEOUT = 0.5  # Seconds each ship has to answer a command before it is counted as missing.
+FLEET_STATE_RATE = 5  # Most state updates per second each ship pushes to us.
+AGGREGATE_INTERVAL = 0.05  # Seconds between aggregated state updates while ships are changing.
+MISSING = object()  # What ShipLink.request() returns for a ship which didn't answer.
+CLOCK_SAMPLES = 8  # Time exchanges per sync; the one with the shortest round trip is used.
+CLOCK_SYNC_INTERVAL = 30.0  # Seconds between syncs of each ship's clock, against drift.
+CLOCK_TOLERANCE = 0.0005  # Offsets smaller than this, in seconds, are left alone.
+
+
+def parse_address(address, default_port):
+    """Splits "host" or "host:port" into (host, port)."""
+    host, _, port = address.rpartition(":")
+    if not host:
+        return port, default_port
+    return host, int(port)
+
+
+def aggregate(states, ships):
+    """
+    Combines ship states into one for the control panel. A setting every ship agrees on keeps
+    its value, and one they differ on is None. cabin_lights gives, for each light, the
+    fraction of ships which have it lit.
+    :type states: list[dict]
+    :param ships: How many ships there are in the fleet, connected or not.
+    """
+    result = {"ships": ships, "connected": len(states)}
+    if not states:
+        return result
+    for key in ("cabins", "cabins_mode", "nacelles", "nacelles_mode", "blinkers"):
+        values = {state[key] for state in states}
+        result[key] = values.pop() if len(values) == 1 else None
+    length = max(len(state["cabin_lights"]) for state in states)
+    result["cabin_lights"] = [
+        sum(state["cabin_lights"][i:i + 1] == "1" for state in states) / len(states)
+        for i in range(length)
+    ]
+    return result
+
+
+class ShipLink:
+    """
+    One ship's connection. It connects, subscribes to the ship's state, and reconnects
+    with backoff whenever the connection drops, until the fleet closes.
+    """
+    def __init__(self, host, port, on_state):
+        self.host = host
+        self.port = port
+        self.on_state = on_state
+        self.state = None
+        self.connected = False
+        self.clock = None  # (offset, round trip) of the ship's clock, as last measured.
+        self.clock_due = 0.0  # time.monotonic() at which the clock next wants syncing.
+        self.__ids = count(1)
+        self.__pending = {}  # request id -> future
+        self.__writer = None
+
+    @property
+    def name(self):
+        return "{}:{}".format(self.host, self.port)
+
+    async def run(self, closing):
+        delay = RECONNECT_DELAY
+        while not closing.is_set():
+            try:
+                reader = await self.__connect()
+            except (OSError, asyncio.TimeoutError):
+                try:
+                    await asyncio.wait_for(closing.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                continue
+            delay = RECONNECT_DELAY
+            closer = asyncio.ensure_future(closing.wait())
+            reading = asyncio.ensure_future(self.__read_messages(reader))
+            await asyncio.wait((closer, reading), return_when=asyncio.FIRST_COMPLETED)
+            closer.cancel()
+            reading.cancel()
+            self.__disconnected()
+
+    async def __connect(self):
+        loop = asyncio.get_running_loop()
+        addresses = await loop.run_in_executor(None, ADDRESSES.resolve, self.host, self.port)
+        error = None
+        for _, address in addresses:
+            try:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(address[0], address[1]),
+                    CONNECT_TIMEOUT
+                )
+            except (OSError, asyncio.TimeoutError) as e:
+                error = e
+                continue
+            self.__writer = writer
+            self.connected = True
+            self.__write(f"subscribe {FLEET_STATE_RATE}")
+            return reader
+        ADDRESSES.forget(self.host, self.port)
+        raise error or OSError("No addresses found for {}.".format(self.host))
+
+    def __disconnected(self):
+        self.connected = False
+        self.clock_due = 0.0  # It may have restarted, so sync as soon as it's back.
+        if self.__writer is not None:
+            self.__writer.close()
+            self.__writer = None
+        for future in self.__pending.values():
+            if not future.done():
+                future.set_result(MISSING)
+        self.__pending.clear()
+        self.on_state(self)
+
+    def __write(self, message):
+        self.__writer.write(json.dumps(message).encode() + b"\n")
+
+    async def __read_messages(self, reader):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                message = json.loads(line)
+                if type(message) is not dict:
+                    continue
+                if message.get("event") == "state":
+                    self.state = message["state"]
+                    self.on_state(self)
+                elif "id" in message:
+                    future = self.__pending.pop(message["id"], None)
+                    if future is not None and not future.done():
+                        future.set_result(message.get("result"))
+        except (ConnectionError, OSError, ValueError):
+            pass
+
+    async def request(self, command, timeout=SHIP_TIMEOUT):
+        """Sends a command and returns the ship's answer, or MISSING if it doesn't answer in time."""
+        if not self.connected:
+            return MISSING
+        request_id = next(self.__ids)
+        future = asyncio.get_running_loop().create_future()
+        self.__pending[request_id] = future
+        try:
+            self.__write({"id": request_id, "command": command})
+            return await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, ConnectionError, OSError):
+            return MISSING
+        finally:
+            self.__pending.pop(request_id, None)
+
+    async def sync_clock(self, samples=CLOCK_SAMPLES):
+        """
+        Measures how far the ship's shared clock is from this process's time.monotonic(),
+        and adjusts it if it is out by more than CLOCK_TOLERANCE. Returns (offset, round
+        trip) as measured, or None if the ship has no shared clock or didn't answer.
+        """
+        self.clock_due = monotonic() + CLOCK_SYNC_INTERVAL
+        best = None
+        for _ in range(samples):
+            sent = monotonic()
+            result = await self.request("time")
+            received = monotonic()
+            if type(result) is not dict or "time" not in result:
+                return None
+            round_trip = received - sent
+            if best is None or round_trip < best[1]:
+                best = (result["time"] - (sent + received) / 2, round_trip)
+        offset, round_trip = best
+        if abs(offset) > CLOCK_TOLERANCE:
+            await self.request(f"clock adjust {-offset:.6f} {round_trip / 2:.6f}")
+        self.clock = best
+        return best
+
+
+class Fleet:
+    """
+    on_state(aggregated_state) is called through dispatch as ships' states change, at most
+    once every AGGREGATE_INTERVAL, with aggregate() of every connected ship's latest state.
+    """
+    def __init__(self, addresses, on_state=None, dispatch=None, timeout=SHIP_TIMEOUT):
+        """
+        :type addresses: list[tuple[str, int]]
+        """
+        self.links = [ShipLink(host, port, self.__state_changed) for host, port in addresses]
+        self.on_state = on_state
+        self.dispatch = dispatch or (lambda function, *args: function(*args))
+        self.timeout = timeout
+        self.loop = asyncio.new_event_loop()
+        self.__closing = None
+        self.__update_pending = False
+        self.__thread = None
+
+    def start(self):
+        self.__thread = Thread(target=self.__run, name="fleet")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __run(self):
+        asyncio.set_event_loop(self.loop)
+        self.__closing = asyncio.Event()
+        self.loop.run_until_complete(asyncio.gather(
+            self.__sync_clocks(self.__closing),
+            *(link.run(self.__closing) for link in self.links)
+        ))
+
+    async def __sync_clocks(self, closing):
+        """Syncs each ship's clock on connecting, then every CLOCK_SYNC_INTERVAL."""
+        while not closing.is_set():
+            now = monotonic()
+            due = [link for link in self.links if link.connected and link.clock_due <= now]
+            await asyncio.gather(*(link.sync_clock() for link in due))
+            try:
+                await asyncio.wait_for(closing.wait(), 1.0)
+            except asyncio.TimeoutError:
+                pass
+
+    def close(self):
+        self.loop.call_soon_threadsafe(lambda: self.__closing and self.__closing.set())
+
+    def submit(self, coroutine, callback=None):
+        """Runs a coroutine on the fleet's loop from any thread, dispatching callback(result) when done."""
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        if callback is not None:
+            future.add_done_callback(lambda f: self.dispatch(callback, f.result()))
+        return future
+
+    def command(self, command, callback=None):
+        """
+        Sends a command to every ship at once. callback gets a dict of ship name -> response,
+        without the ships which didn't answer in time.
+        """
+        return self.submit(self.broadcast(command), callback)
+
+    def get_states(self, callback):
+        """Fetches every ship's state at once. callback gets a dict of ship name -> state."""
+        return self.command("get_state", callback)
+
+    async def broadcast(self, command):
+        results = await asyncio.gather(*(link.request(command, self.timeout) for link in self.links))
+        return {link.name: result for link, result in zip(self.links, results) if result is not MISSING}
+
+    def aggregate(self):
+        return aggregate([link.state for link in self.links if link.connected and link.state], len(self.links))
+
+    def __state_changed(self, link):
+        if self.__update_pending or self.on_state is None:
+            return
+        self.__update_pending = True
+        self.loop.call_later(AGGREGATE_INTERVAL, self.__publish)
+
+    def __publish(self):
+        self.__update_pending = False
+        self.dispatch(self.on_state, self.aggregate())
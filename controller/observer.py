@@ -0,0 +1,95 @@
+"""
+Follows a ship's state from its multicast datagrams (see pi_side/multicast.py), without
+connecting to it. Nothing is ever sent, so any number of observers cost the ship nothing.
+"""
+import socket
+import struct
+from threading import Thread
+from time import monotonic
+
+from wire import StateDecoder, is_binary_frame, HEADER
+
+MULTICAST_GROUP = "239.255.31.41"
+MULTICAST_PORT = 31415
+SIGNAL_TIMEOUT = 3.0  # Seconds without a datagram before the ship counts as gone; a few keepalives.
+
+
+class StateListener:
+    """
+    Joins the multicast group on a background thread, calling on_state with each new state
+    dict, and on_signal(True / False) as the ship's datagrams start and stop arriving. Both
+    are called through dispatch, so with wx.CallAfter they run on the GUI thread.
+
+    With several ships on the one group, ship picks out the host to follow; otherwise the
+    first heard is followed. A repeat of the last seq is a keepalive and isn't passed on, and
+    a seq lower than the last means the ship restarted, so it is taken as new.
+    """
+    def __init__(self, on_state, on_signal=None, group=MULTICAST_GROUP, port=MULTICAST_PORT, ship=None,
+                 interface="0.0.0.0", dispatch=None, timeout=SIGNAL_TIMEOUT):
+        self.on_state = on_state
+        self.on_signal = on_signal
+        self.group = group
+        self.port = port
+        self.ship = socket.gethostbyname(ship) if ship else None
+        self.interface = interface
+        self.dispatch = dispatch or (lambda f, *args: f(*args))
+        self.timeout = timeout
+        self.seq = None
+        self.signal = False
+        self.received = 0
+        self.sock = None
+        self.__running = False
+        self.__thread = None
+
+    def start(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(("", self.port))
+        membership = struct.pack("4s4s", socket.inet_aton(self.group), socket.inet_aton(self.interface))
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        self.sock.settimeout(self.timeout)
+        self.__running = True
+        self.__thread = Thread(target=self.__run, name="multicast-listener")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def close(self):
+        self.__running = False
+        if self.sock is not None:
+            self.sock.close()
+
+    def __set_signal(self, signal):
+        if signal != self.signal:
+            self.signal = signal
+            if self.on_signal is not None:
+                self.dispatch(self.on_signal, signal)
+
+    def __run(self):
+        decoder = StateDecoder(history=1)
+        last_heard = monotonic()
+        while self.__running:
+            try:
+                payload, (host, _) = self.sock.recvfrom(1024)
+            except socket.timeout:
+                self.__set_signal(False)
+                continue
+            except OSError:
+                break
+            if self.ship is None:
+                self.ship = host
+            if host != self.ship or len(payload) < HEADER.size or not is_binary_frame(payload):
+                if monotonic() - last_heard > self.timeout:
+                    self.__set_signal(False)
+                continue
+            last_heard = monotonic()
+            self.received += 1
+            self.__set_signal(True)
+            seq = HEADER.unpack_from(payload)[2]
+            if seq == self.seq:
+                continue
+            try:
+                state = decoder.decode(payload)
+            except (ValueError, IndexError, struct.error):
+                continue
+            self.seq = seq
+            self.dispatch(self.on_state, state)
@@ -0,0 +1,86 @@
+"""
+Decoding of the ship's binary state frames. See pi_side/wire.py for the layout.
+"""
+import struct
+from collections import OrderedDict
+
+BINARY_VERSION = 1
+
+DELTA = 0x01
+REPLY = 0x80
+
+HEADER = struct.Struct("!BBIIB")
+
+CABINS = 0x01
+NACELLES = 0x02
+BLINKERS = 0x04
+CABINS_MODE = 0x08
+NACELLES_MODE = 0x10
+CABIN_LIGHTS = 0x20
+
+FLAG_FIELDS = ((CABINS, "cabins"), (NACELLES, "nacelles"), (BLINKERS, "blinkers"))
+CABINS_MODES = ("random", "static")
+NACELLES_MODES = ("pulse", "static")
+
+
+def is_binary_frame(payload):
+    """JSON never starts with this byte, so it marks a frame as binary."""
+    return len(payload) > 0 and payload[0] == BINARY_VERSION
+
+
+def is_reply(payload):
+    return bool(payload[1] & REPLY)
+
+
+class StateDecoder:
+    """
+    Rebuilds full state dicts from binary frames. The last few states are kept, so a delta
+    can be applied to whichever one it was based on.
+    """
+    def __init__(self, history=32):
+        self.history = history
+        self.states = OrderedDict()
+        self.seq = 0
+
+    def decode(self, payload):
+        """
+        Returns the full state described by the frame. Raises ValueError if it is a delta
+        whose base state is not known, in which case the ship should be asked for a full one.
+        :type payload: bytes
+        """
+        version, kind, seq, base_seq, fields = HEADER.unpack_from(payload)
+        if version != BINARY_VERSION:
+            raise ValueError("Unsupported state frame version {}.".format(version))
+        if kind & DELTA:
+            if base_seq not in self.states:
+                raise ValueError("Delta based on unknown state {}.".format(base_seq))
+            state = dict(self.states[base_seq])
+        else:
+            state = {}
+
+        offset = HEADER.size
+        if fields & (CABINS | NACELLES | BLINKERS):
+            flags = payload[offset]
+            offset += 1
+            for bit, name in FLAG_FIELDS:
+                if fields & bit:
+                    state[name] = bool(flags & bit)
+        if fields & (CABINS_MODE | NACELLES_MODE):
+            modes = payload[offset]
+            offset += 1
+            if fields & CABINS_MODE:
+                state["cabins_mode"] = CABINS_MODES[modes & 0x0F]
+            if fields & NACELLES_MODE:
+                state["nacelles_mode"] = NACELLES_MODES[modes >> 4]
+        if fields & CABIN_LIGHTS:
+            count = payload[offset]
+            mask = payload[offset + 1:offset + 1 + (count + 7) // 8]
+            state["cabin_lights"] = "".join(
+                "1" if mask[i // 8] & (1 << (i % 8)) else "0" for i in range(count)
+            )
+
+        self.states[seq] = state
+        while len(self.states) > self.history:
+            self.states.popitem(last=False)
+        self.seq = seq
+        return state
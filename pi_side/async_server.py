@@ -0,0 +1,153 @@
+import asyncio
+import json
+
+from framing import LENGTH_HEADER, LENGTH_PREFIXED, LINE
+from session import ClientSession
+
+
+class AsyncShipServer:
+    """
+    Serves any number of clients at once from a single asyncio loop.
+
+    Every client gets its own stream reader and writer, so a slow or chatty client only
+    fills its own buffers. Commands from all clients are funnelled through the controller's
+    command queue, so the lights only ever see one command at a time, in arrival order.
+    A client's commands which may be merged are read on from without waiting for their
+    replies, so a burst of them can be; replies are still sent in order.
+
+    sock may be a socket already listening, to serve on in place of opening host and port.
+    """
+    def __init__(self, controller, host="0.0.0.0", port=3141, framing=LINE, max_message_size=65536, sock=None):
+        self.controller = controller
+        self.host = host
+        self.port = port
+        self.sock = sock
+        self.framing = framing
+        self.max_message_size = max_message_size
+        self.clients = set()
+        self.__stopped = None
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        self.__stopped = asyncio.Event()
+        if self.sock is not None:
+            server = await asyncio.start_server(self.handle_client, sock=self.sock, limit=self.max_message_size)
+        else:
+            server = await asyncio.start_server(
+                self.handle_client,
+                self.host,
+                self.port,
+                reuse_address=True,
+                limit=self.max_message_size
+            )
+        print("<System> Async socket open and listening.")
+        async with server:
+            await self.__stopped.wait()
+
+    async def read_message(self, reader, framing):
+        """Returns the next message from a client as str, or None once they disconnect."""
+        try:
+            if framing == LENGTH_PREFIXED:
+                (length,) = LENGTH_HEADER.unpack(await reader.readexactly(LENGTH_HEADER.size))
+                if length > self.max_message_size:
+                    raise ValueError("Message of {} bytes exceeds {} bytes.".format(length, self.max_message_size))
+                data = await reader.readexactly(length)
+                self.controller.metrics.received(LENGTH_HEADER.size)
+            else:
+                data = await reader.readuntil(b"\n")
+        except asyncio.IncompleteReadError:
+            return None
+        except asyncio.LimitOverrunError:
+            raise ValueError("Message exceeds {} bytes.".format(self.max_message_size))
+        self.controller.metrics.received(len(data))
+        return data.decode()
+
+    async def send_reply(self, writer, session, reply):
+        resp = session.encode_response(reply)
+        if resp is not None:
+            writer.write(resp)
+            self.controller.metrics.sent(len(resp))
+            await writer.drain()
+
+    async def send_replies(self, replies, writer, session, failed):
+        """
+        Sends each reply from the replies queue in turn, until it gives None. Once one fails,
+        the error is added to failed and the rest are dropped, so replies.join() still returns.
+        """
+        while True:
+            reply = await replies.get()
+            try:
+                if reply is None:
+                    return
+                reply = await reply
+                if not failed:
+                    await self.send_reply(writer, session, reply)
+            except Exception as e:
+                failed.append(e)
+            finally:
+                replies.task_done()
+
+    async def handle_client(self, reader, writer):
+        addr = writer.get_extra_info("peername")
+        loop = asyncio.get_running_loop()
+        metrics = self.controller.metrics
+        session = ClientSession(
+            metrics.counted(lambda data: loop.call_soon_threadsafe(writer.write, data)),
+            self.framing
+        )
+        metrics.connected()
+        self.clients.add(writer)
+        self.set_connected()
+        print(f"<System> Client connected from {addr}.")
+        replies = asyncio.Queue()  # Of replies to commands which may be merged, still to be sent.
+        failed = []
+        sender = asyncio.ensure_future(self.send_replies(replies, writer, session, failed))
+        try:
+            while self.controller.run and not failed:
+                message = await self.read_message(reader, session.framing)
+                if message is None:
+                    break
+                try:
+                    command = json.loads(message)
+                except json.JSONDecodeError:
+                    print("<System> JSONDecodeError: Bad data received.")
+                    metrics.json_error()
+                    continue
+                merges = self.controller.merge_slots(command)
+                queue = self.controller.command_queue
+                if merges is not None:
+                    replies.put_nowait(asyncio.wrap_future(queue.submit(command, session, merges)))
+                    continue
+                # It may change the session, such as its framing, so it's run alone: the replies
+                # before it are sent first, and the next command is only read once it's done.
+                await replies.join()
+                if failed:
+                    raise failed[0]
+                reply = await asyncio.wrap_future(queue.submit(command, session))
+                await self.send_reply(writer, session, reply)
+            replies.put_nowait(None)
+            await sender
+            if failed:
+                raise failed[0]
+        except ValueError as e:
+            print(f"<System> Dropping client {addr}: {e}")
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            sender.cancel()
+            session.close()
+            self.clients.discard(writer)
+            writer.close()
+            print(f"<System> Client {addr} disconnected.")
+            self.set_connected()
+            if not self.controller.run:
+                self.__stopped.set()
+
+    def set_connected(self):
+        connected = bool(self.clients)
+        if connected != self.controller.connected:
+            self.controller.connected = connected
+            if self.controller.run:
+                self.controller.update_screen()
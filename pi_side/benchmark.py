@@ -0,0 +1,453 @@
+"""
+Measures the ship's network performance without any hardware attached.
+
+The ship is started as a subprocess on gpiozero's MockFactory (using MockPWMPin so the
+nacelles can still pulse) and driven over its socket.
+
+throughput pipelines commands down one connection. Passing --baseline runs the same
+measurement against the pi_side directory of an earlier git revision for comparison.
+
+    python3 benchmark.py throughput --commands 20000 --baseline HEAD~1
+
+clients measures get_state round trip latency with many clients connected to the
+async server at once.
+
+    python3 benchmark.py clients --clients 1 10 100
+
+startup measures how long the ship takes from launch to accepting a connection, and to
+answering its first command.
+
+    python3 benchmark.py startup --runs 10
+
+suite runs everything worth tracking from commit to commit: commands/sec and get_state
+latency through the socket, the ship's thread count and memory, and, in this process
+on MockFactory, how closely nacelle pulses and random cabin toggles keep to time.
+
+    python3 benchmark.py --output results.json suite
+
+--output writes any benchmark's results as JSON, to compare runs with.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from io import BytesIO
+from threading import Thread
+
+from framing import frame, CommandReader, FRAMINGS, LINE
+
+SHIP_DIR = os.path.dirname(os.path.abspath(__file__))
+SHIP_PORT = 3141
+# Cheap and idempotent, so the network loop dominates, and changes state like a light
+# command without being one the command queue merges, so every command sent is run.
+BENCH_COMMAND = "effect cabins off"
+
+
+def mock_environment():
+    env = dict(os.environ)
+    env["GPIOZERO_PIN_FACTORY"] = "mock"
+    env["GPIOZERO_MOCK_PIN_CLASS"] = "mockpwmpin"
+    return env
+
+
+def ship_command(ship_dir, *args):
+    """
+    The command to run the ship in ship_dir. This tree's ship is kept from restoring or
+    journaling its state, so every run starts alike; baselines from before the journal
+    don't know the option, and never had one.
+    """
+    if ship_dir == SHIP_DIR:
+        args += ("--no_journal",)
+    return [sys.executable, "pi_side.py", *args]
+
+
+def start_ship(ship_dir, *args, timeout=10.0):
+    ship = subprocess.Popen(
+        ship_command(ship_dir, *args),
+        cwd=ship_dir,
+        env=mock_environment(),
+        stdout=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if ship.poll() is not None:
+            raise RuntimeError("Ship exited during startup.")
+        try:
+            socket.create_connection(("127.0.0.1", SHIP_PORT), timeout=0.1).close()
+            # The old single client loop needs a moment to notice the probe has gone.
+            time.sleep(0.2)
+            return ship
+        except OSError:
+            time.sleep(0.05)
+    ship.kill()
+    raise RuntimeError("Ship did not start listening within {}s.".format(timeout))
+
+
+def startup_times(ship_dir, timeout=10.0):
+    """
+    Launches the ship and returns the seconds until it first accepted a connection, and
+    until it first answered get_state on it.
+    """
+    request = frame(json.dumps("get_state").encode())
+    start = time.perf_counter()
+    ship = subprocess.Popen(
+        ship_command(ship_dir),
+        cwd=ship_dir,
+        env=mock_environment(),
+        stdout=subprocess.DEVNULL
+    )
+    try:
+        while True:
+            if ship.poll() is not None:
+                raise RuntimeError("Ship exited during startup.")
+            if time.perf_counter() - start > timeout:
+                raise RuntimeError("Ship did not start listening within {}s.".format(timeout))
+            try:
+                sock = socket.create_connection(("127.0.0.1", SHIP_PORT), timeout=timeout)
+                break
+            except OSError:
+                time.sleep(0.005)
+        listening = time.perf_counter() - start
+        with sock:
+            sock.sendall(request)
+            sock.recv(65536)
+        return listening, time.perf_counter() - start
+    finally:
+        stop_ship(ship)
+
+
+def stop_ship(ship):
+    ship.kill()
+    ship.wait()
+
+
+def export_revision(revision, target):
+    """Extracts pi_side/ from the given git revision into target, returning its path."""
+    archive = subprocess.check_output(
+        ["git", "archive", "--format=tar", revision, "pi_side"],
+        cwd=os.path.dirname(SHIP_DIR)
+    )
+    with tarfile.open(fileobj=BytesIO(archive)) as tar:
+        tar.extractall(target)
+    return os.path.join(target, "pi_side")
+
+
+def commands_per_second(count, framing=LINE, response_size=None):
+    """
+    Pipelines count commands at the ship and times how long it takes for every
+    response to come back.
+    """
+    request = frame(json.dumps(BENCH_COMMAND).encode(), framing)
+    sock = socket.create_connection(("127.0.0.1", SHIP_PORT))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    if response_size is None:
+        # Every response is the same, so one sent first says how many bytes to wait for.
+        sock.sendall(request)
+        response_size = len(frame(read_message(CommandReader(sock, framing)).encode(), framing))
+    expected = response_size * count
+
+    def send_all():
+        batch = request * 100
+        for _ in range(count // 100):
+            sock.sendall(batch)
+        sock.sendall(request * (count % 100))
+
+    start = time.perf_counter()
+    sender = Thread(target=send_all, daemon=True)
+    sender.start()
+    received = 0
+    while received < expected:
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise RuntimeError("Ship closed the connection after {} of {} bytes.".format(received, expected))
+        received += len(chunk)
+    elapsed = time.perf_counter() - start
+    sender.join()
+    sock.close()
+    return count / elapsed
+
+
+def read_message(reader):
+    """The next message from a CommandReader."""
+    while reader.fill():
+        for message in reader.messages():
+            return message
+    raise RuntimeError("Ship closed the connection.")
+
+
+def queue_stats(framing=LINE):
+    """The ship's command queue stats (see command_queue.py), asked for on a new connection."""
+    with socket.create_connection(("127.0.0.1", SHIP_PORT), timeout=5.0) as sock:
+        sock.sendall(frame(json.dumps("stats").encode(), framing))
+        return json.loads(read_message(CommandReader(sock, framing, max_message_size=1 << 20)))["queue"]
+
+
+async def client_latencies(clients, requests):
+    """
+    Connects the given number of clients, then has every one of them send get_state
+    requests one after another. Returns all the round trip times in seconds.
+    """
+    request = frame(json.dumps("get_state").encode())
+    connections = [
+        await asyncio.open_connection("127.0.0.1", SHIP_PORT)
+        for _ in range(clients)
+    ]
+    latencies = []
+
+    async def client(reader, writer):
+        for _ in range(requests):
+            start = time.perf_counter()
+            writer.write(request)
+            await reader.readuntil(b"\n")
+            latencies.append(time.perf_counter() - start)
+
+    await asyncio.gather(*(client(reader, writer) for reader, writer in connections))
+    for _, writer in connections:
+        writer.close()
+    return latencies
+
+
+def summarise(latencies):
+    latencies = sorted(latencies)
+    return {
+        "mean_ms": 1000 * sum(latencies) / len(latencies),
+        "p50_ms": 1000 * latencies[len(latencies) // 2],
+        "p99_ms": 1000 * latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+        "max_ms": 1000 * latencies[-1],
+    }
+
+
+def process_usage(pid):
+    """Returns the thread count and resident memory of a process, from /proc."""
+    usage = {}
+    with open("/proc/{}/status".format(pid)) as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if name == "Threads":
+                usage["threads"] = int(value)
+            elif name == "VmRSS":
+                usage["rss_kb"] = int(value.split()[0])
+    return usage
+
+
+def mock_pins():
+    """Puts every gpiozero device made in this process onto mock pins."""
+    from gpiozero import Device
+    from gpiozero.pins.mock import MockFactory, MockPWMPin
+    if Device.pin_factory is not None:
+        Device.pin_factory.close()
+    Device.pin_factory = MockFactory(pin_class=MockPWMPin)
+
+
+def interval_errors(pin, expected):
+    """Returns how far each gap between the pin's changes was from expected seconds."""
+    return [abs(state.timestamp - expected) for state in pin.states[2:]]
+
+
+def pulse_timing(duration, rate):
+    """
+    Pulses a CustomPWMLED the way the nacelles do for duration seconds, and measures
+    how far apart the brightness updates really were, compared with 1 / rate.
+    """
+    from framebuffer import FrameBuffer
+    from lights import CustomPWMLED
+    from pi_side import NACELLE_PULSE
+    from scheduler import Scheduler
+    mock_pins()
+    scheduler = Scheduler()
+    frame = FrameBuffer()
+    scheduler.tick_hooks.append(frame.flush)
+    led = CustomPWMLED(15, scheduler=scheduler, frame=frame, pulse_rate=rate)
+    led.pin.clear_states()
+    led.custom_pulse(*NACELLE_PULSE)
+    time.sleep(duration)
+    led.custom_stop()
+    updates = len(led.pin.states) - 1
+    result = summarise(interval_errors(led.pin, 1 / rate))
+    result.update(updates_per_second=updates / duration, expected_per_second=rate)
+    return result
+
+
+def toggle_timing(duration, lights=16):
+    """
+    Runs a DynamicLights for each of the cabin pins for duration seconds, and measures how
+    often they really toggled and how late the scheduler ran each toggle. Each toggles
+    after a random 0 to 5 seconds, so together they should average lights / 2.5 a second.
+    """
+    from framebuffer import FrameBuffer
+    from lights import DynamicLights
+    from scheduler import Scheduler
+    from gpiozero import LED
+    mock_pins()
+    scheduler = Scheduler()
+    frame = FrameBuffer()
+    scheduler.tick_hooks.append(frame.flush)
+    pins = (12, 16, 20, 21, 26, 19, 13, 6, 5, 11, 9, 10, 22, 27, 17, 4)[:lights]
+    groups = [DynamicLights([LED(pin)], scheduler=scheduler, frame=frame) for pin in pins]
+    for group in groups:
+        group.on()
+    frame.flush()
+    for group in groups:
+        group.lights[0].pin.clear_states()
+    time.sleep(duration)
+    for group in groups:
+        group.off()
+    toggles = sum(len(group.lights[0].pin.states) - 1 for group in groups)
+    stats = scheduler.stats()
+    return {
+        "toggles_per_second": toggles / duration,
+        "expected_per_second": len(groups) / 2.5,
+        "mean_jitter_ms": stats["mean_jitter_ms"],
+        "max_jitter_ms": stats["max_jitter_ms"],
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"],
+            cwd=SHIP_DIR,
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def startup(runs, ship_dir=SHIP_DIR):
+    listening, ready = zip(*(startup_times(ship_dir) for _ in range(runs)))
+    return {"listening": summarise(listening), "ready": summarise(ready)}
+
+
+def run_startup(args):
+    results = {}
+    if args.baseline:
+        with tempfile.TemporaryDirectory() as tmp:
+            results["baseline"] = startup(args.runs, export_revision(args.baseline, tmp))
+    results["current"] = startup(args.runs)
+    return results
+
+
+def run_suite(args):
+    results = {
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "time": time.time(),
+    }
+    ship = start_ship(SHIP_DIR)
+    try:
+        results["ship_idle"] = process_usage(ship.pid)
+        results["commands_per_second"] = commands_per_second(args.commands)
+        results["commands_merged"] = queue_stats()["merged"]
+        results["get_state_latency"] = summarise(asyncio.run(client_latencies(1, args.requests)))
+        results["ship_loaded"] = process_usage(ship.pid)
+    finally:
+        stop_ship(ship)
+    results["startup"] = startup(args.startup_runs)
+    results["pulse_timing"] = pulse_timing(args.duration, args.pulse_rate)
+    results["toggle_timing"] = toggle_timing(args.duration)
+    return results
+
+
+def run_clients(args):
+    results = {}
+    ship = start_ship(SHIP_DIR, "--async_server")
+    try:
+        for clients in args.clients:
+            results[clients] = summarise(asyncio.run(client_latencies(clients, args.requests)))
+    finally:
+        stop_ship(ship)
+    return results
+
+
+def run_throughput(args):
+    results = {}
+    if args.baseline:
+        with tempfile.TemporaryDirectory() as tmp:
+            ship = start_ship(export_revision(args.baseline, tmp))
+            try:
+                # Revisions before responses were framed send a bare "null" per command.
+                results["baseline"] = {
+                    "commands_per_second": commands_per_second(
+                        args.commands, response_size=args.baseline_response_size
+                    ),
+                    "merged": None,  # Not asked, as older revisions may not have the stats.
+                }
+            finally:
+                stop_ship(ship)
+    for framing in FRAMINGS:
+        ship = start_ship(SHIP_DIR, "--framing", framing)
+        try:
+            results[framing] = {
+                "commands_per_second": commands_per_second(args.commands, framing),
+                "merged": queue_stats(framing)["merged"],
+            }
+        finally:
+            stop_ship(ship)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-o", "--output", help="Also write the results to this file as JSON.")
+    benchmarks = parser.add_subparsers(dest="benchmark", required=True)
+
+    throughput = benchmarks.add_parser("throughput", help="Commands/sec down a single connection.")
+    throughput.add_argument("-n", "--commands", type=int, default=10000, help="Commands to send per run.")
+    throughput.add_argument("-b", "--baseline", help="Git revision whose pi_side to compare against.")
+    throughput.add_argument(
+        "--baseline_response_size",
+        type=int,
+        default=4,
+        help="Bytes the baseline revision replies with per command."
+    )
+
+    clients = benchmarks.add_parser("clients", help="get_state latency with many concurrent clients.")
+    clients.add_argument("-c", "--clients", type=int, nargs="+", default=[1, 10, 100], help="Client counts to try.")
+    clients.add_argument("-r", "--requests", type=int, default=50, help="Requests sent by each client.")
+
+    startup_parser = benchmarks.add_parser("startup", help="Time from launch to accepting and answering.")
+    startup_parser.add_argument("-n", "--runs", type=int, default=10, help="Times to start the ship.")
+    startup_parser.add_argument("-b", "--baseline", help="Git revision whose pi_side to compare against.")
+
+    suite = benchmarks.add_parser("suite", help="Everything, for comparing commits.")
+    suite.add_argument("-n", "--commands", type=int, default=10000, help="Commands to send for commands/sec.")
+    suite.add_argument("-r", "--requests", type=int, default=500, help="get_state requests to time.")
+    suite.add_argument("-d", "--duration", type=float, default=10.0, help="Seconds to time pulses and toggles for.")
+    suite.add_argument("--startup_runs", type=int, default=5, help="Times to start the ship for startup time.")
+    suite.add_argument("--pulse_rate", type=float, default=20.0, help="Pulse brightness updates per second.")
+
+    args = parser.parse_args()
+    if args.benchmark == "throughput":
+        results = run_throughput(args)
+        for name, result in results.items():
+            merged = "" if result["merged"] is None else "  {} of {} merged".format(result["merged"], args.commands)
+            print("{:<10} {:>10.0f} commands/sec{}".format(name, result["commands_per_second"], merged))
+    elif args.benchmark == "clients":
+        results = run_clients(args)
+        print("{:>8} {:>9} {:>9} {:>9} {:>9}".format("clients", "mean ms", "p50 ms", "p99 ms", "max ms"))
+        for count, stats in results.items():
+            print("{:>8} {mean_ms:>9.2f} {p50_ms:>9.2f} {p99_ms:>9.2f} {max_ms:>9.2f}".format(count, **stats))
+    elif args.benchmark == "startup":
+        results = run_startup(args)
+        print("{:>10} {:>10} {:>9} {:>9} {:>9}".format("", "", "mean ms", "p50 ms", "max ms"))
+        for name, stages in results.items():
+            for stage, stats in stages.items():
+                print("{:>10} {:>10} {mean_ms:>9.1f} {p50_ms:>9.1f} {max_ms:>9.1f}".format(name, stage, **stats))
+    else:
+        results = run_suite(args)
+        print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
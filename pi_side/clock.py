@@ -0,0 +1,83 @@
+"""
+A timebase shared between ships, so effects which repeat can be kept in phase across them.
+
+Each ship's ShipClock is its own time.monotonic() plus an offset. Something holding
+connections to every ship (the controller's fleet mode) measures each ship's clock against
+its own, NTP style, over the ship's normal socket:
+
+    t1 = its time on sending "time"
+    t  = the ship's clock, in the reply
+    t4 = its time on receiving the reply
+
+The ship's clock is then ahead by t - (t1 + t4) / 2, to within half the round trip
+(t4 - t1), and "clock adjust" takes that off. Of several samples, the one with the
+shortest round trip is the most accurate. Once every ship has been adjusted to the same
+reference, anything scheduled from the shared clock happens at the same moment on all.
+"""
+from math import isfinite
+from threading import Lock
+from time import monotonic
+
+# Furthest the shared clock may be moved from this ship's own, in seconds: about 34 years,
+# well past any difference in uptimes, while the shared time still keeps its microseconds.
+MAX_OFFSET = 2.0 ** 30
+
+
+class ShipClock:
+    """
+    Converts between the shared time and this process's time.monotonic(). listeners are
+    called with the change in offset whenever it is adjusted.
+    """
+    def __init__(self):
+        self.offset = 0.0
+        self.error = None  # Half the round trip of the sample behind the last adjustment.
+        self.adjusted = None  # time.monotonic() of the last adjustment.
+        self.adjustments = 0
+        self.listeners = []
+        self.__lock = Lock()
+
+    def now(self):
+        return monotonic() + self.offset
+
+    def local(self, shared):
+        """The time.monotonic() time of a shared time."""
+        return shared - self.offset
+
+    def period_start(self, period):
+        """
+        The time.monotonic() time the current period began, periods being counted from 0 on
+        the shared clock, so every ship agrees where each one starts.
+        """
+        shared = self.now()
+        return self.local(shared - shared % period)
+
+    def next_tick(self, interval):
+        """The time.monotonic() time of the next multiple of interval on the shared clock."""
+        shared = self.now()
+        return self.local(shared - shared % interval + interval)
+
+    def adjust(self, delta, error=None):
+        """
+        Moves the shared clock on by delta seconds (back, if negative). Raises ValueError
+        if delta or error isn't finite, or it would move the clock past MAX_OFFSET.
+        """
+        if not isfinite(delta) or (error is not None and not (isfinite(error) and error >= 0)):
+            raise ValueError("Clock adjustments must be finite, and errors not negative.")
+        with self.__lock:
+            if abs(self.offset + delta) > MAX_OFFSET:
+                raise ValueError("Clock offset would be more than {} seconds.".format(MAX_OFFSET))
+            self.offset += delta
+            self.error = error
+            self.adjusted = monotonic()
+            self.adjustments += 1
+        for listener in self.listeners:
+            listener(delta)
+
+    def status(self):
+        return {
+            "time": self.now(),
+            "offset": self.offset,
+            "error_ms": None if self.error is None else 1000 * self.error,
+            "adjusted_ago": None if self.adjusted is None else monotonic() - self.adjusted,
+            "adjustments": self.adjustments,
+        }
@@ -0,0 +1,128 @@
+"""
+The one queue every client's commands pass through on their way to the lights, run in
+arrival order by a single worker thread, so only one command ever changes the ship at once.
+
+Commands which simply set part of the ship (cabins on, nacelles mode static, ...) say which
+parts, their merge slots, in the command table. While one is still waiting, a later command
+setting all of the same parts replaces it, so a client toggling a switch faster than the
+ship keeps up sends only where it ended up to the lights: "cabins on", "cabins off",
+"cabins on" runs once. A merged command's reply is the reply of the one which replaced it.
+Anything else, queries included, is run exactly as sent, and nothing merges across it.
+
+At most max_depth commands wait at once. Past that, commands are answered straight away
+with a busy reply, rather than queued, and the client should send them again later.
+
+Anything else which changes the ship from another thread, such as a scene's fade steps
+from the scheduler, goes through call, so it too runs on the worker, in turn.
+"""
+from concurrent.futures import Future
+from functools import partial
+from threading import Condition, Thread
+
+MAX_DEPTH = 64
+
+
+class QueuedCommand:
+    __slots__ = ("command", "session", "merges", "futures", "function")
+
+    def __init__(self, command, session, merges, future, function=None):
+        self.command = command
+        self.session = session
+        self.merges = merges
+        self.futures = [future]
+        self.function = function  # Run instead of processing command, for call.
+
+
+class CommandQueue:
+    def __init__(self, process, max_depth=MAX_DEPTH):
+        """process(command, session) runs a command and returns its reply, as process_command does."""
+        self.process = process
+        self.max_depth = max_depth
+        self.submitted = 0
+        self.merged = 0
+        self.rejected = 0
+        self.deepest = 0
+        self.__queue = []
+        self.__condition = Condition()
+        self.__thread = Thread(target=self.__run, name="command-queue")
+        self.__thread.daemon = True
+
+    def start(self):
+        self.__thread.start()
+
+    def submit(self, command, session=None, merges=None):
+        """
+        Queues a command, returning a concurrent.futures.Future of its reply. merges is the
+        frozenset of its merge slots, or None if it mustn't be merged.
+        """
+        future = Future()
+        with self.__condition:
+            self.submitted += 1
+            replaced = []
+            if merges is not None:
+                for queued in reversed(self.__queue):
+                    if queued.merges is None:
+                        break
+                    if queued.merges <= merges:
+                        replaced.append(queued)
+            depth = len(self.__queue) - len(replaced)
+            if depth >= self.max_depth:
+                self.rejected += 1
+                future.set_result(self.busy_reply(command, depth))
+                return future
+            entry = QueuedCommand(command, session, merges, future)
+            for queued in replaced:
+                self.__queue.remove(queued)
+                entry.futures.extend(queued.futures)
+            self.merged += len(replaced)
+            self.__queue.append(entry)
+            self.deepest = max(self.deepest, len(self.__queue))
+            self.__condition.notify()
+        return future
+
+    def call(self, function, *args):
+        """
+        Queues function(*args) to run on the worker, returning a Future of its result. It is
+        never refused as too deep, and nothing merges across it.
+        """
+        future = Future()
+        with self.__condition:
+            self.__queue.append(QueuedCommand(None, None, None, future, partial(function, *args)))
+            self.deepest = max(self.deepest, len(self.__queue))
+            self.__condition.notify()
+        return future
+
+    @staticmethod
+    def busy_reply(command, depth):
+        reply = {"error": "Busy.", "queued": depth}
+        if type(command) is dict and "id" in command:
+            return {"id": command["id"], "result": reply}
+        return reply
+
+    def stats(self):
+        with self.__condition:
+            return {
+                "depth": len(self.__queue),
+                "deepest": self.deepest,
+                "submitted": self.submitted,
+                "merged": self.merged,
+                "rejected": self.rejected,
+            }
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while not self.__queue:
+                    self.__condition.wait()
+                entry = self.__queue.pop(0)
+            try:
+                if entry.function is not None:
+                    reply = entry.function()
+                else:
+                    reply = self.process(entry.command, entry.session)
+            except Exception as e:
+                for future in entry.futures:
+                    future.set_exception(e)
+            else:
+                for future in entry.futures:
+                    future.set_result(reply)
@@ -0,0 +1,95 @@
+from threading import Condition, Thread
+from time import monotonic, sleep
+
+ROW_ADDRESSES = (0x80, 0xC0, 0x94, 0xD4)  # Set DDRAM address commands for the start of each row.
+CHARACTER_MODE = 0b00000001
+
+
+class DisplayManager:
+    """
+    Drives a 20x4 HD44780 LCD from a background worker.
+
+    invalidate() only marks the screen as out of date, so it is safe to call from
+    anywhere, as often as wanted. The worker then calls render() for the new lines at
+    most max_rate times a second, and compares them to a shadow copy of what the
+    display shows, moving the cursor to and writing only the characters which differ.
+
+    lcd is an RPi_GPIO_i2c_LCD.i2c_HD44780.lcd, used directly rather than through
+    lcd.HD44780, as that rewrites every line over I2C in a loop for as long as it runs.
+    """
+    def __init__(self, lcd, render, rows=4, columns=20, max_rate=10.0):
+        self.lcd = lcd
+        self.render = render
+        self.rows = rows
+        self.columns = columns
+        self.interval = 1 / max_rate
+        self.__shown = [" " * columns for _ in range(rows)]
+        self.__dirty = True
+        self.__running = True
+        self.__condition = Condition()
+        self.writes = 0
+        self.write_time = 0.0
+        self.lcd.backlight("on")
+        self.lcd.clear()
+        self.__thread = Thread(target=self.__run, name="display")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def invalidate(self):
+        with self.__condition:
+            self.__dirty = True
+            self.__condition.notify()
+
+    def close(self):
+        """Stops the worker, then clears the display and turns the backlight off."""
+        with self.__condition:
+            self.__running = False
+            self.__condition.notify()
+        self.__thread.join()
+        self.lcd.backlight("off")
+        self.lcd.clear()
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while self.__running and not self.__dirty:
+                    self.__condition.wait()
+                if not self.__running:
+                    return
+                self.__dirty = False
+            started = monotonic()
+            try:
+                self.__update([line.ljust(self.columns)[:self.columns] for line in self.render()])
+            except Exception as e:
+                print(f"<System> Display update failed: {e!r}")
+            self.write_time += monotonic() - started
+            sleep(max(0.0, started + self.interval - monotonic()))
+
+    def __update(self, lines):
+        for row, (line, shown) in enumerate(zip(lines, self.__shown)):
+            for start, end in self.__changed_runs(line, shown):
+                self.lcd.write(ROW_ADDRESSES[row] + start)
+                for character in line[start:end]:
+                    self.lcd.write(ord(character), CHARACTER_MODE)
+                self.writes += 1
+            self.__shown[row] = line
+
+    @staticmethod
+    def __changed_runs(line, shown):
+        """
+        Yields (start, end) of each run of changed characters. Runs one unchanged character
+        apart are merged, as rewriting that character costs the same as moving the cursor.
+        """
+        start = None
+        end = None
+        for i, (new, old) in enumerate(zip(line, shown)):
+            if new == old:
+                continue
+            if start is None:
+                start = i
+            elif i - end > 1:
+                yield start, end
+                start = i
+            end = i + 1
+        if start is not None:
+            yield start, end
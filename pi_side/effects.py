@@ -0,0 +1,396 @@
+"""
+Light effects built as streams of per-tick values, composed and played together.
+
+An effect is made for a number of lights and a tick rate, and is then an iterator giving,
+once per tick, a tuple of one level in [0, 1] for each of the lights. Nothing is computed
+until it is asked for, not even a whole period ahead, so however long an effect's period
+its stream costs the same, and effects chain freely:
+
+    strobe(0.1, 2).delay(0.1)
+    mix(twinkle(40), breathe(1, 1), 0.3)
+    chase(2).gate(strobe(0.5, 0.5))
+
+The EffectEngine plays every bound effect from one repeating scheduler call, advancing
+each by however many ticks are due since it started, so effects cost no threads, keep
+their phase however late a tick runs, and all write into the same frame buffer flush.
+
+Effects can also be described in JSON (see build): "twinkle", or
+{"effect": "delay", "source": {"effect": "strobe", "on": 0.1, "off": 2}, "seconds": 0.1}.
+"""
+from collections import deque
+from functools import wraps
+from itertools import count, repeat
+from math import floor, isfinite
+from random import Random
+from threading import Lock
+from time import monotonic
+
+from waveforms import resolve_shape, SHAPES
+
+EFFECTS = {}  # Name -> function making the effect, for build().
+SOURCE_PARAMS = ("source", "a", "b", "control")  # Parameters which take another effect.
+ENGINE_RATE = 20.0  # Ticks per second, so the blinkers' 0.1 second flashes are two ticks.
+MAX_SECONDS = 3600.0  # Longest any time in an effect may be, as delay keeps that long of its source.
+
+
+class Effect:
+    """An effect not yet bound to any lights. Calling it with (width, rate) starts a stream."""
+    def __init__(self, stream, name):
+        self.stream = stream
+        self.name = name
+
+    def __call__(self, width, rate):
+        return self.stream(width, rate)
+
+    def __repr__(self):
+        return "<Effect {}>".format(self.name)
+
+    def mix(self, other, amount=0.5):
+        return mix(self, other, amount)
+
+    def scale(self, factor=1.0, offset=0.0):
+        return scale(self, factor, offset)
+
+    def delay(self, seconds=0.0, stagger=0.0):
+        return delay(self, seconds, stagger)
+
+    def gate(self, control, threshold=0.5):
+        return gate(self, control, threshold)
+
+
+def number(name, value, lowest=None, highest=None, above=None):
+    if type(value) not in (int, float) or not isfinite(value):
+        raise ValueError("{} must be a number, not {!r}.".format(name, value))
+    if (lowest is not None and value < lowest) or (highest is not None and value > highest) or (
+            above is not None and value <= above):
+        raise ValueError("{} is out of range: {!r}.".format(name, value))
+
+
+def check_seed(name, value):
+    if value is not None and (type(value) not in (int, float) or value != int(value)):
+        raise ValueError("{} must be a whole number, not {!r}.".format(name, value))
+
+
+def check_shape(name, value):
+    if isinstance(value, str):
+        if value not in SHAPES:
+            raise ValueError("Unknown shape {!r}.".format(value))
+    elif not callable(value):
+        if not isinstance(value, (list, tuple)) or len(value) < 2:
+            raise ValueError("{} must be a shape's name, or a list of at least 2 levels.".format(name))
+        for level in value:
+            number(name, level, 0, 1)
+
+
+def check_source(name, value):
+    if not isinstance(value, Effect):
+        raise ValueError("{} must be an effect, not {!r}.".format(name, value))
+
+
+# How each parameter of the effects below is checked, by its name, when an effect is made.
+PARAM_CHECKS = {
+    "interval": lambda name, value: number(name, value, highest=MAX_SECONDS, above=0),
+    "period": lambda name, value: number(name, value, highest=MAX_SECONDS, above=0),
+    "fade_in": lambda name, value: number(name, value, highest=MAX_SECONDS, above=0),
+    "fade_out": lambda name, value: number(name, value, highest=MAX_SECONDS, above=0),
+    "on": lambda name, value: number(name, value, highest=MAX_SECONDS, above=0),
+    "off": lambda name, value: number(name, value, highest=MAX_SECONDS, above=0),
+    "seconds": lambda name, value: number(name, value, 0, MAX_SECONDS),
+    "stagger": lambda name, value: number(name, value, 0, MAX_SECONDS),
+    "lit": lambda name, value: number(name, value, 0),
+    "lower": lambda name, value: number(name, value, 0, 1),
+    "upper": lambda name, value: number(name, value, 0, 1),
+    "level": lambda name, value: number(name, value, 0, 1),
+    "amount": lambda name, value: number(name, value, 0, 1),
+    "smoothing": lambda name, value: number(name, value, 0, 1),
+    "threshold": number,
+    "factor": number,
+    "offset": number,
+    "seed": check_seed,
+    "shape": check_shape,
+}
+PARAM_CHECKS.update((name, check_source) for name in SOURCE_PARAMS)
+
+
+def effect(generator):
+    """
+    Registers generator(width, rate, *params) as an effect, returning a function which takes
+    just the params and gives an Effect. Bad params raise there and then, rather than once
+    the effect is bound: TypeError for ones it doesn't take, and ValueError for values which
+    fail their PARAM_CHECKS.
+    """
+    @wraps(generator)
+    def make(*args, **kwargs):
+        from inspect import signature  # Slow to import, and not needed until an effect is made.
+        params = signature(generator).bind(0, 0, *args, **kwargs).arguments
+        for name, value in params.items():
+            if name in PARAM_CHECKS:
+                PARAM_CHECKS[name](name, value)
+        return Effect(lambda width, rate: generator(width, rate, *args, **kwargs), generator.__name__)
+    EFFECTS[generator.__name__] = make
+    return make
+
+
+def ticks(seconds, rate):
+    return max(1, round(seconds * rate))
+
+
+@effect
+def twinkle(width, rate, interval=40.0, seed=None):
+    """
+    Each light toggles at random, on average every interval seconds. 16 lights with the
+    default interval toggle one every 2.5 seconds between them, like the random cabins.
+    """
+    random = Random(None if seed is None else int(seed))
+    chance = 1 / (interval * rate)
+    levels = [float(random.random() < 0.5) for _ in range(width)]
+    while True:
+        for i in range(width):
+            if random.random() < chance:
+                levels[i] = 1.0 - levels[i]
+        yield tuple(levels)
+
+
+@effect
+def chase(width, rate, period=2.0, lit=1):
+    """lit lights in a row run along the lights, all the way along once every period seconds."""
+    steps = ticks(period, rate)
+    return (
+        tuple(float((i - step % steps * width // steps) % width < lit) for i in range(width))
+        for step in count()
+    )
+
+
+@effect
+def breathe(width, rate, fade_in=1.0, fade_out=1.0, lower=0.0, upper=1.0, shape="sine"):
+    """
+    Every light fades up and down together, along a waveforms shape. Each level is worked
+    out as it's needed rather than looked up in a waveform's table, as fade times come from
+    clients, and a long enough one would make a table too big to keep.
+    """
+    curve = resolve_shape(tuple(shape) if isinstance(shape, list) else shape)
+    rise = ticks(fade_in, rate)
+    fall = ticks(fade_out, rate)
+    difference = upper - lower
+
+    def level(step):
+        x = step / rise if step < rise else 1 - (step - rise) / fall
+        return lower + difference * curve(x)
+    return ((level(step % (rise + fall)),) * width for step in count())
+
+
+@effect
+def strobe(width, rate, on=0.1, off=0.9):
+    """Every light on for on seconds, then off for off seconds, starting on."""
+    on_ticks = ticks(on, rate)
+    period = on_ticks + ticks(off, rate)
+    lit, unlit = (1.0,) * width, (0.0,) * width
+    return (lit if step % period < on_ticks else unlit for step in count())
+
+
+@effect
+def noise(width, rate, lower=0.0, upper=1.0, smoothing=0.8, seed=None):
+    """Each light flickers at random between lower and upper, smoothing being how slowly it wanders."""
+    random = Random(None if seed is None else int(seed))
+    levels = [random.random() for _ in range(width)]
+    while True:
+        for i in range(width):
+            levels[i] = levels[i] * smoothing + random.random() * (1 - smoothing)
+        yield tuple(lower + (upper - lower) * level for level in levels)
+
+
+@effect
+def solid(width, rate, level=1.0):
+    return repeat((float(level),) * width)
+
+
+@effect
+def mix(width, rate, a, b, amount=0.5):
+    """amount of b blended with the rest of a."""
+    for x, y in zip(a(width, rate), b(width, rate)):
+        yield tuple(p + (q - p) * amount for p, q in zip(x, y))
+
+
+@effect
+def scale(width, rate, source, factor=1.0, offset=0.0):
+    """Each level times factor, plus offset, kept within [0, 1]."""
+    for levels in source(width, rate):
+        yield tuple(min(1.0, max(0.0, level * factor + offset)) for level in levels)
+
+
+@effect
+def delay(width, rate, source, seconds=0.0, stagger=0.0):
+    """
+    Holds the lights off for seconds, then plays the source that far behind. Each light
+    after the first is held back stagger seconds more than the one before.
+    """
+    lags = [round((seconds + i * stagger) * rate) for i in range(width)]
+    history = deque([(0.0,) * width] * max(lags, default=0), maxlen=max(lags, default=0) + 1)
+    for levels in source(width, rate):
+        history.append(levels)
+        yield tuple(history[-1 - lag][i] for i, lag in enumerate(lags))
+
+
+@effect
+def gate(width, rate, source, control, threshold=0.5):
+    """The source where control is at least threshold, and off elsewhere."""
+    for levels, controls in zip(source(width, rate), control(width, rate)):
+        yield tuple(level if c >= threshold else 0.0 for level, c in zip(levels, controls))
+
+
+def build(spec):
+    """
+    Makes an Effect from a JSON description: an effect's name, or a dict of its "effect"
+    name and its parameters, where the source, a, b and control parameters are themselves
+    descriptions. Raises ValueError if it isn't a valid description.
+    """
+    if isinstance(spec, Effect):
+        return spec
+    if isinstance(spec, str):
+        spec = {"effect": spec}
+    if not isinstance(spec, dict) or spec.get("effect") not in EFFECTS:
+        raise ValueError("Unknown effect {!r}.".format(spec))
+    params = {key: value for key, value in spec.items() if key != "effect"}
+    for key in SOURCE_PARAMS:
+        if key in params:
+            params[key] = build(params[key])
+    try:
+        return EFFECTS[spec["effect"]](**params)
+    except TypeError as e:
+        raise ValueError("Bad parameters for {}: {}".format(spec["effect"], e))
+
+
+class Binding:
+    __slots__ = ("devices", "dimmable", "stream", "epoch", "tick", "values", "notify", "cancelled")
+
+    def __init__(self, devices, dimmable, stream, epoch, notify):
+        self.devices = devices
+        self.dimmable = dimmable
+        self.stream = stream
+        self.epoch = epoch
+        self.tick = -1
+        self.values = (None,) * len(devices)  # What was last written to each device.
+        self.notify = notify
+        self.cancelled = False
+
+
+class EffectEngine:
+    """
+    Plays effects on lights: every binding is advanced together, once per tick of one
+    repeating scheduler call, which only runs while something is bound. Each light is
+    driven by at most one binding; binding an effect to a light takes it from any other.
+
+    Levels are written into the frame buffer, rounded to on or off for lights which can't
+    dim. When a tick changes the lights of a binding made with notify, on_change is called.
+
+    Given a clock.ShipClock, ticks fall on whole multiples of the tick interval of the shared
+    time, so ships whose clocks agree tick together. realign() must be called if it's adjusted.
+    """
+    def __init__(self, scheduler, frame, rate=ENGINE_RATE, on_change=None, clock=None):
+        self.scheduler = scheduler
+        self.frame = frame
+        self.rate = rate
+        self.on_change = on_change
+        self.clock = clock
+        self.ticks = 0
+        self.__bindings = []
+        self.__call = None
+        self.__lock = Lock()  # Held while the bindings are changed or played.
+
+    def bind(self, devices, effect, epoch=None, notify=True):
+        """
+        Starts playing effect on devices, its first tick at epoch (a time.monotonic(),
+        default now), and returns the Binding, for unbind.
+        """
+        from gpiozero import PWMOutputDevice
+        devices = tuple(devices)
+        binding = Binding(
+            devices,
+            tuple(isinstance(device, PWMOutputDevice) for device in devices),
+            effect(len(devices), self.rate),
+            monotonic() if epoch is None else epoch,
+            notify
+        )
+        with self.__lock:
+            self.__release(devices)
+            self.__play(binding, monotonic())  # Raises before anything is bound, if the effect can't start.
+            if not binding.cancelled:
+                self.__bindings.append(binding)
+                if self.__call is None:
+                    self.__start()
+        return binding
+
+    def realign(self):
+        """Moves the ticks back onto the shared clock's, after it has been adjusted."""
+        with self.__lock:
+            if self.__call is not None:
+                self.__call.cancel()
+                self.__start()
+
+    def __start(self):
+        interval = 1 / self.rate
+        start = None if self.clock is None else self.clock.next_tick(interval)
+        self.__call = self.scheduler.call_every(interval, self.__tick, start=start)
+
+    def unbind(self, binding):
+        """Stops the binding, leaving its lights as they are."""
+        with self.__lock:
+            self.__remove(binding)
+
+    def release(self, devices):
+        """Stops any bindings driving any of devices, leaving their lights as they are."""
+        with self.__lock:
+            self.__release(devices)
+
+    def bound(self, devices):
+        """Whether any of devices are driven by a binding."""
+        devices = set(devices)
+        with self.__lock:
+            return any(devices.intersection(binding.devices) for binding in self.__bindings)
+
+    def __release(self, devices):
+        devices = set(devices)
+        for binding in [binding for binding in self.__bindings if devices.intersection(binding.devices)]:
+            self.__remove(binding)
+
+    def __remove(self, binding):
+        binding.cancelled = True
+        if binding in self.__bindings:
+            self.__bindings.remove(binding)
+        if not self.__bindings and self.__call is not None:
+            self.__call.cancel()
+            self.__call = None
+
+    def __play(self, binding, now):
+        """Advances the binding to the tick due at now, writing its levels. Returns whether they changed."""
+        # The nearest tick rather than the last one started, so a tick running a moment early
+        # for a binding whose epoch doesn't line up with the engine's own doesn't lose a whole tick.
+        due = floor((now - binding.epoch) * self.rate + 0.5)
+        if due <= binding.tick:
+            return False
+        try:
+            for _ in range(due - binding.tick):
+                levels = next(binding.stream)
+        except StopIteration:
+            self.__remove(binding)
+            return False
+        binding.tick = due
+        values = tuple(level if dimmable else int(level >= 0.5) for level, dimmable in zip(levels, binding.dimmable))
+        if values == binding.values:
+            return False
+        for device, value, before in zip(binding.devices, values, binding.values):
+            if value != before:
+                self.frame.set(device, value)
+        binding.values = values
+        return True
+
+    def __tick(self):
+        now = monotonic()
+        notify = False
+        with self.__lock:
+            self.ticks += 1
+            for binding in list(self.__bindings):
+                if self.__play(binding, now) and binding.notify:
+                    notify = True
+        if notify and self.on_change is not None:
+            self.on_change()
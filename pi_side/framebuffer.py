@@ -0,0 +1,138 @@
+from threading import Lock
+
+from gpiozero import PWMOutputDevice
+
+
+def gpio_number(pin):
+    """The BCM GPIO number of a gpiozero pin."""
+    info = getattr(pin, "info", None)
+    if info is None:
+        return pin.number  # gpiozero 1.x, where pin.number is still the GPIO number.
+    return int(info.name[len("GPIO"):])
+
+
+class FrameBuffer:
+    """
+    Collects the values the lights should change to, then writes them out together.
+
+    Writing into the buffer doesn't touch the hardware. flush() writes every pending
+    change in one go, skipping any which match what the pin already shows, so a scene
+    change appears at once rather than light by light.
+
+    Where the pin factory is pigpio, the on/off lights are written with one set and one
+    clear of the GPIO bank register. Otherwise (including gpiozero's MockFactory) each
+    changed device is written in turn.
+
+    Each device's value is read from its pin only the first time it's needed; after that,
+    the buffer remembers what it last wrote, as reading a pin through pigpio is a round trip
+    to pigpiod. So every change to the lights must go through the buffer.
+
+    version counts the flushes which changed any of the watched devices, so whoever
+    watches them can tell if they've changed without reading them all.
+    """
+    def __init__(self):
+        self.__pending = {}  # device -> value
+        self.__written = {}  # device -> the value it was last known to have
+        self.__bits = {}  # device -> its bit in the bank registers
+        self.__watched = frozenset()
+        self.version = 0
+        self.__lock = Lock()
+        self.__bank = None
+        self.__bank_checked = False
+        self.flushes = 0
+        self.writes = 0
+
+    def watch(self, devices):
+        """Sets the devices whose changes bump version."""
+        self.__watched = frozenset(devices)
+
+    def set(self, device, value):
+        with self.__lock:
+            self.__pending[device] = value
+
+    def on(self, device):
+        self.set(device, 1)
+
+    def off(self, device):
+        self.set(device, 0)
+
+    def toggle(self, device):
+        with self.__lock:
+            self.__pending[device] = 0 if self.__value(device) else 1
+
+    def value(self, device):
+        """The value the device will have after the next flush."""
+        with self.__lock:
+            return self.__value(device)
+
+    def written(self, devices):
+        """The values the devices were last flushed with, ignoring anything still pending."""
+        with self.__lock:
+            return [self.__current(device) for device in devices]
+
+    def __value(self, device):
+        if device in self.__pending:
+            return self.__pending[device]
+        return self.__current(device)
+
+    def __current(self, device):
+        value = self.__written.get(device)
+        if value is None:
+            value = self.__written[device] = device.value
+        return value
+
+    def flush(self):
+        """Writes all pending changes to the pins, returning how many devices changed."""
+        with self.__lock:
+            if not self.__pending:
+                return 0
+            pending = self.__pending
+            self.__pending = {}
+            changes = [(device, value) for device, value in pending.items() if self.__current(device) != value]
+            if not self.__bank_checked and changes:
+                self.__bank = self.__find_bank(changes[0][0].pin_factory)
+                self.__bank_checked = True
+            written = len(changes)
+            watched = False
+            for device, value in changes:
+                self.__written[device] = value
+                watched = watched or device in self.__watched
+            if watched:
+                self.version += 1
+            if self.__bank is not None:
+                changes = self.__write_bank(changes)
+            for device, value in changes:
+                device.value = value
+            self.flushes += 1
+            self.writes += written
+            return written
+
+    @staticmethod
+    def __find_bank(pin_factory):
+        """Returns the pigpio connection behind the pin factory, if that's what it is."""
+        connection = getattr(pin_factory, "connection", None)
+        if hasattr(connection, "set_bank_1") and hasattr(connection, "clear_bank_1"):
+            return connection
+        return None
+
+    def __write_bank(self, changes):
+        """Writes the plain on/off devices through the bank registers, returning the rest."""
+        set_mask = 0
+        clear_mask = 0
+        remaining = []
+        for device, value in changes:
+            if isinstance(device, PWMOutputDevice):
+                remaining.append((device, value))
+                continue
+            bit = self.__bits.get(device)
+            if bit is None:
+                bit = self.__bits[device] = 1 << gpio_number(device.pin)
+            if bool(value) == device.active_high:
+                set_mask |= bit
+            else:
+                clear_mask |= bit
+        if set_mask:
+            self.__bank.set_bank_1(set_mask)
+        if clear_mask:
+            self.__bank.clear_bank_1(clear_mask)
+        return remaining
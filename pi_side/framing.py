@@ -0,0 +1,109 @@
+import struct
+
+LINE = "line"
+LENGTH_PREFIXED = "length"
+FRAMINGS = (LINE, LENGTH_PREFIXED)
+
+LENGTH_HEADER = struct.Struct("!I")
+
+
+def frame(payload, framing=LINE):
+    """
+    Wraps an encoded message ready to be sent with the given framing.
+    :type payload: bytes
+    :type framing: str
+    """
+    if framing == LENGTH_PREFIXED:
+        return LENGTH_HEADER.pack(len(payload)) + payload
+    return payload + b"\n"
+
+
+class CommandReader:
+    """
+    Reads framed messages from a socket into a single reusable buffer.
+
+    Each call to fill() is one recv_into syscall, which may pull in any number of
+    complete messages. These are then sliced out of the buffer by messages() without
+    copying the buffer itself.
+    """
+    def __init__(self, sock, framing=LINE, buffer_size=4096, max_message_size=65536):
+        assert framing in FRAMINGS
+        self.sock = sock
+        self.framing = framing
+        self.max_message_size = max_message_size
+        self.__buffer = bytearray(buffer_size)
+        self.__view = memoryview(self.__buffer)
+        self.__start = 0  # First byte not yet consumed.
+        self.__end = 0  # One past the last byte received.
+        self.__scanned = 0  # Bytes before this offset are known not to hold a newline.
+
+    def fill(self):
+        """
+        Receives whatever is available on the socket. Returns the number of bytes read,
+        which is 0 once the peer has closed the connection.
+        """
+        if self.__start == self.__end:
+            self.__start = self.__end = self.__scanned = 0
+        elif self.__end == len(self.__buffer):
+            self.__make_room()
+        read = self.sock.recv_into(self.__view[self.__end:])
+        self.__end += read
+        return read
+
+    def messages(self):
+        """
+        Yields every complete message currently buffered, decoded to str. The framing is
+        checked before each message, so it may be changed part way through.
+        """
+        while True:
+            if self.framing == LENGTH_PREFIXED:
+                message = self.__next_length_prefixed()
+            else:
+                message = self.__next_line()
+            if message is None:
+                return
+            yield message
+
+    def __next_line(self):
+        newline = self.__buffer.find(b"\n", max(self.__start, self.__scanned), self.__end)
+        if newline == -1:
+            self.__scanned = self.__end
+            if self.__end - self.__start > self.max_message_size:
+                raise ValueError("Message exceeds {} bytes.".format(self.max_message_size))
+            return None
+        start = self.__start
+        self.__start = newline + 1
+        return str(self.__view[start:newline], "utf-8")
+
+    def __next_length_prefixed(self):
+        header_size = LENGTH_HEADER.size
+        if self.__end - self.__start < header_size:
+            return None
+        (length,) = LENGTH_HEADER.unpack_from(self.__buffer, self.__start)
+        if length > self.max_message_size:
+            raise ValueError("Message of {} bytes exceeds {} bytes.".format(length, self.max_message_size))
+        start = self.__start + header_size
+        if self.__end - start < length:
+            self.__reserve(header_size + length)
+            return None
+        self.__start = start + length
+        return str(self.__view[start:self.__start], "utf-8")
+
+    def __make_room(self):
+        """Moves a partial message to the front of the buffer, growing it if it is already there."""
+        pending = self.__end - self.__start
+        if self.__start:
+            self.__buffer[:pending] = self.__buffer[self.__start:self.__end]
+            self.__scanned = max(0, self.__scanned - self.__start)
+            self.__start, self.__end = 0, pending
+        else:
+            self.__reserve(len(self.__buffer) * 2)
+
+    def __reserve(self, size):
+        """Ensures a single message of the given size can fit in the buffer."""
+        if size <= len(self.__buffer):
+            return
+        size = min(max(size, len(self.__buffer) * 2), self.max_message_size + LENGTH_HEADER.size)
+        self.__view.release()
+        self.__buffer.extend(bytes(size - len(self.__buffer)))
+        self.__view = memoryview(self.__buffer)
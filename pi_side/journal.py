@@ -0,0 +1,200 @@
+"""
+Keeps the ship's state on disk so it comes back as it was after a restart or reboot, and
+keeps a short history of recent commands in memory for debugging.
+
+The journal is an append-only file of records, each
+
+    length  I   of the JSON which follows
+    crc     I   zlib.crc32 of that JSON
+    JSON        the settings: as a scene (see scenes.py), so it can be applied like one
+
+A record is only written when a setting worth restoring changes: not as the random cabins
+toggle, only once they're held static. The ship only says that something changed; the
+settings are read from it once changes have been coalesced for min_interval seconds, so
+a burst of commands costs one write, and once the file passes max_size it is replaced by
+a file holding just the latest record. A record cut short by power loss fails its length
+or CRC check, and is dropped on loading, so the one before it is restored instead.
+"""
+import json
+import os
+import struct
+import zlib
+from collections import deque
+from threading import Condition, Lock, Thread
+from time import monotonic, sleep, time
+
+RECORD_HEADER = struct.Struct("!II")
+JOURNAL_FILE = "state.journal"
+SETTINGS = ("cabins", "cabins_mode", "nacelles", "nacelles_mode", "blinkers")
+
+
+def settings_of(state, cabin_lights=True):
+    """
+    The parts of a get_state dict worth restoring, in the form of a scene's settings.
+    Which cabin lights are lit is only kept while they're static, and cabin_lights is True.
+    """
+    settings = {key: state[key] for key in SETTINGS}
+    if cabin_lights and state["cabins_mode"] == "static":
+        settings["cabin_lights"] = state["cabin_lights"]
+    return settings
+
+
+class StateJournal:
+    def __init__(self, path, min_interval=1.0, max_size=65536):
+        self.path = path
+        self.min_interval = min_interval
+        self.max_size = max_size
+        self.writes = 0
+        self.compactions = 0
+        self.source = None
+        self.__last = None  # Settings of the last record written.
+        self.__dirty = False
+        self.__closed = False
+        self.__condition = Condition()
+        self.__write_lock = Lock()  # Held while writing, so records can't be written out of order.
+        self.__thread = None
+
+    def load(self):
+        """
+        Returns the settings in the last intact record, or None if there are none. Anything
+        after it, such as a record torn by power loss, is cut off so appending carries on cleanly.
+        """
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        settings = None
+        offset = end = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            length, crc = RECORD_HEADER.unpack_from(data, offset)
+            body = data[offset + RECORD_HEADER.size:offset + RECORD_HEADER.size + length]
+            if len(body) != length or zlib.crc32(body) != crc:
+                break
+            try:
+                settings = json.loads(body)
+            except ValueError:
+                break
+            offset = end = offset + RECORD_HEADER.size + length
+        if end < len(data):
+            print("<System> Dropping {} damaged bytes from the end of {}.".format(len(data) - end, self.path))
+            with open(self.path, "r+b") as f:
+                f.truncate(end)
+        self.__last = settings
+        return settings
+
+    def start(self, source):
+        """
+        Starts writing in the background. source() returns the settings to keep (see
+        settings_of), and is called from the journal's thread once changes have settled.
+        """
+        self.source = source
+        self.__thread = Thread(target=self.__run, name="journal")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def changed(self):
+        """Notes that the settings may have changed. Cheap enough to call on every change."""
+        with self.__condition:
+            if not self.__dirty and not self.__closed:
+                self.__dirty = True
+                self.__condition.notify()
+
+    def flush(self):
+        """Writes a record now if the settings have changed, such as before shutting down."""
+        with self.__write_lock:
+            with self.__condition:
+                self.__dirty = False
+            settings = self.source()
+            if settings == self.__last:
+                return
+            self.__last = settings
+            body = json.dumps(settings, separators=(",", ":")).encode()
+            self.__write(RECORD_HEADER.pack(len(body), zlib.crc32(body)) + body)
+
+    def close(self):
+        """Writes any change now, and ignores any after, such as the lights going out as the ship stops."""
+        with self.__condition:
+            self.__closed = True
+        if self.source is not None:
+            self.flush()
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                while not self.__dirty:
+                    self.__condition.wait()
+            sleep(self.min_interval)  # Let a burst of changes settle into one write.
+            with self.__condition:
+                if self.__closed:
+                    return
+            self.flush()
+
+    def __write(self, record):
+        try:
+            if os.path.exists(self.path) and os.path.getsize(self.path) + len(record) > self.max_size:
+                self.__compact(record)
+                return
+            with open(self.path, "ab") as f:
+                f.write(record)
+                f.flush()
+                os.fsync(f.fileno())
+            self.writes += 1
+        except OSError as e:
+            print("<System> Could not write state journal: {}".format(e))
+
+    def __compact(self, record):
+        """Replaces the journal with one holding just record, atomically."""
+        temporary = self.path + ".tmp"
+        with open(temporary, "wb") as f:
+            f.write(record)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+        directory = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+        self.writes += 1
+        self.compactions += 1
+
+
+class CommandHistory:
+    """
+    The last few commands the ship was sent, with when, in ring buffers: one for those which
+    change the ship, and a shorter one for everything else (queries, acks, subscriptions, and
+    unknown commands), so a client polling or acking can't push the changes out.
+    """
+    def __init__(self, length=256, queries=32):
+        self.entries = deque(maxlen=length)  # (time.time(), time.monotonic(), command, changed state)
+        self.queries = deque(maxlen=queries)  # The same, for commands which didn't change it.
+        self.total = 0
+        self.paused = False  # While True, commands aren't added, such as those being replayed.
+
+    def add(self, command, changes_state):
+        if self.paused:
+            return
+        (self.entries if changes_state else self.queries).append((time(), monotonic(), command, changes_state))
+        self.total += 1
+
+    def recent(self, count=None, queries=False):
+        """The last count commands which changed the ship, or with queries, of those which didn't."""
+        entries = list(self.queries if queries else self.entries)
+        if count is not None:
+            entries = entries[-count:] if count > 0 else []
+        return entries
+
+    def snapshot(self, count=None):
+        now = monotonic()
+
+        def described(entries):
+            return [
+                {"time": wall_time, "ago": now - at, "command": command, "changes_state": changes_state}
+                for wall_time, at, command, changes_state in entries
+            ]
+        return {
+            "total": self.total,
+            "commands": described(self.recent(count)),
+            "queries": described(self.recent(count, queries=True)),
+        }
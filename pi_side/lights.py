@@ -0,0 +1,173 @@
+"""
+The ship's light groups which do more than switch on and off: cabins which toggle at
+random, and nacelles which pulse. Both write through a FrameBuffer from the scheduler.
+
+Kept apart from pi_side so that gpiozero, which is slow to import on a Pi, is only
+loaded once the ship has started listening.
+"""
+from random import randint
+from threading import RLock
+from time import monotonic, sleep
+
+from gpiozero import PWMLED
+
+from waveforms import waveform
+
+
+class DynamicLights:
+    def __init__(self, lights, mode="random", parent=None, scheduler=None, frame=None):
+        self.parent = parent
+        self.lights = lights
+        self.scheduler = scheduler
+        self.frame = frame
+        self.is_active = False
+        self.__mode = ""
+        self.__toggle_call = None
+        self.__lock = RLock()  # Held while the toggle call is changed, so only one is ever scheduled.
+        if mode == "random":
+            self.set_random()
+        else:
+            self.set_static()
+
+    @property
+    def is_lit(self):
+        return self.is_active
+
+    def on(self):
+        self.is_active = True
+        for led in self.lights:
+            if self.__mode == "static" or randint(0, 1):  # Turn on all lights if mode is static, else random.
+                self.frame.on(led)
+        if self.__mode == "random":
+            self.__start_toggling()
+
+    def show(self, pattern, mode):
+        """Lights exactly those lights set in pattern, then carries on in the given mode."""
+        self.is_active = True
+        self.__mode = mode
+        for led, lit in zip(self.lights, pattern):
+            self.frame.set(led, lit)
+        if mode == "random":
+            self.__start_toggling()
+        else:
+            self.__stop_toggling()
+
+    def hold(self):
+        """Stops toggling, leaving each light as it is, and stays static from then on."""
+        self.__mode = "static"
+        self.__stop_toggling()
+
+    def off(self):
+        self.is_active = False
+        self.__stop_toggling()
+        for led in self.lights:
+            self.frame.off(led)
+
+    def __start_toggling(self):
+        with self.__lock:
+            if self.__toggle_call is None and self.is_active:
+                self.__toggle_call = self.scheduler.call_later(randint(0, 50) / 10, self.__toggle)
+
+    def __stop_toggling(self):
+        with self.__lock:
+            if self.__toggle_call is not None:
+                self.__toggle_call.cancel()
+                self.__toggle_call = None
+
+    def __toggle(self):
+        with self.__lock:
+            self.__toggle_call = None
+            if not self.is_active or self.__mode != "random":
+                return
+            self.frame.toggle(self.lights[randint(0, len(self.lights) - 1)])
+        if self.parent is not None:
+            self.parent.state_changed()
+        self.__start_toggling()
+
+    def set_random(self):
+        self.__mode = "random"
+        self.__start_toggling()
+
+    def set_static(self):
+        self.__mode = "static"
+        self.__stop_toggling()
+        if self.is_lit:
+            self.on()
+
+    @property
+    def mode(self):
+        return self.__mode
+
+
+class CustomPWMLED(PWMLED):
+    def __init__(self, *args, scheduler=None, frame=None, pulse_rate=20.0, pulse_shape="linear", **kwargs):
+        """
+        pulse_rate is how many times a second the brightness is updated while pulsing, and
+        pulse_shape the default curve of each fade (see waveforms.resolve_shape).
+        """
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler
+        self.frame = frame
+        self.pulse_rate = pulse_rate
+        self.pulse_shape = pulse_shape
+        self.pulsing = False
+        self.__pulse_call = None
+
+    def custom_pulse(self, fade_in_time=1.0, fade_out_time=1.0, lower_limit=0.0, upper_limit=1.0, background=True,
+                     shape=None):
+        self.__stop_pulse()
+        wave = waveform(
+            fade_in_time,
+            fade_out_time,
+            lower_limit,
+            upper_limit,
+            self.pulse_shape if shape is None else shape,
+            self.pulse_rate
+        )
+        self.pulsing = True
+        epoch = monotonic()
+        self.frame.set(self, wave.table[0])
+        if background:
+            self.__pulse_call = self.scheduler.call_every(1 / self.pulse_rate, self.__pulse_frame, wave, epoch)
+            return
+        frame_time = 1 / self.pulse_rate
+        next_frame = epoch
+        while self.pulsing:
+            self.__pulse_frame(wave, epoch)
+            self.frame.flush()
+            next_frame += frame_time
+            now = monotonic()
+            if next_frame < now:
+                next_frame += (now - next_frame) // frame_time * frame_time + frame_time
+            sleep(next_frame - now)
+
+    def fade_to(self, value, duration):
+        """Stops any pulse, then ramps the brightness from where it is to value over duration seconds."""
+        self.pulsing = False
+        self.__stop_pulse()
+        if duration <= 0:
+            self.frame.set(self, value)
+            return
+        start_value = self.frame.value(self)
+        epoch = monotonic()
+
+        def fade_frame():
+            progress = min(1.0, (monotonic() - epoch) / duration)
+            self.frame.set(self, start_value + (value - start_value) * progress)
+            if progress >= 1.0:
+                self.__stop_pulse()
+        self.__pulse_call = self.scheduler.call_every(1 / self.pulse_rate, fade_frame)
+
+    def __pulse_frame(self, wave, epoch):
+        if self.pulsing:
+            self.frame.set(self, wave.value_at(monotonic() - epoch))
+
+    def __stop_pulse(self):
+        if self.__pulse_call is not None:
+            self.__pulse_call.cancel()
+            self.__pulse_call = None
+
+    def custom_stop(self):
+        self.pulsing = False
+        self.__stop_pulse()
+        self.frame.off(self)
@@ -0,0 +1,175 @@
+"""
+Counters and latency histograms for the ship process, cheap enough to leave running.
+
+Recording is an increment or two under an uncontended lock, with no allocation once a
+command has been seen. The numbers are only formatted when someone asks for them, either
+as a dict for the "stats" command, or as Prometheus text.
+"""
+from bisect import bisect_left
+from threading import Lock, Thread
+from time import monotonic
+
+# Upper bounds of the command latency buckets, in seconds. Anything slower lands in +Inf.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25)
+
+
+class Histogram:
+    __slots__ = ("bounds", "counts", "count", "total")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean_ms": 1000 * self.total / self.count if self.count else 0.0,
+            "buckets_ms": dict(zip([str(1000 * b) for b in self.bounds] + ["inf"], self.counts)),
+        }
+
+
+class Metrics:
+    """
+    gauges maps a name to a function returning a number, or a dict of numbers, which is
+    read each time the metrics are; for things which keep their own counts, like the
+    scheduler and the display.
+    """
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.started = monotonic()
+        self.commands = {}  # command name -> Histogram of how long it took to run
+        self.unknown_commands = 0
+        self.json_errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.connections = 0
+        self.gauges = {}
+        self.__lock = Lock()
+
+    def observe_command(self, name, seconds):
+        with self.__lock:
+            histogram = self.commands.get(name)
+            if histogram is None:
+                histogram = self.commands[name] = Histogram(self.bounds)
+            histogram.observe(seconds)
+
+    def unknown_command(self):
+        with self.__lock:
+            self.unknown_commands += 1
+
+    def json_error(self):
+        with self.__lock:
+            self.json_errors += 1
+
+    def connected(self):
+        with self.__lock:
+            self.connections += 1
+
+    def received(self, size):
+        with self.__lock:
+            self.bytes_in += size
+
+    def sent(self, size):
+        with self.__lock:
+            self.bytes_out += size
+
+    def counted(self, send):
+        """Wraps a client's send function so everything sent through it is counted."""
+        def counted_send(data):
+            send(data)
+            self.sent(len(data))
+        return counted_send
+
+    def read_gauges(self):
+        values = {}
+        for name, gauge in self.gauges.items():
+            try:
+                values[name] = gauge()
+            except Exception as e:
+                print(f"<System> Reading gauge {name} failed: {e!r}")
+        return values
+
+    def snapshot(self):
+        with self.__lock:
+            data = {
+                "uptime": monotonic() - self.started,
+                "commands": {name: histogram.snapshot() for name, histogram in self.commands.items()},
+                "unknown_commands": self.unknown_commands,
+                "json_errors": self.json_errors,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "connections": self.connections,
+            }
+        data.update(self.read_gauges())
+        return data
+
+    def prometheus(self, prefix="uss_lux"):
+        """Returns the metrics in the Prometheus text exposition format."""
+        lines = []
+
+        def metric(name, kind, value, help_text=None):
+            if help_text:
+                lines.append(f"# HELP {prefix}_{name} {help_text}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            lines.append(f"{prefix}_{name} {value}")
+
+        with self.__lock:
+            metric("uptime_seconds", "gauge", monotonic() - self.started)
+            metric("unknown_commands_total", "counter", self.unknown_commands)
+            metric("json_errors_total", "counter", self.json_errors, "Messages which were not valid JSON.")
+            metric("received_bytes_total", "counter", self.bytes_in)
+            metric("sent_bytes_total", "counter", self.bytes_out)
+            metric("connections_total", "counter", self.connections)
+            lines.append(f"# HELP {prefix}_command_seconds Time taken to run each command.")
+            lines.append(f"# TYPE {prefix}_command_seconds histogram")
+            for name, histogram in sorted(self.commands.items()):
+                cumulative = 0
+                for bound, count in zip(list(histogram.bounds) + ["+Inf"], histogram.counts):
+                    cumulative += count
+                    lines.append(f'{prefix}_command_seconds_bucket{{command="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{prefix}_command_seconds_sum{{command="{name}"}} {histogram.total}')
+                lines.append(f'{prefix}_command_seconds_count{{command="{name}"}} {histogram.count}')
+
+        for name, value in self.read_gauges().items():
+            if isinstance(value, dict):
+                for key, item in value.items():
+                    if isinstance(item, (int, float)):
+                        metric(f"{name}_{key}", "gauge", item)
+            else:
+                metric(name, "gauge", value)
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="0.0.0.0"):
+        """Serves the Prometheus text at http://host:port/metrics from a background thread."""
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        thread = Thread(target=server.serve_forever, name="metrics")
+        thread.daemon = True
+        thread.start()
+        print(f"<System> Serving metrics on port {port}.")
+        return server
@@ -0,0 +1,83 @@
+"""
+Broadcasts the ship's state over UDP multicast, for observers which only watch: dashboards,
+a second display, logging boxes. Any number can listen without connecting to the ship, so
+they never compete with the controlling client for its socket.
+
+Each datagram is one binary full state frame (see wire.py), which carries its own seq.
+One is sent whenever the state changes, at most max_rate a second, and the latest is sent
+again every keepalive seconds while nothing changes, so late joiners catch up and listeners
+can tell the ship is still there. Listeners should ignore a repeat of the seq they last saw.
+"""
+import socket
+from threading import Event, Lock, Thread
+from time import monotonic
+
+MULTICAST_GROUP = "239.255.31.41"
+MULTICAST_PORT = 31415
+KEEPALIVE = 1.0  # Seconds between repeats of the state while it isn't changing.
+
+
+class StateBroadcaster:
+    def __init__(self, publisher, group=MULTICAST_GROUP, port=MULTICAST_PORT, ttl=1, keepalive=KEEPALIVE,
+                 max_rate=None, interface=None):
+        """
+        publisher is the ship's subscriptions.StatePublisher, which the broadcaster subscribes
+        to like any client, so the state is encoded once however many are listening.
+        ttl is how many routers the datagrams may cross; 1 keeps them on the local network.
+        interface is the address of the network interface to send from, if not the default.
+        """
+        self.publisher = publisher
+        self.address = (group, port)
+        self.keepalive = keepalive
+        self.max_rate = max_rate
+        self.sent = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        if interface is not None:
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+        self.subscription = None
+        self.__frame = None
+        self.__last_sent = 0.0
+        self.__lock = Lock()  # Held while sending, as changes and keepalives come from different threads.
+        self.__stopped = Event()
+        self.__thread = Thread(target=self.__run, name="multicast")
+        self.__thread.daemon = True
+
+    def start(self):
+        self.subscription = self.publisher.subscribe(self.push, self.max_rate)
+        self.__thread.start()
+        print("<System> Multicasting state to {}:{}.".format(*self.address))
+
+    def push(self, snapshot):
+        """Called by the publisher with each new wire.StateSnapshot."""
+        self.__send(snapshot.full_frame)
+
+    def stop(self):
+        self.__stopped.set()
+        if self.subscription is not None:
+            self.subscription.cancel()
+            self.subscription = None
+        self.sock.close()
+
+    def __send(self, frame):
+        with self.__lock:
+            self.__frame = frame
+            self.__last_sent = monotonic()
+            try:
+                self.sock.sendto(frame, self.address)
+            except OSError as e:
+                # No route to the group yet, such as while the network is still coming up.
+                print("<System> Multicast failed: {}".format(e))
+                return
+            self.sent += 1
+
+    def __run(self):
+        wait = self.keepalive
+        while not self.__stopped.wait(wait):
+            with self.__lock:
+                frame = self.__frame
+                due = self.__last_sent + self.keepalive - monotonic()
+            if frame is not None and due <= 0:
+                self.__send(frame)
+                due = self.keepalive
+            wait = max(due, 0.01)
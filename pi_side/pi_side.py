@@ -1,11 +1,30 @@
 import json
+import os
 import socket
-import sys
-from gpiozero import LED, PWMLED
-from time import sleep
-from random import randint
-from threading import Thread
+from time import sleep, monotonic, perf_counter
+from random import randint, shuffle
+from math import isfinite
+from threading import Thread, Lock, active_count
+from itertools import count
 import argparse
+from framing import CommandReader, FRAMINGS, LINE
+from session import ClientSession, NO_REPLY
+from subscriptions import StatePublisher
+from wire import StateSnapshot, BINARY, BINARY_VERSION, JSON
+from scheduler import Scheduler
+from waveforms import SHAPES
+from display import DisplayManager
+from scenes import load_scenes, compile_scene
+from metrics import Metrics
+from clock import ShipClock, MAX_OFFSET
+from effects import build, strobe, EffectEngine, ENGINE_RATE
+from multicast import StateBroadcaster, MULTICAST_GROUP, MULTICAST_PORT, KEEPALIVE
+from journal import StateJournal, CommandHistory, JOURNAL_FILE, settings_of
+from command_queue import CommandQueue, MAX_DEPTH
+
+# gpiozero, and everything built on it, is imported where it's first needed rather than
+# here: it takes the best part of a second to load on a Pi, and the ship opens its socket
+# first, so it can be imported cheaply and accepts connections almost as soon as it starts.
 
 parser = argparse.ArgumentParser()
 parser.add_argument(
@@ -15,129 +34,176 @@ parser.add_argument(
          "This will take over control of pins 3 & 5 (GPIO 2 & 3).",
     action="store_true"
 )
-args = parser.parse_args()
-
-DEBUG_DISPLAY = args.debug_display
+parser.add_argument(
+    "-f",
+    "--framing",
+    help="How commands and responses are delimited on the socket: newline terminated JSON (default) "
+         "or JSON prefixed with a 4 byte big-endian length.",
+    choices=FRAMINGS,
+    default=LINE
+)
+parser.add_argument(
+    "-a",
+    "--async_server",
+    help="Serve any number of clients at once from an asyncio loop, instead of one client at a time.",
+    action="store_true"
+)
+parser.add_argument(
+    "-r",
+    "--max_push_rate",
+    help="Default maximum number of state updates per second pushed to each subscribed client.",
+    type=float,
+    default=10.0
+)
+parser.add_argument(
+    "--pulse_rate",
+    help="Brightness updates per second while the nacelles pulse.",
+    type=float,
+    default=20.0
+)
+parser.add_argument(
+    "--effect_rate",
+    help="Ticks per second of the effects engine, which plays the blinkers and the \"effect\" command.",
+    type=float,
+    default=ENGINE_RATE
+)
+parser.add_argument(
+    "--pulse_shape",
+    help="Curve the nacelles fade along when pulsing.",
+    choices=tuple(SHAPES),
+    default="linear"
+)
+parser.add_argument(
+    "-s",
+    "--scenes",
+    help="JSON file of named scenes for the \"scene\" command.",
+    default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "scenes.json")
+)
+parser.add_argument(
+    "-m",
+    "--metrics_port",
+    help="Also serve the \"stats\" metrics as Prometheus text over HTTP on this port.",
+    type=int
+)
+parser.add_argument(
+    "-j",
+    "--journal",
+    help="File the state is kept in, to be restored from when the ship next starts.",
+    default=os.path.join(os.path.dirname(os.path.abspath(__file__)), JOURNAL_FILE)
+)
+parser.add_argument(
+    "--no_journal",
+    help="Neither restore nor keep the state: always start with everything on.",
+    action="store_true"
+)
+parser.add_argument(
+    "--history",
+    help="How many recent commands which changed the ship to keep for the \"history\" command.",
+    type=int,
+    default=256
+)
+parser.add_argument(
+    "-q",
+    "--queue_depth",
+    help="Most commands waiting to run at once. Past this, clients are told the ship is busy.",
+    type=int,
+    default=MAX_DEPTH
+)
+parser.add_argument(
+    "--multicast",
+    help="Also multicast the state to any number of passive observers, by default on {}:{}.".format(
+        MULTICAST_GROUP, MULTICAST_PORT
+    ),
+    nargs="?",
+    const="{}:{}".format(MULTICAST_GROUP, MULTICAST_PORT),
+    metavar="GROUP[:PORT]"
+)
+parser.add_argument(
+    "--multicast_ttl",
+    help="How many routers multicast state may cross. 1 keeps it on the local network.",
+    type=int,
+    default=1
+)
+parser.add_argument(
+    "--multicast_keepalive",
+    help="Seconds between repeats of the multicast state while it isn't changing.",
+    type=float,
+    default=KEEPALIVE
+)
 
-if DEBUG_DISPLAY:
-    from RPi_GPIO_i2c_LCD import lcd
-    LCD_ADDR = 0x27
-    DISPLAY = lcd.HD44780(LCD_ADDR)
-    DISPLAY.backlight("on")
-    DISPLAY.clear()
+LCD_ADDR = 0x27
 
 RUN = True
+ANY = ("*",)  # Matches any word in a position of the command table.
+NACELLE_PULSE = (0.3, 0.9, 0.2, 0.3)  # Fade in time, fade out time, lower limit, upper limit.
+BLINKERS = ("port_lights", "starboard_lights", "top_lights_1", "top_lights_2", "top_lights_3")
+# Each group blinks its lights on for on seconds, then off for off seconds. A light's phase is
+# how long after the start of each of the group's periods it comes on. Periods are counted
+# from 0 on the shared clock, so ships whose clocks are synced blink together.
+BLINK_GROUPS = (
+    # (on, off, ((light, phase), ...))
+    (5.0, 0.1, (("port_lights", 0.0), ("starboard_lights", 0.1))),
+    (0.1, 2.0, (("top_lights_1", 0.0), ("top_lights_3", 0.1), ("top_lights_2", 0.2))),
+)
 
 
-class DynamicLights:
-    def __init__(self, lights, mode="random", parent=None):
-        self.parent = parent
-        self.lights = lights
-        self.is_active = False
-        self.run_thread = None
-        self.__mode = ""
-        self.__keep_running = True
-        if mode == "random":
-            self.set_random()
-        else:
-            self.set_static()
-
-    @property
-    def is_lit(self):
-        return self.is_active
-
-    def on(self):
-        self.is_active = True
-        for led in self.lights:
-            if self.__mode == "static" or randint(0, 1):  # Turn on all lights if mode is static, else random.
-                led.on()
-
-    def off(self):
-        self.is_active = False
-        for led in self.lights:
-            led.off()
-
-    def __run(self):
-        while self.__keep_running:
-            if self.is_active:
-                while self.is_active and self.__keep_running:
-                    self.lights[randint(0, len(self.lights) - 1)].toggle()
-                    if self.parent is not None:
-                        self.parent.update_screen()
-                    sleep(randint(0, 50) / 10)
-            else:
-                sleep(1)
-
-    def set_random(self):
-        self.__mode = "random"
-        self.__keep_running = True
-        self.run_thread = Thread(target=self.__run)
-        self.run_thread.daemon = True
-        self.run_thread.start()
-
-    def set_static(self):
-        self.__mode = "static"
-        self.__keep_running = False
-        if self.is_lit:
-            self.on()
-
-    @property
-    def mode(self):
-        return self.__mode
-
-
-class CustomPWMLED(PWMLED):
-    def __init__(self, *args):
-        super().__init__(*args)
-        self.pulsing = False
-
-    def custom_pulse(self, fade_in_time=1.0, fade_out_time=1.0, lower_limit=0.0, upper_limit=1.0, background=True):
-        if background:
-            t = Thread(
-                target=self.custom_pulse,
-                args=(
-                    fade_in_time,
-                    fade_out_time,
-                    lower_limit,
-                    upper_limit,
-                    False
-                )
-            )
-            t.daemon = True
-            t.start()
-            return
-        self.pulsing = True
-        increasing = True
-        difference = float(upper_limit - lower_limit)
-        step_up_size = difference / (fade_in_time / 0.05)
-        step_down_size = difference / (fade_out_time / 0.05)
-        self.value = lower_limit
-        while self.pulsing:
-            v = self.value
-            if increasing:
-                v += step_up_size
-                if v >= upper_limit:
-                    self.value = upper_limit
-                    increasing = False
-                else:
-                    self.value = v
-            else:
-                v -= step_down_size
-                if v <= lower_limit:
-                    self.value = lower_limit
-                    increasing = True
-                else:
-                    self.value = v
-            sleep(0.05)
-
-    def custom_stop(self):
-        self.pulsing = False
-        self.off()
+def listen(host="0.0.0.0", port=3141, backlog=1):
+    """
+    Opens a socket listening on host and port. Clients can connect as soon as this
+    returns: they wait in the backlog until the ship gets round to accepting them.
+    """
+    sock = socket.socket()
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    print("<System> Socket open and listening.")
+    return sock
 
 
 class ShipController:
-    def __init__(self, start_thread=False):
-        """If start_thread is False, "network_control" will need to be called."""
+    def __init__(self, start_thread=False, framing=LINE, max_push_rate=10.0, pulse_rate=20.0, pulse_shape="linear",
+                 scenes_file=None, lcd=None, pin_factory=None, scheduler=None, host="0.0.0.0", port=3141,
+                 listener=None, effect_rate=ENGINE_RATE, journal=None, history=256, queue_depth=MAX_DEPTH):
+        """
+        If start_thread is False, "network_control" will need to be called.
+        listener is a socket already listening (see listen), to serve on rather than opening one.
+        scenes_file is a JSON file of scenes (see scenes.py) for the "scene" command.
+        lcd is an RPi_GPIO_i2c_LCD.i2c_HD44780.lcd to show the debug display on, if any.
+        pin_factory is the gpiozero pin factory for the lights, by default gpiozero's own.
+        scheduler may be a Scheduler shared with other ships in the same process.
+        effect_rate is how many times a second the EffectEngine ticks.
+        journal is a journal.StateJournal to restore the state from, and keep it in.
+        history is how many recent commands which changed the ship to keep for the "history" command.
+        queue_depth is how many commands from clients may wait to run at once (see command_queue.py).
+        """
+        self.framing = framing
+        self.state_seq = 0
+        self.__seq_counter = count(1)
+        self.__snapshot = None  # Built from the lights when first asked for after a change.
+        self.__state_key = None  # What the state was last built from; see state_changed.
+        self.__state_lock = Lock()  # Held while the state's seq is bumped, or its snapshot built.
+        self.metrics = Metrics()
+        self.journal = journal
+        self.history = CommandHistory(history)
+        self.publisher = StatePublisher(self.snapshot, max_push_rate)
+        self.host = host
+        self.port = port
+        from gpiozero import LED
+        from framebuffer import FrameBuffer
+        from lights import CustomPWMLED, DynamicLights
+        self.scheduler = scheduler or Scheduler()
+        self.frame = FrameBuffer()
+        self.scheduler.tick_hooks.append(self.frame.flush)
+        self.clock = ShipClock()
+        self.clock.listeners.append(self.clock_adjusted)
+        self.effects = EffectEngine(
+            self.scheduler,
+            self.frame,
+            effect_rate,
+            on_change=self.state_changed,
+            clock=self.clock
+        )
+        self.display = None
         self.__cabins_mode = "random"  # "static" / "random"
         self.__nacelles_mode = "pulse"  # "static" / "pulse"
 
@@ -161,26 +227,74 @@ class ShipController:
         )
 
         self.lights = {
-            "static_nacelles": LED(14),
-            "dynamic_nacelles": CustomPWMLED(15),
-            "port_lights": LED(18),
-            "starboard_lights": LED(23),
-            "top_lights_1": LED(24),
-            "top_lights_2": LED(25),
-            "top_lights_3": LED(8),
-            "static_cabins": LED(7),
+            "static_nacelles": LED(14, pin_factory=pin_factory),
+            "dynamic_nacelles": CustomPWMLED(
+                15,
+                scheduler=self.scheduler,
+                frame=self.frame,
+                pulse_rate=pulse_rate,
+                pulse_shape=pulse_shape,
+                pin_factory=pin_factory
+            ),
+            "port_lights": LED(18, pin_factory=pin_factory),
+            "starboard_lights": LED(23, pin_factory=pin_factory),
+            "top_lights_1": LED(24, pin_factory=pin_factory),
+            "top_lights_2": LED(25, pin_factory=pin_factory),
+            "top_lights_3": LED(8, pin_factory=pin_factory),
+            "static_cabins": LED(7, pin_factory=pin_factory),
             "dynamic_cabins": DynamicLights(
                 [
-                    LED(n) for n in dynamic_cabin_pins
+                    LED(n, pin_factory=pin_factory) for n in dynamic_cabin_pins
                 ],
-                parent=self
+                parent=self,
+                scheduler=self.scheduler,
+                frame=self.frame
             ),
         }
+        blinkers = [self.lights[name] for name in BLINKERS]
+        self.groups = {
+            "cabins": [self.lights["static_cabins"]] + self.lights["dynamic_cabins"].lights,
+            "dynamic_cabins": self.lights["dynamic_cabins"].lights,
+            "nacelles": [self.lights["static_nacelles"], self.lights["dynamic_nacelles"]],
+            "blinkers": blinkers,
+            "top_lights": blinkers[2:],
+        }
+        self.groups["all"] = self.groups["cabins"] + self.groups["nacelles"] + blinkers
+        self.frame.watch(self.groups["cabins"] + [self.lights["static_nacelles"]])  # The lights in get_state.
         self.blinkers_lit = False
-        self.receiver_socket = socket.socket()
+        self.blink_bindings = []
+        self.effect_bindings = {}  # Target -> effects.Binding, for those started by the "effect" command.
+        self.scenes = load_scenes(scenes_file, len(dynamic_cabin_pins)) if scenes_file else {}
+        self.scene_calls = []
+        self.scene_generation = 0  # Bumped whenever a scene's fade is cut short, so its queued steps are dropped.
+        self.timeline = None
+        self.timeline_session = None
+        self.receiver_socket = listener
         self.connected = False
         self.current_connection = None
         self.run = True
+        self.commands = self.build_commands()
+        self.command_queue = CommandQueue(self.process_command, queue_depth)
+        if lcd is not None:
+            self.display = DisplayManager(lcd, self.screen_lines)
+        self.metrics.gauges.update(
+            threads=active_count,
+            scheduler=self.scheduler.stats,
+            frame=lambda: {"flushes": self.frame.flushes, "writes": self.frame.writes},
+            effect_ticks=lambda: self.effects.ticks,
+            history=lambda: self.history.total,
+            queue=self.command_queue.stats,
+        )
+        if self.journal is not None:
+            self.metrics.gauges["journal"] = lambda: {
+                "writes": self.journal.writes,
+                "compactions": self.journal.compactions,
+            }
+        if self.display is not None:
+            self.metrics.gauges["display"] = lambda: {
+                "writes": self.display.writes,
+                "write_seconds": self.display.write_time,
+            }
 
         if start_thread:
             self.network_thread = Thread(
@@ -189,11 +303,15 @@ class ShipController:
             self.network_thread.daemon = True
             self.network_thread.start()
 
-        self.nacelles_on()
-        self.cabins_on()
-        self.blinkers_on()
+        if not (self.journal is not None and self.restore(self.journal.load())):
+            self.nacelles_on()
+            self.cabins_on()
+            self.blinkers_on()
 
-        self.update_screen()
+        self.state_changed()
+        if self.journal is not None:
+            self.journal.start(self.journal_settings)
+        self.command_queue.start()
 
     @property
     def cabins_mode(self):
@@ -204,50 +322,106 @@ class ShipController:
         return self.__nacelles_mode
 
     def cabins_on(self):
-        self.lights["static_cabins"].on()
-        self.lights["dynamic_cabins"].on()
+        self.effects.release(self.groups["cabins"])
+        self.frame.on(self.lights["static_cabins"])
+        # Mode first, as the cabins may have been held static by an effect or timeline.
         if self.__cabins_mode == "static":
             self.lights["dynamic_cabins"].set_static()
         elif self.__cabins_mode == "random":
             self.lights["dynamic_cabins"].set_random()
+        self.lights["dynamic_cabins"].on()
 
     def cabins_off(self):
-        self.lights["static_cabins"].off()
+        self.effects.release(self.groups["cabins"])
+        self.frame.off(self.lights["static_cabins"])
         self.lights["dynamic_cabins"].off()
 
     def nacelles_on(self):
-        self.lights["static_nacelles"].on()
+        self.effects.release(self.groups["nacelles"])
+        self.frame.on(self.lights["static_nacelles"])
         if self.__nacelles_mode == "static":
-            self.lights["dynamic_nacelles"].on()
+            self.frame.on(self.lights["dynamic_nacelles"])
         elif self.__nacelles_mode == "pulse":
-            self.lights["dynamic_nacelles"].custom_pulse(0.3, 0.9, 0.2, 0.3)
+            self.lights["dynamic_nacelles"].custom_pulse(*NACELLE_PULSE)
 
     def nacelles_off(self):
-        self.lights["static_nacelles"].off()
+        self.effects.release(self.groups["nacelles"])
+        self.frame.off(self.lights["static_nacelles"])
         self.lights["dynamic_nacelles"].custom_stop()
 
+    def blink(self, name, on_time, off_time, delay=0.0, start=None):
+        """Blinks a light with the effects engine, starting delay seconds after start (default now)."""
+        start = monotonic() if start is None else start
+        self.blink_bindings.append(self.effects.bind(
+            [self.lights[name]], strobe(on_time, off_time), epoch=start + delay, notify=False
+        ))
+
     def blinkers_on(self):
-        # Start Side Blinkers
-        self.lights["port_lights"].blink(5, 0.1)
-        sleep(0.1)
-        self.lights["starboard_lights"].blink(5, 0.1)
-
-        # Start top blinks.
-        self.lights["top_lights_1"].blink(0.1, 2)
-        sleep(0.1)
-        self.lights["top_lights_3"].blink(0.1, 2)
-        sleep(0.1)
-        self.lights["top_lights_2"].blink(0.1, 2)
+        self.stop_blinking()
+        for on_time, off_time, lights in BLINK_GROUPS:
+            epoch = self.clock.period_start(on_time + off_time)
+            for name, phase in lights:
+                self.blink(name, on_time, off_time, delay=phase, start=epoch)
         self.blinkers_lit = True
 
+    def clock_adjusted(self, delta):
+        """Puts the effects and blinkers back in phase with the shared clock after it moves."""
+        self.effects.realign()
+        if self.blinkers_lit:
+            self.blinkers_on()
+
+    def stop_blinking(self):
+        self.effects.release(self.groups["blinkers"])
+        self.blink_bindings = []
+
     def blinkers_off(self):
-        self.lights["port_lights"].off()
-        self.lights["starboard_lights"].off()
-        self.lights["top_lights_1"].off()
-        self.lights["top_lights_2"].off()
-        self.lights["top_lights_3"].off()
+        self.stop_blinking()
+        for name in BLINKERS:
+            self.frame.off(self.lights[name])
         self.blinkers_lit = False
 
+    def group(self, target):
+        """
+        Returns the lights a target names: one of groups, a light in lights (dynamic_cabins
+        being its lights), or "dynamic_cabins.<n>" for one cabin light. None if it's unknown.
+        """
+        if target in self.groups:
+            return self.groups[target]
+        name, dot, index = target.partition(".")
+        light = self.lights.get(name)
+        if light is None:
+            return None
+        if dot:
+            if name == "dynamic_cabins" and index.isdigit() and int(index) < len(light.lights):
+                return [light.lights[int(index)]]
+            return None
+        return [light]
+
+    def play_effect(self, target, effect):
+        """
+        Plays an effects.Effect on the target's lights, in place of whatever was driving them:
+        random cabins hold as they are and the nacelles stop pulsing, until their lights are
+        switched on or off again. Returns the binding, or None if the target is unknown.
+        """
+        devices = self.group(target)
+        if devices is None:
+            return None
+        dynamic_cabins = self.lights["dynamic_cabins"]
+        if any(device in devices for device in dynamic_cabins.lights):
+            dynamic_cabins.hold()
+        dynamic_nacelles = self.lights["dynamic_nacelles"]
+        if dynamic_nacelles in devices:
+            dynamic_nacelles.fade_to(self.frame.value(dynamic_nacelles), 0)
+        binding = self.effects.bind(devices, effect)
+        self.effect_bindings[target] = binding
+        return binding
+
+    def stop_effect(self, target):
+        """Stops the effect playing on target, leaving its lights as they are."""
+        binding = self.effect_bindings.pop(target, None)
+        if binding is not None:
+            self.effects.unbind(binding)
+
     def set_nacelles_mode(self, mode):
         """
         Mode may be "static" or "pulse".
@@ -271,12 +445,256 @@ class ShipController:
         else:
             self.lights["dynamic_cabins"].set_random()
 
-    def process_command(self, command):
-        global RUN
+    def apply_scene(self, scene, fade=None):
+        """
+        Changes the ship to the scene, touching only what differs from how it is now:
+        lights already right aren't rewritten, and effects already running as the scene
+        wants them carry on undisturbed. Everything changes in the same flush.
+
+        With a fade (default: the scene's own), the lights which need switching on or off
+        switch one at a time, in random order, spread over that many seconds, while the
+        nacelles ramp to their new brightness. Modes and blinkers change at the end.
+        :type scene: scenes.Scene
+        """
+        self.cancel_scene()
+        self.effects.release(self.groups["cabins"] + self.groups["nacelles"])
+        fade = scene.fade if fade is None else fade
+        dynamic_cabins = self.lights["dynamic_cabins"]
+        pattern = scene.cabin_lights
+        if not scene.cabins:
+            pattern = (0,) * len(dynamic_cabins.lights)
+        elif pattern is None:
+            if scene.cabins_mode == "static":
+                pattern = (1,) * len(dynamic_cabins.lights)
+            elif dynamic_cabins.is_active and dynamic_cabins.mode == "random":
+                pattern = tuple(self.frame.value(led) for led in dynamic_cabins.lights)
+            else:
+                pattern = tuple(randint(0, 1) for _ in dynamic_cabins.lights)
+        if fade <= 0:
+            self.__show_scene(scene, pattern)
+            return
+
+        targets = [
+            (self.lights["static_cabins"], int(scene.cabins)),
+            (self.lights["static_nacelles"], int(scene.nacelles)),
+        ]
+        targets.extend(zip(dynamic_cabins.lights, pattern))
+        changes = [(device, value) for device, value in targets if self.frame.value(device) != value]
+        shuffle(changes)
+        start = monotonic()
+        # The steps run on the command queue's worker, not the scheduler, as they change the ship.
+        run = self.command_queue.call
+        generation = self.scene_generation
+        for i, (device, value) in enumerate(changes):
+            self.scene_calls.append(self.scheduler.call_at(
+                start + fade * (i + 1) / (len(changes) + 1), run, self.__scene_step, generation, device, value
+            ))
+        if self.__nacelles_change(scene):
+            if not scene.nacelles:
+                brightness = 0.0
+            elif scene.nacelles_mode == "static":
+                brightness = 1.0
+            else:
+                brightness = NACELLE_PULSE[2]
+            self.lights["dynamic_nacelles"].fade_to(brightness, fade)
+        self.scene_calls.append(self.scheduler.call_at(
+            start + fade, run, self.__finish_scene, generation, scene, pattern
+        ))
+
+    def cancel_scene(self):
+        """Stops any scene's fade where it's got to: its steps yet to run, queued or not, are dropped."""
+        for call in self.scene_calls:
+            call.cancel()
+        self.scene_calls = []
+        self.scene_generation += 1
+
+    def __nacelles_change(self, scene):
+        """Whether the scene needs the dynamic nacelles doing anything different to now."""
+        if not scene.nacelles:
+            return bool(self.frame.value(self.lights["dynamic_nacelles"]))
+        return not (
+            self.frame.value(self.lights["static_nacelles"])
+            and scene.nacelles_mode == self.__nacelles_mode
+            and (scene.nacelles_mode == "static" or self.lights["dynamic_nacelles"].pulsing)
+        )
+
+    def __scene_step(self, generation, device, value):
+        if generation != self.scene_generation:
+            return  # Queued before another scene, or hold_effects, replaced this one.
+        self.frame.set(device, value)
+        self.state_changed()
+
+    def __finish_scene(self, generation, scene, pattern):
+        if generation != self.scene_generation:
+            return
+        self.scene_calls = []
+        self.__show_scene(scene, pattern)
+        self.state_changed()
+
+    def __show_scene(self, scene, pattern):
+        dynamic_cabins = self.lights["dynamic_cabins"]
+        if scene.cabins:
+            self.frame.on(self.lights["static_cabins"])
+            if not (dynamic_cabins.is_active and dynamic_cabins.mode == scene.cabins_mode
+                    and scene.cabin_lights is None):
+                dynamic_cabins.show(pattern, scene.cabins_mode)
+            self.__cabins_mode = scene.cabins_mode
+        else:
+            self.cabins_off()
+            self.set_cabins_mode(scene.cabins_mode)
+
+        if not scene.nacelles:
+            self.nacelles_off()
+        elif self.__nacelles_change(scene):
+            self.__nacelles_mode = scene.nacelles_mode
+            self.lights["dynamic_nacelles"].custom_stop()
+            self.nacelles_on()
+        self.__nacelles_mode = scene.nacelles_mode
+
+        if scene.blinkers and not self.blinkers_lit:
+            self.blinkers_on()
+        elif not scene.blinkers and self.blinkers_lit:
+            self.blinkers_off()
+
+    def restore(self, settings):
+        """
+        Puts the ship straight back as it was, from settings loaded from the journal.
+        Returns False if there are none, or they aren't valid.
+        """
+        if settings is None:
+            return False
+        try:
+            scene = compile_scene("restored", settings, len(self.lights["dynamic_cabins"].lights))
+        except ValueError as e:
+            print("<System> Not restoring the state: {}".format(e))
+            return False
+        self.apply_scene(scene, fade=0)
+        print("<System> Restored the last state.")
+        return True
+
+    def hold_effects(self):
+        """
+        Stops every running effect (scene fades, blinking, random cabins and pulsing) and
+        leaves each light as it is, so something else can drive the lights directly.
+        """
+        self.cancel_scene()
+        self.effects.release(self.groups["all"])
+        self.effect_bindings = {}
+        self.blink_bindings = []
+        self.blinkers_lit = False
+        self.lights["dynamic_cabins"].hold()
+        self.__cabins_mode = "static"
+        dynamic_nacelles = self.lights["dynamic_nacelles"]
+        dynamic_nacelles.fade_to(self.frame.value(dynamic_nacelles), 0)
+        self.__nacelles_mode = "static"
+
+    def open_timeline(self, lookahead=1024, session=None):
+        """Starts a new, empty timeline in place of any other, reporting its events to session."""
+        from timeline import Timeline
+        if self.timeline is not None:
+            self.timeline.stop()
+        devices = {name: light for name, light in self.lights.items() if name != "dynamic_cabins"}
+        cabin_lights = self.lights["dynamic_cabins"].lights
+        devices.update(("dynamic_cabins.{}".format(i), led) for i, led in enumerate(cabin_lights))
+        self.timeline_session = session
+        self.timeline = Timeline(
+            self.scheduler,
+            devices,
+            {"dynamic_cabins": cabin_lights},
+            self.frame,
+            lookahead=lookahead,
+            on_change=self.state_changed,
+            on_event=self.__timeline_event
+        )
+        return self.timeline
+
+    def __timeline_event(self, reason, status):
+        session = self.timeline_session
+        if session is None:
+            return
+        status["event"] = "timeline"
+        status["reason"] = reason
+        try:
+            session.send(session.encode_response(status))
+        except (ConnectionError, OSError, RuntimeError):
+            self.timeline_session = None
+
+    def build_commands(self):
+        """
+        Returns the dispatch table used by process_command, mapping (target, action, arg)
+        to (handler, changes_state, merges), with every alias expanded. "*" matches any
+        action or arg, for commands which take free arguments. merges names the parts of
+        the ship a command sets outright, for the command queue to merge it by.
+        """
+        commands = {}
+
+        def add(targets, actions, args, handler, changes_state=True, merges=None):
+            merges = None if merges is None else frozenset(merges)
+            for target in targets:
+                for action in actions:
+                    for arg in args:
+                        commands[(target, action, arg)] = (handler, changes_state, merges)
+
+        def light_command(message, *steps):
+            def handler(words, session):
+                self.cancel_scene()  # Or the rest of its fade would undo this.
+                for step in steps:
+                    step()
+                print("<System> {}".format(message))
+            return handler
+
+        cabins = ("cabins",)
+        nacelles = ("nacelles",)
+        blinkers = ("blinkers",)
+        everything = cabins + nacelles + blinkers
+        add(("cabins",), ("on",), ANY, light_command("Cabins on.", self.cabins_on), merges=cabins)
+        add(("cabins",), ("off",), ANY, light_command("Cabins off.", self.cabins_off), merges=cabins)
+        add(("cabins",), ("random", "mode"), ("on", "random"), light_command(
+            "Cabins mode set to random.", lambda: self.set_cabins_mode("random")
+        ), merges=("cabins_mode",))
+        add(("cabins",), ("random", "mode"), ("off", "static"), light_command(
+            "Cabins mode set to static.", lambda: self.set_cabins_mode("static")
+        ), merges=("cabins_mode",))
+        add(("engines", "nacelles"), ("on",), ANY, light_command("Nacelles on.", self.nacelles_on), merges=nacelles)
+        add(("engines", "nacelles"), ("off",), ANY, light_command("Nacelles off.", self.nacelles_off), merges=nacelles)
+        add(("engines", "nacelles"), ("pulse", "mode"), ("on", "pulse"), light_command(
+            "Nacelles mode set to pulse.", lambda: self.set_nacelles_mode("pulse")
+        ), merges=("nacelles_mode",))
+        add(("engines", "nacelles"), ("pulse", "mode"), ("off", "static"), light_command(
+            "Nacelles mode set to static.", lambda: self.set_nacelles_mode("static")
+        ), merges=("nacelles_mode",))
+        add(("blinkers",), ("on",), ANY, light_command("Blinkers on.", self.blinkers_on), merges=blinkers)
+        add(("blinkers",), ("off",), ANY, light_command("Blinkers off.", self.blinkers_off), merges=blinkers)
+        add(("all",), ("on",), ANY, light_command(
+            "All on.", self.cabins_on, self.nacelles_on, self.blinkers_on
+        ), merges=everything)
+        add(("all",), ("off",), ANY, light_command(
+            "All off.", self.cabins_off, self.nacelles_off, self.blinkers_off
+        ), merges=everything)
+        add(("scene",), ANY, ANY, self.__scene_command)
+        add(("effect",), ANY, ANY, self.__effect_command)
+        add(("time",), ANY, ANY, lambda words, session: {"time": self.clock.now()}, changes_state=False)
+        add(("clock",), ANY, ANY, self.__clock_command, changes_state=False)
+        add(("timeline",), ("open", "end", "status"), ANY, self.__timeline_command, changes_state=False)
+        add(("timeline",), ("play", "stop"), ANY, self.__timeline_command)
+        add(("stop", "exit", "halt"), ANY, ANY, self.__stop_command)
+        add(("scheduler",), ANY, ANY, lambda words, session: self.scheduler.stats(), changes_state=False)
+        add(("stats",), ANY, ANY, self.__stats_command, changes_state=False)
+        add(("get_state",), ANY, ANY, self.__get_state_command, changes_state=False)
+        add(("subscribe",), ANY, ANY, self.__subscribe_command, changes_state=False)
+        add(("unsubscribe",), ANY, ANY, self.__unsubscribe_command, changes_state=False)
+        add(("format",), ANY, ANY, self.__format_command, changes_state=False)
+        add(("ack",), ANY, ANY, self.__ack_command, changes_state=False)
+        add(("history",), ANY, ANY, self.__history_command, changes_state=False)
+        add(("history",), ("replay",), ANY, self.__replay_command)
+        return commands
+
+    @staticmethod
+    def parse_command(command):
         if type(command) is str:
             commands = command.split(" ")
         elif type(command) in (tuple, list):
-            commands = command
+            commands = list(command)
             if [type(c) for c in commands].count(str) != len(commands):
                 raise TypeError("List of commands was not all strings.")
         else:
@@ -284,131 +702,534 @@ class ShipController:
 
         while len(commands) < 3:
             commands.append("")
+        return commands
 
-        if commands[0] == "cabins":
-            if commands[1] == "on":
-                self.cabins_on()
-                print("<System> Cabins on.")
-            elif commands[1] == "off":
-                self.cabins_off()
-                print("<System> Cabins off.")
-            elif commands[1] in ("random", "mode"):
-                if commands[2] in ("on", "random"):
-                    self.set_cabins_mode("random")
-                    print("<System> Cabins mode set to random.")
-                elif commands[2] in ("off", "static"):
-                    self.set_cabins_mode("static")
-                    print("<System> Cabins mode set to static.")
-        elif commands[0] in ("engines", "nacelles"):
-            if commands[1] == "on":
-                self.nacelles_on()
-                print("<System> Nacelles on.")
-            elif commands[1] == "off":
-                self.nacelles_off()
-                print("<System> Nacelles off.")
-            elif commands[1] in ("pulse", "mode"):
-                if commands[2] in ("on", "pulse"):
-                    self.set_nacelles_mode("pulse")
-                    print("<System> Nacelles mode set to pulse.")
-                elif commands[2] in ("off", "static"):
-                    self.set_nacelles_mode("static")
-                    print("<System> Nacelles mode set to static.")
-        elif commands[0] == "blinkers":
-            if commands[1] == "on":
-                self.blinkers_on()
-                print("<System> Blinkers on.")
-            elif commands[1] == "off":
-                self.blinkers_off()
-                print("<System> Blinkers off.")
-        elif commands[0] == "all":
-            if commands[1] == "on":
-                self.cabins_on()
-                self.nacelles_on()
-                self.blinkers_on()
-                print("<System> All on.")
-            elif commands[1] == "off":
-                self.cabins_off()
-                self.nacelles_off()
-                self.blinkers_off()
-                print("<System> All off.")
-        elif commands[0] in ("stop", "exit", "halt"):
-            self.cabins_off()
-            self.nacelles_off()
-            self.blinkers_off()
-            print("<System> Stopping...")
-            RUN = False
-            self.run = False
+    def lookup(self, commands):
+        """Returns the (handler, changes_state, merges) entry for a parsed command, or None if it's unknown."""
+        target, action, arg = commands[:3]
+        return (
+            self.commands.get((target, action, arg))
+            or self.commands.get((target, action, "*"))
+            or self.commands.get((target, "*", "*"))
+        )
+
+    def merge_slots(self, command):
+        """The merge slots of a command (see build_commands), or None if it mustn't be merged."""
+        if type(command) not in (str, list, tuple):
+            return None
+        try:
+            entry = self.lookup(self.parse_command(command))
+        except TypeError:
+            return None
+        return None if entry is None else entry[2]
+
+    def process_command(self, command, session=None):
+        """
+        command is a single command, or a message of one of these forms:
+            {"batch": [command, ...]} runs several and returns a list of their responses.
+            {"id": id, "command": command} or {"id": id, "batch": [...]} answers with
+            {"id": id, "result": response}, so clients can have many requests in flight.
+            {"timeline": [cue, ...]} adds cues to the open timeline (see timeline.py).
+            {"effect": target, "spec": spec} plays an effect described in JSON (see effects.build)
+            on the target's lights, or stops it if spec is null.
+
+        session is the ClientSession the command arrived on, if any. It is only needed
+        for commands which act on the connection itself, such as "subscribe".
+
+        Clients' commands are run from command_queue, which may merge them first.
+        """
+        if type(command) is dict:
+            return self.process_message(command, session)
+        try:
+            commands = self.parse_command(command)
+        except TypeError as e:
+            return self.invalid(e)
+        entry = self.lookup(commands)
+        self.history.add(command, entry is not None and entry[1])
+        if entry is None:
+            self.metrics.unknown_command()
+            return None
+        handler, changes_state, _ = entry
+        started = perf_counter()
+        resp = self.call_handler(command, handler, commands, session)
+        if changes_state:
+            self.state_changed()
+        self.metrics.observe_command(commands[0], perf_counter() - started)
+        return resp
+
+    def process_message(self, message, session=None):
+        if type(message.get("batch")) is list:
+            resp = self.process_batch(message["batch"], session)
+        elif type(message.get("timeline")) is list:
+            resp = self.call_handler("timeline", self.timeline_cues, message["timeline"])
+        elif type(message.get("effect")) is str:
+            self.history.add({"effect": message["effect"], "spec": message.get("spec")}, True)
+            resp = self.call_handler("effect", self.effect_message, message["effect"], message.get("spec"))
+        elif "command" in message:
+            resp = self.process_command(message["command"], session)
+        else:
+            resp = self.invalid("Invalid command message {}".format(message))
+        if "id" not in message or resp is NO_REPLY:
+            return resp
+        if type(resp) is bytes:
+            resp = self.__decoded_state(resp, self.parse_command(message["command"]), session)
+        return {"id": message["id"], "result": resp}
+
+    def process_batch(self, batch, session=None):
+        """
+        Runs every command in the batch, then writes all their light changes out together,
+        so a whole scene change happens at once, from a single request. If any command in
+        it isn't valid, none of them are run, and the reply is an error.
+        """
+        try:
+            parsed = [self.parse_command(command) for command in batch]
+        except TypeError as e:
+            return self.invalid("Invalid batch: {}".format(e))
+        responses = []
+        changed = False
+        try:
+            for command, commands in zip(batch, parsed):
+                entry = self.lookup(commands)
+                self.history.add(command, entry is not None and entry[1])
+                if entry is None:
+                    self.metrics.unknown_command()
+                    responses.append(None)
+                    continue
+                handler, changes_state, _ = entry
+                if changed and not changes_state:
+                    # Let queries see the changes made earlier in the batch.
+                    self.state_changed()
+                started = perf_counter()
+                resp = self.call_handler(command, handler, commands, session)
+                self.metrics.observe_command(commands[0], perf_counter() - started)
+                changed = changed or changes_state
+                if resp is NO_REPLY:
+                    resp = None
+                elif type(resp) is bytes:
+                    resp = self.__decoded_state(resp, commands, session)
+                responses.append(resp)
+        finally:
+            # Whatever the commands before a failing one changed is still written out.
+            if changed:
+                self.state_changed()
+        return responses
+
+    def call_handler(self, command, handler, *args):
+        """
+        Returns handler(*args), or if it raises, an error reply for command: a bug or bad value
+        in one command is answered like a bad message, rather than losing the client or server.
+        """
+        try:
+            return handler(*args)
+        except Exception as e:
+            return self.invalid("{} failed: {!r}".format(command, e))
+
+    def invalid(self, reason):
+        """The reply to a command or message which isn't valid, rather than raising on the client's thread."""
+        print("<System> {}".format(reason))
+        self.metrics.unknown_command()
+        return {"error": str(reason)}
+
+    def __stop_command(self, commands, session):
+        global RUN
+        if self.journal is not None:
+            self.journal.close()  # Before the lights go out, so they come back on at the next start.
+        self.cabins_off()
+        self.nacelles_off()
+        self.blinkers_off()
+        print("<System> Stopping...")
+        RUN = False
+        self.run = False
+        if self.receiver_socket is not None:
             self.receiver_socket.close()
-            self.run = False
-            RUN = False
-            Thread(target=self.stop).start()
-        elif commands[0] == "get_state":
-            #print("<System> Getting state.")
-            return self.get_state()
-        self.update_screen()
+        Thread(target=self.stop).start()
+
+    def __history_command(self, commands, session):
+        """
+        history [count]: the last count commands which changed the ship (default all kept),
+        oldest first, and separately the last count which didn't.
+        """
+        try:
+            count = int(commands[1]) if commands[1] else None
+        except ValueError:
+            return None
+        return self.history.snapshot(count)
+
+    def __replay_command(self, commands, session):
+        """
+        history replay [count]: runs the state changing commands among the last count again,
+        in order, to reproduce how the ship got to where it is. Returns how many were run.
+        They aren't added to the history again.
+        """
+        try:
+            count = int(commands[2]) if commands[2] else None
+        except ValueError:
+            return None
+        # This command is already the last in the history, and isn't one of the count.
+        recent = self.history.recent(None if count is None else count + 1)[:-1]
+        replay = []
+        for _, _, command, _ in recent:
+            if type(command) is not dict and self.lookup(self.parse_command(command))[0] in (
+                self.__stop_command, self.__replay_command
+            ):
+                continue
+            replay.append(command)
+        self.history.paused = True
+        try:
+            for command in replay:
+                self.process_command(command, session)
+        finally:
+            self.history.paused = False
+        print("<System> Replayed {} commands.".format(len(replay)))
+        return {"replayed": len(replay)}
+
+    def __scene_command(self, commands, session):
+        scene = self.scenes.get(commands[1])
+        if scene is None:
+            print("<System> Unknown scene {}.".format(commands[1]))
+            return
+        try:
+            fade = float(commands[2]) if commands[2] else None
+            if fade is not None and not isfinite(fade):
+                raise ValueError
+        except ValueError:
+            print("<System> Bad fade time {}.".format(commands[2]))
+            return
+        self.apply_scene(scene, fade)
+        print("<System> Scene {}.".format(scene.name))
+
+    def __effect_command(self, commands, session):
+        """
+        effect <target> <name> [param=value ...]  Plays an effect (see effects.py) on the
+                                                  target's lights: a light, or a group.
+        effect <target> off                       Stops it, leaving the lights as they are.
+        """
+        if commands[2] == "off":
+            return self.effect_message(commands[1], None)
+        spec = {"effect": commands[2]}
+        for param in commands[3:]:
+            key, _, value = param.partition("=")
+            try:
+                spec[key] = float(value)
+            except ValueError:
+                spec[key] = value
+        return self.effect_message(commands[1], spec)
+
+    def __clock_command(self, commands, session):
+        """
+        clock                          The shared clock's status.
+        clock adjust <delta> [error]   Moves the shared clock by delta seconds, error being
+                                       how far out the measurement behind it might be.
+        clock reset                    Goes back to this ship's own time.
+        "time" answers {"time": <shared clock>}, for measuring the offset (see clock.py).
+        """
+        try:
+            if commands[1] == "adjust":
+                delta = float(commands[2])
+                error = float(commands[3]) if len(commands) > 3 and commands[3] else None
+                if not isfinite(delta) or abs(delta) > MAX_OFFSET:
+                    raise ValueError
+                self.clock.adjust(delta, error)
+            elif commands[1] == "reset":
+                self.clock.adjust(-self.clock.offset)
+        except ValueError:
+            print("<System> Bad clock adjustment {}.".format(" ".join(commands[2:])))
+        return self.clock.status()
+
+    def effect_message(self, target, spec):
+        """Starts or, with spec None, stops an effect on target, returning what it's playing."""
+        if spec is None:
+            self.stop_effect(target)
+            print("<System> Effect on {} stopped.".format(target))
+            return {"target": target, "effect": None}
+        try:
+            effect = build(spec)
+        except ValueError as e:
+            print("<System> Bad effect: {}".format(e))
+            return {"target": target, "error": str(e)}
+        if self.play_effect(target, effect) is None:
+            print("<System> Unknown effect target {}.".format(target))
+            return {"target": target, "error": "Unknown target."}
+        print("<System> Playing {} on {}.".format(effect.name, target))
+        return {"target": target, "effect": effect.name}
+
+    def __timeline_command(self, commands, session):
+        """
+        timeline open [lookahead]  Starts a new timeline, for cues sent as {"timeline": [...]}.
+        timeline play [delay]      Takes over the lights and plays, delay seconds from now.
+        timeline end               No more cues are coming, so the show ends once they run out.
+        timeline stop              Stops playing, leaving the lights as they are.
+        timeline status
+        """
+        action = commands[1]
+        if action == "open":
+            try:
+                lookahead = int(commands[2]) if commands[2] else 1024
+            except ValueError:
+                print("<System> Bad timeline lookahead {}.".format(commands[2]))
+                return
+            print("<System> Timeline opened.")
+            return self.open_timeline(max(1, lookahead), session).status()
+        if self.timeline is None:
+            print("<System> No timeline open.")
+            return
+        if action == "play":
+            try:
+                delay = float(commands[2]) if commands[2] else 0.0
+                if not (isfinite(delay) and delay >= 0):
+                    raise ValueError
+            except ValueError:
+                print("<System> Bad timeline delay {}.".format(commands[2]))
+                return
+            self.hold_effects()
+            self.timeline.play(delay)
+            print("<System> Timeline playing.")
+        elif action == "end":
+            self.timeline.end()
+        elif action == "stop":
+            self.timeline.stop()
+            print("<System> Timeline stopped.")
+        return self.timeline.status()
+
+    def timeline_cues(self, cues):
+        """Adds a chunk of cues to the open timeline, returning how many it had room for."""
+        if self.timeline is None:
+            return {"accepted": 0, "error": "No timeline open."}
+        try:
+            accepted = self.timeline.add(cues)
+        except ValueError as e:
+            print("<System> Bad timeline cue: {}".format(e))
+            return dict(self.timeline.status(), accepted=0, error=str(e))
+        return dict(self.timeline.status(), accepted=accepted)
+
+    def __stats_command(self, commands, session):
+        """"stats" returns the metrics as a dict, "stats prometheus" as Prometheus text."""
+        if commands[1] == "prometheus":
+            return self.metrics.prometheus()
+        return self.metrics.snapshot()
+
+    def __get_state_command(self, commands, session):
+        """
+        get_state              The state, already encoded.
+        get_state since=<seq>  {"seq": seq, "unchanged": true} if the state is still the one
+                               with that seq, else {"seq": seq, "state": state}.
+        """
+        return self.__state_reply(commands, session, session is not None and session.wire_format == BINARY)
+
+    def __state_reply(self, commands, session, binary):
+        snapshot = self.snapshot()
+        since = None
+        if commands[1].startswith("since="):
+            try:
+                since = int(commands[1][len("since="):])
+            except ValueError:
+                print("<System> Bad state seq {}.".format(commands[1]))
+        if since == snapshot.seq:
+            return snapshot.empty_delta if binary else snapshot.json_unchanged
+        if binary:
+            return session.encode_binary_state(snapshot, reply=True)
+        return snapshot.json_state if since is None else snapshot.json_versioned
+
+    def __decoded_state(self, resp, commands, session):
+        """
+        get_state replies come pre-encoded, which can't be nested in a JSON message as they are.
+        Binary state frames can't carry a request id either, so those are answered again as JSON.
+        """
+        if session is not None and session.wire_format == BINARY:
+            resp = self.__state_reply(commands, session, False)
+        return json.loads(resp)
+
+    def __subscribe_command(self, commands, session):
+        if session is None:
+            return
+        try:
+            max_rate = float(commands[1]) if commands[1] else None
+            if max_rate is not None and not (isfinite(max_rate) and max_rate > 0):
+                raise ValueError
+        except ValueError:
+            print("<System> Bad subscription rate {}.".format(commands[1]))
+            return
+        session.unsubscribe()
+        session.subscription = self.publisher.subscribe(session.push, max_rate)
+        print("<System> Client subscribed to state updates.")
+
+    def __unsubscribe_command(self, commands, session):
+        if session is None:
+            return
+        session.unsubscribe()
+        print("<System> Client unsubscribed from state updates.")
+
+    def __format_command(self, commands, session):
+        if session is None:
+            return
+        try:
+            version = int(commands[2]) if commands[2] else BINARY_VERSION
+        except ValueError:
+            version = None
+        wire_format = session.set_wire_format(commands[1] or JSON, version)
+        print("<System> Client using {} state format.".format(wire_format))
+        return {
+            "format": wire_format,
+            "version": version if wire_format == BINARY else None,
+            "request_ids": True,
+        }
+
+    def __ack_command(self, commands, session):
+        if session is None:
+            return
+        try:
+            session.acknowledge(int(commands[1]))
+        except ValueError:
+            pass
+        return NO_REPLY
 
     def stop(self):
         sleep(1)
-        if DEBUG_DISPLAY:
-            DISPLAY.clear()
-            DISPLAY.backlight("off")
+        if self.display is not None:
+            self.display.close()
         exit(0)
 
+    def state_changed(self):
+        """
+        Called after anything which may have changed the lights, writing those changes out.
+        If the state may now differ from the last, it gets the next seq, and subscribers are
+        told. The lights in the state aren't read here: the frame buffer counts the flushes
+        which changed any of them, and that count and the modes are all that's compared.
+        """
+        self.frame.flush()
+        key = (self.frame.version, self.__cabins_mode, self.__nacelles_mode, self.blinkers_lit)
+        with self.__state_lock:
+            changed = key != self.__state_key
+            if changed:
+                self.__state_key = key
+                self.state_seq = next(self.__seq_counter)
+        if changed:
+            self.update_screen()
+            if self.journal is not None:
+                self.journal.changed()
+            self.publisher.notify()
+
+    def snapshot(self):
+        """
+        The state as of the last change, built from the lights the first time it's asked for,
+        then shared by every reader until the next, so it's only ever built and encoded once
+        per change however often it's asked for, and not at all if it isn't.
+        """
+        with self.__state_lock:
+            snapshot = self.__snapshot
+            if snapshot is None or snapshot.seq != self.state_seq:
+                snapshot = self.__snapshot = StateSnapshot(self.state_seq, self.get_state())
+            return snapshot
+
+    def journal_settings(self):
+        """The settings for the journal to keep, read from its thread once changes have settled."""
+        # Lights an effect or timeline is playing change too often to be worth journaling.
+        cabin_lights = not (
+            self.effects.bound(self.groups["dynamic_cabins"]) or (self.timeline is not None and self.timeline.playing)
+        )
+        return settings_of(self.snapshot().state, cabin_lights)
+
     def get_state(self):
+        cabins, nacelles, *cabin_lights = self.frame.written(
+            [self.lights["static_cabins"], self.lights["static_nacelles"]] + self.lights["dynamic_cabins"].lights
+        )
         data = {
-            "cabins": self.lights["static_cabins"].is_lit,
+            "cabins": bool(cabins),
             "cabins_mode": self.__cabins_mode,
-            "cabin_lights": "".join(["1" if led.is_lit else "0" for led in self.lights["dynamic_cabins"].lights]),
-            "nacelles": self.lights["static_nacelles"].is_lit,
+            "cabin_lights": "".join(["1" if lit else "0" for lit in cabin_lights]),
+            "nacelles": bool(nacelles),
             "nacelles_mode": self.__nacelles_mode,
             "blinkers": self.blinkers_lit
         }
         return data
 
     def network_control(self):
-        self.receiver_socket.bind(("0.0.0.0", 3141))
-        self.receiver_socket.listen(1)
-        print("<System> Socket open and listening.")
+        if self.receiver_socket is None:
+            self.receiver_socket = listen(self.host, self.port)
         self.connected = False
         while self.run:
             self.current_connection, addr = self.receiver_socket.accept()
             self.connected = True
+            self.metrics.connected()
             print(f"<System> Client connected from {addr}.")
             self.update_screen()
-            data = b""
+            reader = CommandReader(self.current_connection, self.framing)
+            session = ClientSession(self.metrics.counted(self.locked_sender(self.current_connection)), self.framing)
             while self.run:
                 try:
-                    rb = self.current_connection.recv(1)
-                except (ConnectionError, OSError):
-                    break
-
-                if rb == b"":
-                    try:
+                    received = reader.fill()
+                    if not received:
                         self.current_connection.close()
-                    except (ConnectionError, OSError):
-                        pass
+                        break
+                    self.metrics.received(received)
+                    responses = []
+                    pending = []  # Commands queued, in order, whose replies are yet to be collected.
+                    for message in reader.messages():
+                        try:
+                            command = json.loads(message)
+                        except json.JSONDecodeError:
+                            print("<System> JSONDecodeError: Bad data received.")
+                            self.metrics.json_error()
+                            continue
+                        merges = self.merge_slots(command)
+                        if merges is not None:
+                            pending.append(self.command_queue.submit(command, session, merges))
+                            continue
+                        # It may change the session, such as its framing, so it's run alone: the replies
+                        # before it are framed first, and the next command is only read once it's done.
+                        responses.extend(self.__replies(pending, session))
+                        pending.append(self.command_queue.submit(command, session))
+                        responses.extend(self.__replies(pending, session))
+                        reader.framing = session.framing
+                    responses.extend(self.__replies(pending, session))
+                    if responses:
+                        session.send(b"".join(responses))
+                except ValueError as e:  # From the reader: a message too long, or badly framed.
+                    print(f"<System> Dropping client {addr}: {e}")
+                    self.current_connection.close()
                     break
-                elif rb == b"\n":
-                    command = data.decode()
-                    try:
-                        command = json.loads(command)
-                        resp = controller.process_command(command)
-                        self.current_connection.send(
-                            json.dumps(resp).encode()
-                        )
-                        data = b""
-                    except json.JSONDecodeError:
-                        print("<System> JSONDecodeError: Bad data received.")
-                else:
-                    data += rb
+                except (ConnectionError, OSError):
+                    break
+            session.close()
             self.connected = False
             print(f"<System> Client {addr} disconnected.")
             self.update_screen()
 
+    def __replies(self, pending, session):
+        """Waits for each queued command's reply in turn, returning them framed, and empties pending."""
+        responses = []
+        for future in pending:
+            try:
+                reply = future.result()
+            except Exception as e:  # call_handler answers for handlers, so this would be a bug in the queue.
+                reply = self.invalid("Command failed: {!r}".format(e))
+            responses.append(session.encode_response(reply))
+        pending.clear()
+        return [resp for resp in responses if resp is not None]
+
+    @staticmethod
+    def locked_sender(connection):
+        """Returns a send function for the connection which is safe to share between threads."""
+        lock = Lock()
+
+        def send(data):
+            with lock:
+                connection.sendall(data)
+        return send
+
+    def async_network_control(self):
+        """Like network_control, but serves every connected client concurrently."""
+        from async_server import AsyncShipServer
+        listener, self.receiver_socket = self.receiver_socket, None  # The server owns it from here.
+        AsyncShipServer(self, self.host, self.port, framing=self.framing, sock=listener).run()
+
     def update_screen(self):
-        if not DEBUG_DISPLAY:
-            return
-        state = self.get_state()
+        """Marks the debug display as out of date. It redraws itself in the background."""
+        if self.display is not None:
+            self.display.invalidate()
+
+    def screen_lines(self):
+        state = self.snapshot().state  # Read from the frame buffer, not the pins, and shared with clients.
         on = "ON "
         off = "OFF"
         lines = [
@@ -424,21 +1245,21 @@ class ShipController:
                 "Rand" if state["cabins_mode"] == "random" else "Stat"
             ),
             "{}{}".format(
-                "".join(["*" if led.is_lit else "O" for led in self.lights["dynamic_cabins"].lights]).ljust(19),
+                "".join(["*" if lit == "1" else "O" for lit in state["cabin_lights"]]).ljust(19),
                 "C" if self.connected else " "
             )
         ]
-        for i, line in enumerate(lines):
-            DISPLAY.set(line, i + 1)
+        return lines
 
 
-def run_cl():
+def run_cl(controller):
     while RUN:
         command = input("}}} ")
         controller.process_command(command)
 
 
 def test(pins):
+    from gpiozero import PWMLED
     lights = [PWMLED(n) for n in pins]
     for light in lights:
         light.off()
@@ -462,5 +1283,52 @@ def chip_test():
     test(chip3)
 
 
-controller = ShipController()
-controller.network_control()
+def main(argv=None):
+    """
+    Runs the ship. The socket is opened before anything else, so clients can connect while
+    gpiozero loads and the lights start up, and are served as soon as that's done.
+    """
+    started = monotonic()
+    args = parser.parse_args(argv)
+    listener = listen(backlog=100 if args.async_server else 1)
+    print("<System> Listening {:.3f}s after launch.".format(monotonic() - started))
+    lcd = None
+    if args.debug_display:
+        from RPi_GPIO_i2c_LCD import i2c_HD44780
+        lcd = i2c_HD44780.lcd(LCD_ADDR)
+
+    controller = ShipController(
+        framing=args.framing,
+        max_push_rate=args.max_push_rate,
+        pulse_rate=args.pulse_rate,
+        pulse_shape=args.pulse_shape,
+        effect_rate=args.effect_rate,
+        scenes_file=args.scenes,
+        lcd=lcd,
+        listener=listener,
+        journal=None if args.no_journal else StateJournal(args.journal),
+        history=args.history,
+        queue_depth=args.queue_depth
+    )
+    print("<System> Lights running {:.3f}s after launch.".format(monotonic() - started))
+    if args.metrics_port:
+        controller.metrics.serve(args.metrics_port)
+    if args.multicast:
+        group, _, port = args.multicast.partition(":")
+        broadcaster = StateBroadcaster(
+            controller.publisher,
+            group,
+            int(port) if port else MULTICAST_PORT,
+            ttl=args.multicast_ttl,
+            keepalive=args.multicast_keepalive
+        )
+        broadcaster.start()
+        controller.metrics.gauges["multicast"] = lambda: {"datagrams": broadcaster.sent}
+    if args.async_server:
+        controller.async_network_control()
+    else:
+        controller.network_control()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Named scenes: complete looks for the ship, loaded from a JSON file of the form
+
+    {
+        "cruise": {"cabins": true, "cabins_mode": "random", "nacelles": true, "blinkers": true},
+        "docked": {"cabins": true, "cabins_mode": "static", "cabin_lights": "1010101010101010", "fade": 2}
+    }
+
+Anything a scene leaves out is off, or in its default mode, so each one sets every light.
+cabin_lights picks exactly which dynamic cabin lights start lit; without it static cabins
+are all lit and random ones start from a random pattern. fade is how many seconds the
+change to the scene takes by default.
+"""
+import json
+from math import isfinite
+
+CABINS_MODES = ("random", "static")
+NACELLES_MODES = ("pulse", "static")
+
+
+class Scene:
+    __slots__ = ("name", "cabins", "cabins_mode", "cabin_lights", "nacelles", "nacelles_mode", "blinkers", "fade")
+
+    def __init__(self, name, cabins=False, cabins_mode="random", cabin_lights=None, nacelles=False,
+                 nacelles_mode="pulse", blinkers=False, fade=0.0):
+        """
+        :type cabin_lights: tuple | None
+        """
+        self.name = name
+        self.cabins = cabins
+        self.cabins_mode = cabins_mode
+        self.cabin_lights = cabin_lights
+        self.nacelles = nacelles
+        self.nacelles_mode = nacelles_mode
+        self.blinkers = blinkers
+        self.fade = fade
+
+
+def compile_scene(name, settings, cabin_count):
+    """
+    Checks a scene's settings from the file and turns them into a Scene, raising
+    ValueError if any are wrong, so a bad file is caught at startup rather than mid-show.
+    """
+    if type(settings) is not dict:
+        raise ValueError("Scene {!r} is not an object.".format(name))
+    unknown = set(settings) - set(Scene.__slots__[1:])
+    if unknown:
+        raise ValueError("Scene {!r} has unknown settings {}.".format(name, ", ".join(sorted(unknown))))
+    for key in ("cabins", "nacelles", "blinkers"):
+        if type(settings.get(key, False)) is not bool:
+            raise ValueError("Scene {!r}: {} must be true or false.".format(name, key))
+    if settings.get("cabins_mode", "random") not in CABINS_MODES:
+        raise ValueError("Scene {!r}: cabins_mode must be one of {}.".format(name, CABINS_MODES))
+    if settings.get("nacelles_mode", "pulse") not in NACELLES_MODES:
+        raise ValueError("Scene {!r}: nacelles_mode must be one of {}.".format(name, NACELLES_MODES))
+    fade = settings.get("fade", 0.0)
+    if type(fade) not in (int, float) or not isfinite(fade) or fade < 0:
+        raise ValueError("Scene {!r}: fade must be a number of seconds.".format(name))
+
+    cabin_lights = settings.get("cabin_lights")
+    if cabin_lights is not None:
+        if type(cabin_lights) is not str or len(cabin_lights) != cabin_count or set(cabin_lights) - {"0", "1"}:
+            raise ValueError("Scene {!r}: cabin_lights must be {} 0s and 1s.".format(name, cabin_count))
+        cabin_lights = tuple(int(c) for c in cabin_lights)
+
+    return Scene(
+        name,
+        cabins=settings.get("cabins", False),
+        cabins_mode=settings.get("cabins_mode", "random"),
+        cabin_lights=cabin_lights,
+        nacelles=settings.get("nacelles", False),
+        nacelles_mode=settings.get("nacelles_mode", "pulse"),
+        blinkers=settings.get("blinkers", False),
+        fade=float(fade),
+    )
+
+
+def load_scenes(path, cabin_count):
+    """Reads and compiles every scene in the file, returning a dict of name -> Scene."""
+    with open(path) as f:
+        settings = json.load(f)
+    if type(settings) is not dict:
+        raise ValueError("Scene file {} must hold an object of scenes.".format(path))
+    return {name: compile_scene(name, scene, cabin_count) for name, scene in settings.items()}
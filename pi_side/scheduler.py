@@ -0,0 +1,128 @@
+import heapq
+import threading
+from itertools import count
+from math import isfinite
+from time import monotonic
+
+
+class ScheduledCall:
+    __slots__ = ("deadline", "interval", "callback", "args", "cancelled")
+
+    def __init__(self, deadline, interval, callback, args):
+        self.deadline = deadline
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Scheduler:
+    """
+    Runs every timed light effect from one thread, off a heap of deadlines.
+
+    Repeating calls are scheduled against their previous deadline rather than when
+    they actually ran, so they never drift. If the thread falls more than a whole
+    interval behind, the missed calls are skipped rather than run in a burst.
+
+    Each tick runs every call which is due, then each of tick_hooks, so effects can
+    write their changes during the tick and have them flushed once at the end.
+    """
+    def __init__(self):
+        self.tick_hooks = []
+        self.__heap = []
+        self.__order = count()  # Keeps calls due at the same time in the order they were made.
+        self.__condition = threading.Condition()
+        self.ticks = 0
+        self.missed = 0
+        self.total_jitter = 0.0
+        self.max_jitter = 0.0
+        self.__thread = threading.Thread(target=self.__run, name="scheduler")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def call_at(self, deadline, callback, *args):
+        """Calls callback(*args) once, at the given time.monotonic() time. Raises ValueError if it isn't finite."""
+        return self.__push(ScheduledCall(deadline, None, callback, args))
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(monotonic() + delay, callback, *args)
+
+    def call_every(self, interval, callback, *args, start=None):
+        """
+        Calls callback(*args) every interval seconds, first at start (default: now),
+        until the returned call is cancelled.
+        """
+        if not (isfinite(interval) and interval > 0):
+            raise ValueError("Interval must be a positive number of seconds, not {!r}.".format(interval))
+        return self.__push(ScheduledCall(monotonic() if start is None else start, interval, callback, args))
+
+    def __push(self, call):
+        # A NaN deadline would break the heap's ordering and have the thread wait for no time at all.
+        if not isfinite(call.deadline):
+            raise ValueError("Deadline must be a finite time, not {!r}.".format(call.deadline))
+        with self.__condition:
+            heapq.heappush(self.__heap, (call.deadline, next(self.__order), call))
+            if self.__heap[0][2] is call:
+                self.__condition.notify()
+        return call
+
+    def stats(self):
+        return {
+            "threads": threading.active_count(),
+            "scheduled": sum(1 for _, _, call in self.__heap if not call.cancelled),
+            "ticks": self.ticks,
+            "missed": self.missed,
+            "mean_jitter_ms": 1000 * self.total_jitter / self.ticks if self.ticks else 0.0,
+            "max_jitter_ms": 1000 * self.max_jitter,
+        }
+
+    def __next_due(self):
+        """Waits for the next call to be due, then returns it and any others due as well."""
+        with self.__condition:
+            while True:
+                if not self.__heap:
+                    self.__condition.wait()
+                    continue
+                now = monotonic()
+                due = []
+                while self.__heap and self.__heap[0][0] <= now:
+                    call = heapq.heappop(self.__heap)[2]
+                    if not call.cancelled:
+                        due.append(call)
+                if due:
+                    return due, now
+                if self.__heap:
+                    self.__condition.wait(self.__heap[0][0] - now)
+
+    def __run(self):
+        while True:
+            due, now = self.__next_due()
+            for call in due:
+                self.__run_call(call, now)
+            for hook in self.tick_hooks:
+                try:
+                    hook()
+                except Exception as e:
+                    print(f"<System> Scheduler tick hook {hook} failed: {e!r}")
+
+    def __run_call(self, call, now):
+        jitter = now - call.deadline
+        self.ticks += 1
+        self.total_jitter += jitter
+        if jitter > self.max_jitter:
+            self.max_jitter = jitter
+        try:
+            call.callback(*call.args)
+        except Exception as e:
+            print(f"<System> Scheduled call {call.callback} failed: {e!r}")
+        if call.interval is not None and not call.cancelled:
+            call.deadline += call.interval
+            late = monotonic() - call.deadline
+            if late >= call.interval:
+                behind = int(late / call.interval)
+                self.missed += behind
+                call.deadline += behind * call.interval
+            self.__push(call)
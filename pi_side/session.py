@@ -0,0 +1,94 @@
+import json
+from collections import OrderedDict
+from threading import Lock
+
+from framing import frame, LENGTH_PREFIXED, LINE
+from wire import encode_state, BINARY, BINARY_VERSION, JSON
+
+NO_REPLY = object()  # Returned by process_command for commands the client expects no answer to.
+MAX_UNACKED_STATES = 32
+
+
+class ClientSession:
+    """
+    State belonging to one connected client, shared by both server loops.
+
+    send must write already framed bytes to the client and be safe to call from
+    any thread, as state updates are pushed from the publisher's thread.
+    """
+    def __init__(self, send, framing=LINE):
+        self.send = send
+        self.framing = framing
+        self.wire_format = JSON
+        self.subscription = None
+        self.__lock = Lock()
+        self.__sent_states = OrderedDict()  # seq -> state, for states sent but not yet acknowledged.
+        self.__acked = None  # (seq, state) of the last state the client acknowledged.
+
+    def set_wire_format(self, wire_format, version=BINARY_VERSION):
+        """
+        Switches the format state is sent in, returning the format now in use. Binary
+        frames can hold newlines, so switching to binary also switches to length-prefixed framing.
+        """
+        if wire_format == BINARY and version == BINARY_VERSION:
+            self.framing = LENGTH_PREFIXED
+            self.wire_format = BINARY
+        elif wire_format == JSON:
+            self.wire_format = JSON
+        with self.__lock:
+            self.__sent_states.clear()
+            self.__acked = None
+        return self.wire_format
+
+    def acknowledge(self, seq):
+        """
+        Marks the state with the given seq as received, making it the base for future deltas.
+        An unknown seq (such as 0) clears the base, so the next state sent is a full one.
+        """
+        with self.__lock:
+            state = self.__sent_states.get(seq)
+            if state is None:
+                self.__acked = None
+                return False
+            self.__acked = (seq, state)
+            while next(iter(self.__sent_states)) != seq:
+                self.__sent_states.popitem(last=False)
+        return True
+
+    def encode_binary_state(self, snapshot, reply=False):
+        """
+        Returns a binary frame of the snapshot, as a delta if the client has acknowledged a state.
+        :type snapshot: wire.StateSnapshot
+        :type reply: bool
+        """
+        with self.__lock:
+            self.__sent_states[snapshot.seq] = snapshot.state
+            if len(self.__sent_states) > MAX_UNACKED_STATES:
+                self.__sent_states.popitem(last=False)
+            acked = self.__acked
+        if acked is None:
+            return snapshot.full_frame if not reply else encode_state(snapshot.state, snapshot.seq, reply=True)
+        return encode_state(snapshot.state, snapshot.seq, acked[1], acked[0], reply)
+
+    def encode_response(self, resp):
+        """Frames a process_command result for sending, or returns None if there is nothing to send."""
+        if resp is NO_REPLY:
+            return None
+        if type(resp) is not bytes:
+            resp = json.dumps(resp).encode()
+        return frame(resp, self.framing)
+
+    def push(self, snapshot):
+        if self.wire_format == BINARY:
+            payload = self.encode_binary_state(snapshot)
+        else:
+            payload = snapshot.json_event
+        self.send(frame(payload, self.framing))
+
+    def unsubscribe(self):
+        if self.subscription is not None:
+            self.subscription.cancel()
+            self.subscription = None
+
+    def close(self):
+        self.unsubscribe()
@@ -0,0 +1,161 @@
+"""
+Runs virtual ships with no hardware: the GPIO pins and debug LCD are replaced by
+in-memory stand-ins, and every pin change is recorded with its time, so blink and pulse
+timing can be checked afterwards.
+
+Each ship is a real ShipController behind its own AsyncShipServer, so clients can't tell
+it from the real thing. Any number share one process, one asyncio loop and one scheduler
+thread, on consecutive ports; for more, start more processes with different ports.
+
+    python3 simulator.py --ships 200 --port 4000
+"""
+import argparse
+import asyncio
+from collections import deque
+from time import monotonic
+
+from gpiozero.pins.mock import MockFactory, MockPWMPin
+
+from async_server import AsyncShipServer
+from display import ROW_ADDRESSES
+from framing import FRAMINGS, LINE
+from pi_side import ShipController
+from scheduler import Scheduler
+
+TRACE_LENGTH = 4096  # Changes each pin remembers, so long runs don't grow without bound.
+
+
+class TracePin(MockPWMPin):
+    """
+    A mock pin which keeps a trace of (time.monotonic(), value) for each change. gpiozero's
+    own states list, of times since the previous change, is bounded to the same length.
+    """
+    def _change_state(self, value):
+        if super()._change_state(value):
+            self.trace.append((self._last_change, value))
+            return True
+        return False
+
+    def clear_states(self):
+        super().clear_states()
+        length = getattr(self._factory, "trace_length", TRACE_LENGTH)
+        self.states = deque(self.states, maxlen=length)
+        self.trace = deque([(self._last_change, self._state)], maxlen=length)
+
+
+class TraceFactory(MockFactory):
+    """A MockFactory of TracePins. Each ship gets its own, so their pins don't collide."""
+    def __init__(self, trace_length=TRACE_LENGTH):
+        self.trace_length = trace_length
+        super().__init__(pin_class=TracePin)
+
+
+class SimulatedLCD:
+    """
+    Stands in for RPi_GPIO_i2c_LCD.i2c_HD44780.lcd, keeping the characters the display
+    would show, and counting the writes made to it.
+    """
+    def __init__(self, rows=4, columns=20):
+        self.rows = rows
+        self.columns = columns
+        self.buffer = [[" "] * columns for _ in range(rows)]
+        self.lit = False
+        self.writes = 0
+        self.last_write = None
+        self.__row = 0
+        self.__column = 0
+
+    def write(self, cmd, mode=0):
+        self.writes += 1
+        self.last_write = monotonic()
+        if mode:
+            if self.__column < self.columns:
+                self.buffer[self.__row][self.__column] = chr(cmd)
+            self.__column += 1
+            return
+        # Set DDRAM address: the rows' addresses aren't in row order, so find the nearest below.
+        row, address = max(
+            ((row, address) for row, address in enumerate(ROW_ADDRESSES[:self.rows]) if address <= cmd),
+            key=lambda entry: entry[1],
+            default=(0, ROW_ADDRESSES[0])
+        )
+        self.__row = row
+        self.__column = cmd - address
+
+    def backlight(self, state):
+        self.lit = state == "on"
+
+    def clear(self):
+        self.buffer = [[" "] * self.columns for _ in range(self.rows)]
+        self.__row = 0
+        self.__column = 0
+
+    def lines(self):
+        return ["".join(row) for row in self.buffer]
+
+
+class SimulatedShip:
+    def __init__(self, port, host="127.0.0.1", scheduler=None, display=False, trace_length=TRACE_LENGTH,
+                 **controller_args):
+        """
+        controller_args are passed on to ShipController, such as framing or pulse_rate.
+        """
+        self.factory = TraceFactory(trace_length)
+        self.lcd = SimulatedLCD() if display else None
+        self.controller = ShipController(
+            pin_factory=self.factory,
+            scheduler=scheduler,
+            lcd=self.lcd,
+            host=host,
+            port=port,
+            **controller_args
+        )
+        self.server = AsyncShipServer(self.controller, host, port, self.controller.framing)
+
+    def device(self, name):
+        """A light by its name in ShipController.lights, or "dynamic_cabins.<n>" for one cabin light."""
+        group, _, index = name.partition(".")
+        if index:
+            return self.controller.lights[group].lights[int(index)]
+        return self.controller.lights[name]
+
+    def trace(self, name):
+        """Returns the light's recorded changes, as a list of (time.monotonic(), value)."""
+        return list(self.device(name).pin.trace)
+
+    def rises(self, name):
+        """Returns the times the light went from off to on."""
+        trace = self.trace(name)
+        return [t for (_, before), (t, after) in zip(trace, trace[1:]) if not before and after]
+
+
+def fleet(count, port=4000, host="127.0.0.1", display=False, **controller_args):
+    """Makes count ships on consecutive ports from port, sharing one scheduler thread."""
+    scheduler = Scheduler()
+    return [
+        SimulatedShip(port + i, host, scheduler=scheduler, display=display, **controller_args)
+        for i in range(count)
+    ]
+
+
+async def serve_fleet(ships):
+    """Serves every ship from the running loop, until they have all been told to stop."""
+    await asyncio.gather(*(ship.server.serve() for ship in ships))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--ships", type=int, default=1, help="How many ships to run.")
+    parser.add_argument("-p", "--port", type=int, default=4000, help="Port of the first ship, the rest follow on.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on.")
+    parser.add_argument("-d", "--display", action="store_true", help="Give each ship a simulated debug LCD.")
+    parser.add_argument("-f", "--framing", choices=FRAMINGS, default=LINE)
+    args = parser.parse_args()
+
+    ships = fleet(args.ships, args.port, args.host, args.display, framing=args.framing)
+    print("<System> Simulating {} ships on ports {}-{}.".format(len(ships), args.port, args.port + len(ships) - 1))
+    asyncio.run(serve_fleet(ships))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+from math import isfinite
+from threading import Condition, Thread
+from time import monotonic
+
+
+class Subscription:
+    def __init__(self, publisher, send, max_rate):
+        self.publisher = publisher
+        self.send = send
+        if not (isfinite(max_rate) and max_rate > 0):
+            raise ValueError("Subscription rate must be a positive number, not {!r}.".format(max_rate))
+        self.interval = 1 / max_rate
+        self.last_sent = float("-inf")
+        self.pending = True  # New subscribers are sent the current state straight away.
+
+    def cancel(self):
+        self.publisher.unsubscribe(self)
+
+
+class StatePublisher:
+    """
+    Pushes the ship's state to subscribed clients whenever it changes.
+
+    notify() is cheap and can be called on every change. Changes are coalesced so each
+    subscriber is sent at most max_rate updates per second, always of the latest state,
+    and nothing is sent at all while the state is not changing.
+
+    get_snapshot should return a wire.StateSnapshot, which subscribers share so the
+    state is only encoded once per format however many of them there are.
+    """
+    def __init__(self, get_snapshot, default_max_rate=10.0):
+        self.get_snapshot = get_snapshot
+        self.default_max_rate = default_max_rate
+        self.__subscribers = []
+        self.__condition = Condition()
+        self.__thread = Thread(target=self.__run)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def subscribe(self, send, max_rate=None):
+        """
+        send is called from the publisher's thread with each wire.StateSnapshot.
+        :type send: (wire.StateSnapshot) -> None
+        :type max_rate: float
+        Raises ValueError unless max_rate is a positive number.
+        """
+        subscription = Subscription(self, send, max_rate or self.default_max_rate)
+        with self.__condition:
+            self.__subscribers.append(subscription)
+            self.__condition.notify()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.__condition:
+            if subscription in self.__subscribers:
+                self.__subscribers.remove(subscription)
+
+    def notify(self):
+        with self.__condition:
+            if not self.__subscribers:
+                return
+            for subscription in self.__subscribers:
+                subscription.pending = True
+            self.__condition.notify()
+
+    def __due(self):
+        """Returns the subscribers due an update now, and how long until the next one is."""
+        now = monotonic()
+        due = []
+        wait = None
+        for subscription in self.__subscribers:
+            if not subscription.pending:
+                continue
+            ready_at = subscription.last_sent + subscription.interval
+            if ready_at <= now:
+                subscription.pending = False
+                subscription.last_sent = now
+                due.append(subscription)
+            elif wait is None or ready_at - now < wait:
+                wait = ready_at - now
+        return due, wait
+
+    def __run(self):
+        while True:
+            with self.__condition:
+                due, wait = self.__due()
+                while not due:
+                    self.__condition.wait(wait)
+                    due, wait = self.__due()
+            snapshot = self.get_snapshot()
+            for subscription in due:
+                try:
+                    subscription.send(snapshot)
+                except (ConnectionError, OSError, RuntimeError):
+                    # RuntimeError is raised by an asyncio client whose loop has closed.
+                    self.unsubscribe(subscription)
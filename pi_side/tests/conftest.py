@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The ship's modules import each other by bare name, as pi_side.py is run from its own directory.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
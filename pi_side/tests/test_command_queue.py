@@ -0,0 +1,116 @@
+from threading import Event
+
+import pytest
+
+from command_queue import CommandQueue
+
+CABINS = frozenset(("cabins",))
+EVERYTHING = frozenset(("cabins", "nacelles", "blinkers"))
+
+
+class Worker:
+    """A CommandQueue whose worker is held on its first command until release()."""
+    def __init__(self, max_depth=64):
+        self.ran = []
+        self.busy = Event()
+        self.released = Event()
+        self.queue = CommandQueue(self.process, max_depth)
+        self.queue.start()
+        self.queue.submit("hold")
+        assert self.busy.wait(5)
+
+    def process(self, command, session):
+        if command == "hold":
+            self.busy.set()
+            assert self.released.wait(5)
+            return None
+        if command == "fail":
+            raise RuntimeError(command)
+        self.ran.append(command)
+        return "did " + command
+
+    def release(self, *futures):
+        self.released.set()
+        return [future.result(5) for future in futures]
+
+
+def test_later_command_replaces_waiting_one_with_the_same_slots():
+    worker = Worker()
+    queue = worker.queue
+    replies = worker.release(
+        queue.submit("cabins on", merges=CABINS),
+        queue.submit("cabins off", merges=CABINS),
+        queue.submit("cabins on", merges=CABINS),
+    )
+    assert worker.ran == ["cabins on"]
+    assert replies == ["did cabins on"] * 3
+    assert queue.stats()["merged"] == 2
+
+
+def test_nothing_merges_across_an_unmergeable_command():
+    worker = Worker()
+    queue = worker.queue
+    worker.release(
+        queue.submit("cabins on", merges=CABINS),
+        queue.submit("get_state"),
+        queue.submit("cabins off", merges=CABINS),
+    )
+    assert worker.ran == ["cabins on", "get_state", "cabins off"]
+
+
+def test_nothing_merges_across_a_call():
+    worker = Worker()
+    queue = worker.queue
+    replies = worker.release(
+        queue.submit("cabins on", merges=CABINS),
+        queue.call(worker.ran.append, "step"),
+        queue.submit("cabins off", merges=CABINS),
+    )
+    assert worker.ran == ["cabins on", "step", "cabins off"]
+    assert replies[1] is None
+
+
+def test_only_commands_setting_all_the_same_slots_are_replaced():
+    worker = Worker()
+    queue = worker.queue
+    worker.release(
+        queue.submit("all on", merges=EVERYTHING),
+        queue.submit("cabins off", merges=CABINS),
+    )
+    assert worker.ran == ["all on", "cabins off"]
+
+    worker = Worker()
+    queue = worker.queue
+    worker.release(
+        queue.submit("cabins off", merges=CABINS),
+        queue.submit("nacelles off", merges=frozenset(("nacelles",))),
+        queue.submit("all on", merges=EVERYTHING),
+    )
+    assert worker.ran == ["all on"]
+
+
+def test_commands_past_max_depth_are_busy():
+    worker = Worker(max_depth=2)
+    queue = worker.queue
+    queued = [queue.submit("get_state"), queue.submit("get_state")]
+    assert queue.submit("get_state").result(0) == {"error": "Busy.", "queued": 2}
+    assert queue.submit({"id": 7, "command": "get_state"}).result(0) == {
+        "id": 7, "result": {"error": "Busy.", "queued": 2}
+    }
+    # A command merging with one waiting takes its place, so isn't refused.
+    full = CommandQueue(lambda command, session: command, 1)
+    full.submit("cabins on", merges=CABINS)
+    assert not full.submit("cabins off", merges=CABINS).done()
+    worker.release(*queued)
+    assert queue.stats()["rejected"] == 2
+
+
+def test_error_reaches_every_merged_command():
+    worker = Worker()
+    queue = worker.queue
+    first = queue.submit("cabins on", merges=CABINS)
+    second = queue.submit("fail", merges=CABINS)
+    worker.released.set()
+    for future in (first, second):
+        with pytest.raises(RuntimeError):
+            future.result(5)
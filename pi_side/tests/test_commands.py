@@ -0,0 +1,55 @@
+"""Commands run through a simulated ship's command queue, as its clients' are."""
+import json
+import os
+from time import sleep
+
+import pytest
+
+from simulator import SimulatedShip
+
+SCENES = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "scenes.json")
+
+
+@pytest.fixture(scope="module")
+def ship():
+    return SimulatedShip(port=0, scenes_file=SCENES).controller
+
+
+def run(ship, command):
+    return ship.command_queue.submit(command).result(5)
+
+
+def state(ship):
+    return json.loads(run(ship, "get_state"))
+
+
+def test_handler_errors_are_answered(ship, monkeypatch):
+    def broken(*args):
+        raise KeyError("broken")
+    monkeypatch.setattr(ship, "effect_message", broken)
+    assert "error" in run(ship, "effect cabins off")
+    assert "error" in run(ship, {"effect": "cabins", "spec": "twinkle"})
+    reply = run(ship, {"id": 1, "batch": ["effect cabins strobe", "cabins on"]})
+    assert "error" in reply["result"][0]
+    assert state(ship)["cabins"]
+
+
+
+def test_commands_after_a_scene_are_not_undone_by_its_fade(ship):
+    run(ship, "all off")
+    run(ship, "scene warp 0.5")
+    sleep(0.1)
+    run(ship, "cabins off")
+    sleep(0.8)
+    after = state(ship)
+    assert not after["cabins"]
+    assert after["cabin_lights"] == "0" * len(after["cabin_lights"])
+
+
+def test_replay_runs_the_last_count_without_recording_them_again(ship):
+    run(ship, "cabins off")
+    run(ship, "nacelles off")
+    before = run(ship, "history")["commands"]
+    assert run(ship, "history replay 2") == {"replayed": 2}
+    after = run(ship, "history")["commands"]
+    assert [entry["command"] for entry in after] == [entry["command"] for entry in before] + ["history replay 2"]
@@ -0,0 +1,62 @@
+from itertools import islice
+
+import pytest
+
+from effects import build, Effect, MAX_SECONDS
+
+
+def levels(effect, ticks=10, width=4, rate=20.0):
+    return list(islice(effect(width, rate), ticks))
+
+
+@pytest.mark.parametrize("spec", [
+    "twinkle",
+    {"effect": "chase", "period": 1, "lit": 2},
+    {"effect": "breathe", "fade_in": 0.5, "shape": [0, 1, 0.5]},
+    {"effect": "strobe", "on": 0.1, "off": 0.2},
+    {"effect": "noise", "seed": 3.0},
+    {"effect": "solid", "level": 0.5},
+    {"effect": "delay", "source": "strobe", "seconds": 0.1, "stagger": 0.05},
+    {"effect": "gate", "source": "solid", "control": {"effect": "strobe", "on": 0.5, "off": 0.5}},
+    {"effect": "mix", "a": "solid", "b": "twinkle", "amount": 0.3},
+    {"effect": "scale", "source": "breathe", "factor": 2, "offset": -0.5},
+])
+def test_valid_specs_play(spec):
+    effect = build(spec)
+    assert isinstance(effect, Effect)
+    for tick in levels(effect):
+        assert len(tick) == 4
+        assert all(0.0 <= level <= 1.0 for level in tick)
+
+
+@pytest.mark.parametrize("spec", [
+    "sparkle",
+    {"effect": "strobe", "flash": 1},
+    {"effect": "twinkle", "interval": 0},
+    {"effect": "twinkle", "seed": 1.5},
+    {"effect": "twinkle", "seed": "x"},
+    {"effect": "strobe", "on": "abc"},
+    {"effect": "strobe", "off": float("nan")},
+    {"effect": "strobe", "on": True},
+    {"effect": "chase", "period": MAX_SECONDS + 1},
+    {"effect": "chase", "lit": -1},
+    {"effect": "breathe", "shape": [1]},
+    {"effect": "breathe", "shape": "square"},
+    {"effect": "breathe", "shape": [0, "1"]},
+    {"effect": "breathe", "upper": 2},
+    {"effect": "noise", "smoothing": -0.1},
+    {"effect": "delay", "source": "strobe", "seconds": -1},
+    {"effect": "delay", "source": "strobe", "stagger": float("inf")},
+    {"effect": "delay", "source": 3},
+    {"effect": "mix", "a": "solid", "b": "sparkle"},
+    {"effect": "scale", "source": "solid", "factor": None},
+])
+def test_bad_specs_raise_value_error(spec):
+    with pytest.raises(ValueError):
+        build(spec)
+
+
+def test_chained_methods_check_their_params():
+    with pytest.raises(ValueError):
+        build("strobe").delay(-1)
+    assert levels(build("strobe").delay(0.1), ticks=3)[0] == (0.0,) * 4
@@ -0,0 +1,74 @@
+import json
+import socket
+
+import pytest
+
+from framing import CommandReader, frame, FRAMINGS, LENGTH_PREFIXED, LINE
+
+MESSAGES = ["cabins on", {"batch": ["get_state", "stats"]}, "x" * 5000, {"id": 3, "command": "é"}]
+
+
+@pytest.fixture
+def pair():
+    a, b = socket.socketpair()
+    yield a, b
+    a.close()
+    b.close()
+
+
+def read_all(reader, count):
+    messages = []
+    while len(messages) < count:
+        assert reader.fill()
+        messages.extend(json.loads(message) for message in reader.messages())
+    return messages
+
+
+@pytest.mark.parametrize("framing", FRAMINGS)
+def test_round_trip(pair, framing):
+    sender, receiver = pair
+    reader = CommandReader(receiver, framing, buffer_size=64)
+    sender.sendall(b"".join(frame(json.dumps(message).encode(), framing) for message in MESSAGES))
+    assert read_all(reader, len(MESSAGES)) == MESSAGES
+
+
+@pytest.mark.parametrize("framing", FRAMINGS)
+def test_messages_split_across_reads(pair, framing):
+    sender, receiver = pair
+    reader = CommandReader(receiver, framing, buffer_size=16)
+    data = b"".join(frame(json.dumps(message).encode(), framing) for message in MESSAGES)
+    received = []
+    for i in range(0, len(data), 7):
+        sender.sendall(data[i:i + 7])
+        assert reader.fill()
+        received.extend(json.loads(message) for message in reader.messages())
+    assert received == MESSAGES
+
+
+def test_framing_switch_part_way(pair):
+    sender, receiver = pair
+    reader = CommandReader(receiver, LINE)
+    sender.sendall(frame(b'"format binary"', LINE) + frame(b'"get_state"', LENGTH_PREFIXED))
+    reader.fill()
+    messages = reader.messages()
+    assert next(messages) == '"format binary"'
+    reader.framing = LENGTH_PREFIXED
+    assert next(messages) == '"get_state"'
+
+
+@pytest.mark.parametrize("framing", FRAMINGS)
+def test_oversized_message_is_refused(pair, framing):
+    sender, receiver = pair
+    reader = CommandReader(receiver, framing, buffer_size=64, max_message_size=128)
+    payload = frame(b"x" * 1000, framing)
+    with pytest.raises(ValueError):
+        for i in range(0, len(payload), 64):
+            sender.sendall(payload[i:i + 64])
+            reader.fill()
+            list(reader.messages())
+
+
+def test_closed_connection_reads_nothing(pair):
+    sender, receiver = pair
+    sender.close()
+    assert CommandReader(receiver).fill() == 0
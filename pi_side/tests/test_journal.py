@@ -0,0 +1,104 @@
+import os
+import time
+
+from journal import StateJournal, CommandHistory, RECORD_HEADER
+
+FIRST = {"cabins": True, "cabins_mode": "static", "nacelles": True, "nacelles_mode": "pulse", "blinkers": True}
+SECOND = dict(FIRST, nacelles=False, blinkers=False)
+
+
+def written(path, *records, min_interval=1.0, max_size=65536):
+    """A journal at path which has written each of records, and is then closed."""
+    journal = StateJournal(path, min_interval, max_size)
+    settings = [None]
+    journal.start(lambda: settings[0])
+    for record in records:
+        settings[0] = record
+        journal.flush()
+    journal.close()
+    return journal
+
+
+def test_last_record_is_loaded(tmp_path):
+    path = str(tmp_path / "state.journal")
+    written(path, FIRST, SECOND)
+    assert StateJournal(path).load() == SECOND
+
+
+def test_missing_journal_loads_nothing(tmp_path):
+    assert StateJournal(str(tmp_path / "state.journal")).load() is None
+
+
+def test_torn_record_falls_back_and_is_cut_off(tmp_path):
+    path = str(tmp_path / "state.journal")
+    written(path, FIRST)
+    intact = os.path.getsize(path)
+    written(path, SECOND)
+    with open(path, "r+b") as f:
+        f.truncate(os.path.getsize(path) - 3)  # Power lost part way through the second record.
+    assert StateJournal(path).load() == FIRST
+    assert os.path.getsize(path) == intact
+    # Appending carries on from the intact record.
+    written(path, SECOND)
+    assert StateJournal(path).load() == SECOND
+
+
+def test_torn_header_falls_back(tmp_path):
+    path = str(tmp_path / "state.journal")
+    written(path, FIRST)
+    with open(path, "ab") as f:
+        f.write(RECORD_HEADER.pack(100, 0)[:5])
+    assert StateJournal(path).load() == FIRST
+
+
+def test_bad_crc_falls_back(tmp_path):
+    path = str(tmp_path / "state.journal")
+    written(path, FIRST, SECOND)
+    with open(path, "r+b") as f:
+        f.seek(-2, os.SEEK_END)
+        f.write(b"X")
+    assert StateJournal(path).load() == FIRST
+
+
+def test_unchanged_settings_are_not_written_again(tmp_path):
+    path = str(tmp_path / "state.journal")
+    assert written(path, FIRST, FIRST, SECOND, SECOND).writes == 2
+    # Nor those already in the file when it was loaded.
+    journal = StateJournal(path)
+    journal.load()
+    journal.start(lambda: SECOND)
+    journal.flush()
+    assert journal.writes == 0
+
+
+def test_compaction_keeps_only_the_latest(tmp_path):
+    path = str(tmp_path / "state.journal")
+    journal = written(path, *[dict(FIRST, cabins=i % 2 == 0) for i in range(20)], SECOND, max_size=256)
+    assert journal.compactions > 0
+    assert os.path.getsize(path) <= 256
+    assert StateJournal(path).load() == SECOND
+
+
+def test_changes_are_coalesced(tmp_path):
+    path = str(tmp_path / "state.journal")
+    journal = StateJournal(path, min_interval=0.1)
+    settings = [FIRST]
+    journal.start(lambda: settings[0])
+    for record in (SECOND, FIRST, SECOND):
+        settings[0] = record
+        journal.changed()
+    time.sleep(0.3)
+    assert journal.writes == 1
+    assert StateJournal(path).load() == SECOND
+    journal.close()
+
+
+def test_history_keeps_queries_apart():
+    history = CommandHistory(length=4, queries=2)
+    history.add("cabins on", True)
+    for _ in range(10):
+        history.add("ack 1", False)
+    history.add("nacelles off", True)
+    assert [command for _, _, command, _ in history.recent()] == ["cabins on", "nacelles off"]
+    assert len(history.recent(queries=True)) == 2
+    assert history.total == 12
@@ -0,0 +1,73 @@
+"""
+Blink and pulse timing, checked from the traces of a simulated ship's pins. The ship runs
+for a few seconds in real time, so the tolerances allow for a tick or so of lateness.
+"""
+from time import sleep
+
+import pytest
+
+from pi_side import BLINK_GROUPS, NACELLE_PULSE
+from simulator import SimulatedShip
+
+RUN_TIME = 5.4  # Over a period of every blink and its phases, two of the top lights', and several pulses.
+TOLERANCE = 0.03
+
+
+@pytest.fixture(scope="module")
+def ship():
+    ship = SimulatedShip(port=0)
+    for pin in ship.factory.pins.values():
+        pin.clear_states()
+    sleep(RUN_TIME)
+    yield ship
+    ship.controller.process_command("all off")
+
+
+@pytest.mark.parametrize("on, off, lights", BLINK_GROUPS)
+def test_blinker_phase(ship, on, off, lights):
+    first, first_phase = lights[0]
+    first_rises = ship.rises(first)
+    assert first_rises
+    for name, phase in lights[1:]:
+        lag = phase - first_phase
+        # Each light's rises follow the group's first light's by its phase, period after period.
+        # Rises whose partner would have come before or after the trace have nothing to compare to.
+        rises = [
+            rise for rise in ship.rises(name)
+            if first_rises[0] - TOLERANCE <= rise - lag <= first_rises[-1] + TOLERANCE
+        ]
+        offsets = [min(abs(rise - first_rise - lag) for first_rise in first_rises) for rise in rises]
+        assert offsets and max(offsets) < TOLERANCE, (name, offsets)
+
+
+def test_blinker_period(ship):
+    on, off, lights = BLINK_GROUPS[1]
+    for name, _ in lights:
+        rises = ship.rises(name)
+        assert len(rises) >= 2
+        for before, after in zip(rises, rises[1:]):
+            assert after - before == pytest.approx(on + off, abs=TOLERANCE)
+
+
+def test_blinker_on_time(ship):
+    on, off, lights = BLINK_GROUPS[1]
+    for name, _ in lights:
+        trace = ship.trace(name)[1:]  # The first is how it was when the trace was cleared, not a change.
+        lit = [after_t - t for (t, value), (after_t, _) in zip(trace, trace[1:]) if value]
+        assert lit
+        assert all(duration == pytest.approx(on, abs=TOLERANCE) for duration in lit)
+
+
+def test_pulse_period(ship):
+    fade_in, fade_out, lower, upper = NACELLE_PULSE
+    trace = ship.trace("dynamic_nacelles")
+    values = [value for _, value in trace]
+    assert min(values) == pytest.approx(lower, abs=0.01)
+    assert max(values) == pytest.approx(upper, abs=0.01)
+    peaks = []
+    for t, value in trace:
+        if value >= upper - 0.005 and (not peaks or t - peaks[-1] > (fade_in + fade_out) / 2):
+            peaks.append(t)
+    assert len(peaks) >= 3
+    for before, after in zip(peaks, peaks[1:]):
+        assert after - before == pytest.approx(fade_in + fade_out, abs=2 * TOLERANCE)
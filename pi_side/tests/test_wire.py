@@ -0,0 +1,68 @@
+import importlib.util
+import os
+
+import pytest
+
+from wire import StateSnapshot, encode_state, HEADER, REPLY
+
+# The decoder lives with the controller, in a module also called wire.
+_spec = importlib.util.spec_from_file_location(
+    "controller_wire",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "controller", "wire.py")
+)
+controller_wire = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(controller_wire)
+
+STATE = {
+    "cabins": True,
+    "cabins_mode": "random",
+    "cabin_lights": "1010011100001111",
+    "nacelles": True,
+    "nacelles_mode": "pulse",
+    "blinkers": False,
+}
+
+
+def test_full_frame_round_trip():
+    decoder = controller_wire.StateDecoder()
+    assert decoder.decode(encode_state(STATE, 7)) == STATE
+    assert decoder.seq == 7
+
+
+@pytest.mark.parametrize("change", [
+    {"cabins": False},
+    {"cabins_mode": "static", "nacelles_mode": "static"},
+    {"cabin_lights": "0000000000000001"},
+    {"blinkers": True, "nacelles": False},
+])
+def test_delta_round_trip(change):
+    decoder = controller_wire.StateDecoder()
+    decoder.decode(encode_state(STATE, 1))
+    state = dict(STATE, **change)
+    delta = encode_state(state, 2, STATE, 1)
+    assert len(delta) < len(encode_state(state, 2))
+    assert decoder.decode(delta) == state
+
+
+def test_unchanged_delta_carries_no_fields():
+    delta = encode_state(STATE, 2, STATE, 1)
+    assert len(delta) == HEADER.size
+    decoder = controller_wire.StateDecoder()
+    decoder.decode(encode_state(STATE, 1))
+    assert decoder.decode(delta) == STATE
+
+
+def test_delta_on_unknown_base_is_refused():
+    with pytest.raises(ValueError):
+        controller_wire.StateDecoder().decode(encode_state(dict(STATE, cabins=False), 5, STATE, 4))
+
+
+def test_reply_flag():
+    assert HEADER.unpack_from(encode_state(STATE, 3, reply=True))[1] & REPLY
+    assert not HEADER.unpack_from(encode_state(STATE, 3))[1] & REPLY
+
+
+def test_snapshot_encodings_agree():
+    snapshot = StateSnapshot(9, STATE)
+    assert controller_wire.StateDecoder().decode(snapshot.full_frame) == STATE
+    assert snapshot.full_frame is snapshot.full_frame  # Encoded once, then shared.
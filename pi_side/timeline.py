@@ -0,0 +1,214 @@
+"""
+Scripted light shows, streamed to the ship as a list of cues:
+
+    {"t": 1.5, "set": {"port_lights": 1, "dynamic_nacelles": 0.8, "dynamic_cabins.3": 0}}
+
+t is seconds from the start of the show, and never goes backwards from one cue to the
+next. set gives lights their values: 0 or 1 for plain lights, anything between for PWM
+ones. The dynamic cabin lights can be set one at a time as "dynamic_cabins.<n>", or all
+together as "dynamic_cabins" with a string of 0s and 1s.
+
+Cues are sent in chunks as the show plays, into a buffer of at most lookahead cues, so a
+show of any length never needs to be held in memory at once.
+"""
+from collections import deque
+from math import isfinite
+from threading import RLock
+from time import monotonic
+
+from gpiozero import PWMOutputDevice
+
+LATE_TOLERANCE = 0.02  # Seconds after its time that a cue counts as played late.
+
+
+class Cue:
+    __slots__ = ("time", "changes")
+
+    def __init__(self, time, changes):
+        self.time = time
+        self.changes = changes  # ((device, value), ...)
+
+
+class Timeline:
+    """
+    Plays cues against the monotonic clock from the scheduler, writing each through the
+    frame buffer. If the buffer runs dry before end() says the show is complete, that
+    is an underrun: playback carries on against the same clock once more cues arrive,
+    with any that are overdue played at once, so the show catches up rather than drifts.
+
+    on_change is called after each batch of cues is played. on_event(reason, status) is
+    called on an "underrun", once the buffer falls to half empty ("low"), and when the
+    show is "finished".
+    """
+    def __init__(self, scheduler, devices, groups, frame, lookahead=1024, on_change=None, on_event=None):
+        """
+        :type devices: dict
+        :param devices: Name -> device, for every light a cue may set on its own.
+        :type groups: dict
+        :param groups: Name -> list of devices, set together from a string of 0s and 1s.
+        """
+        self.scheduler = scheduler
+        self.devices = devices
+        self.groups = groups
+        self.frame = frame
+        self.lookahead = lookahead
+        self.on_change = on_change
+        self.on_event = on_event
+        self.playing = False
+        self.ended = False
+        self.epoch = None
+        self.received = 0
+        self.played = 0
+        self.late = 0
+        self.underruns = 0
+        self.__cues = deque()
+        self.__last_time = 0.0
+        self.__call = None
+        self.__starved = False
+        self.__low_sent = False
+        self.__lock = RLock()
+
+    def compile_cue(self, cue, after=0.0):
+        """
+        Checks a cue from the client and turns it into a Cue, raising ValueError if it's
+        wrong. after is the time of the cue before it.
+        """
+        if type(cue) is not dict or type(cue.get("set")) is not dict:
+            raise ValueError("Cue {} needs a time and lights to set.".format(cue))
+        time = cue.get("t")
+        if type(time) not in (int, float) or not isfinite(time) or time < after:
+            raise ValueError("Cue time {} is missing, not finite, or earlier than the one before.".format(time))
+        changes = []
+        for name, value in cue["set"].items():
+            if name in self.groups:
+                lights = self.groups[name]
+                if type(value) is not str or len(value) != len(lights) or set(value) - {"0", "1"}:
+                    raise ValueError("{} must be set with {} 0s and 1s.".format(name, len(lights)))
+                changes.extend((led, int(c)) for led, c in zip(lights, value))
+                continue
+            device = self.devices.get(name)
+            if device is None:
+                raise ValueError("Unknown light {}.".format(name))
+            if type(value) not in (int, float, bool) or not 0 <= value <= 1:
+                raise ValueError("{} must be set between 0 and 1.".format(name))
+            if not isinstance(device, PWMOutputDevice):
+                value = 1 if value >= 0.5 else 0
+            changes.append((device, value))
+        return Cue(float(time), tuple(changes))
+
+    def add(self, cues):
+        """
+        Buffers as many of the cues as there is room for, returning how many were taken;
+        the client sends the rest again later. Raises ValueError, taking none of them, if
+        any of those there was room for is bad.
+        """
+        with self.__lock:
+            if self.ended:
+                raise ValueError("The timeline has already been ended.")
+            compiled = []
+            last_time = self.__last_time
+            for cue in cues[:self.lookahead - len(self.__cues)]:
+                compiled.append(self.compile_cue(cue, last_time))
+                last_time = compiled[-1].time
+            if not compiled:
+                return 0
+            self.__cues.extend(compiled)
+            self.__last_time = last_time
+            self.received += len(compiled)
+            if len(self.__cues) > self.lookahead // 2:
+                self.__low_sent = False
+            if self.__starved:
+                self.__starved = False
+                self.__schedule_next()
+            return len(compiled)
+
+    def end(self):
+        """Marks the show as complete, so running out of cues finishes it rather than underruns."""
+        with self.__lock:
+            self.ended = True
+            if self.__starved:
+                self.__starved = False
+                self.__finish()
+
+    def play(self, delay=0.0):
+        """Starts playing, delay seconds from now. Raises ValueError unless delay is a finite number, at least 0."""
+        if not (isfinite(delay) and delay >= 0):
+            raise ValueError("Delay must be a number of seconds, not {!r}.".format(delay))
+        with self.__lock:
+            if self.playing:
+                return
+            self.playing = True
+            self.epoch = monotonic() + delay
+            self.__schedule_next()
+
+    def stop(self):
+        with self.__lock:
+            self.playing = False
+            self.__starved = False
+            if self.__call is not None:
+                self.__call.cancel()
+                self.__call = None
+
+    def position(self):
+        """Seconds into the show, or None before it starts playing."""
+        return None if self.epoch is None else monotonic() - self.epoch
+
+    def status(self):
+        with self.__lock:
+            position = self.position()
+            return {
+                "playing": self.playing,
+                "ended": self.ended,
+                "position": None if position is None else round(position, 3),
+                "buffered": len(self.__cues),
+                "free": self.lookahead - len(self.__cues),
+                "received": self.received,
+                "played": self.played,
+                "late": self.late,
+                "underruns": self.underruns,
+            }
+
+    def __schedule_next(self):
+        if not self.playing:
+            return
+        if self.__cues:
+            self.__call = self.scheduler.call_at(self.epoch + self.__cues[0].time, self.__play_due)
+        elif self.ended:
+            self.__finish()
+        else:
+            self.__starved = True
+            self.underruns += 1
+            print("<System> Timeline underrun {:.2f} s into the show.".format(self.position()))
+            self.__event("underrun")
+
+    def __play_due(self):
+        with self.__lock:
+            self.__call = None
+            if not self.playing:
+                return
+            position = self.position()
+            cues = self.__cues
+            played = 0
+            while cues and cues[0].time <= position:
+                cue = cues.popleft()
+                if position - cue.time > LATE_TOLERANCE:
+                    self.late += 1
+                for device, value in cue.changes:
+                    self.frame.set(device, value)
+                played += 1
+            self.played += played
+            if not self.ended and not self.__low_sent and len(cues) <= self.lookahead // 2:
+                self.__low_sent = True
+                self.__event("low")
+            self.__schedule_next()
+        if played and self.on_change is not None:
+            self.on_change()
+
+    def __finish(self):
+        self.playing = False
+        print("<System> Timeline finished, {} cues played, {} late.".format(self.played, self.late))
+        self.__event("finished")
+
+    def __event(self, reason):
+        if self.on_event is not None:
+            self.on_event(reason, self.status())
@@ -0,0 +1,82 @@
+"""
+Precomputed brightness waveforms for pulsing PWM lights.
+
+A waveform is one full period (fade in then fade out) sampled once at its update rate
+into an array('f'). Playback looks values up by the time elapsed since the pulse
+started, so the period is exactly fade_in_time + fade_out_time however late any one
+update runs, and updates that run late simply land further along the table.
+"""
+import math
+from array import array
+from functools import lru_cache
+
+
+def linear(x):
+    return x
+
+
+def sine(x):
+    return (1 - math.cos(math.pi * x)) / 2
+
+
+def gamma(x, exponent=2.2):
+    """Linear in perceived brightness, rather than in duty cycle."""
+    return x ** exponent
+
+
+SHAPES = {
+    "linear": linear,
+    "sine": sine,
+    "gamma": gamma,
+}
+
+
+class Waveform:
+    __slots__ = ("table", "period")
+
+    def __init__(self, table, period):
+        self.table = table
+        self.period = period
+
+    def value_at(self, elapsed):
+        """Returns the brightness the given number of seconds into the pulse."""
+        table = self.table
+        return table[int((elapsed % self.period) / self.period * len(table)) % len(table)]
+
+
+def resolve_shape(shape):
+    """
+    Turns a shape into a function of x in [0, 1] returning a level in [0, 1]. A shape may be
+    one of the names in SHAPES, any such function, or a sequence of levels spaced evenly
+    over [0, 1] which are linearly interpolated.
+    """
+    if isinstance(shape, str):
+        return SHAPES[shape]
+    if callable(shape):
+        return shape
+    points = tuple(shape)
+    assert len(points) >= 2
+
+    def interpolated(x):
+        position = x * (len(points) - 1)
+        i = min(int(position), len(points) - 2)
+        return points[i] + (points[i + 1] - points[i]) * (position - i)
+    return interpolated
+
+
+@lru_cache(maxsize=32)
+def waveform(fade_in_time, fade_out_time, lower_limit=0.0, upper_limit=1.0, shape="linear", rate=20.0):
+    """
+    Returns the cached Waveform for these pulse settings, building it the first time.
+    shape must be hashable to be cached, so pass sequences of levels as tuples.
+    """
+    curve = resolve_shape(shape)
+    difference = float(upper_limit - lower_limit)
+    rise = max(1, round(fade_in_time * rate))
+    fall = max(1, round(fade_out_time * rate))
+    table = array("f", bytes(4 * (rise + fall)))
+    for i in range(rise):
+        table[i] = lower_limit + difference * curve(i / rise)
+    for i in range(fall):
+        table[rise + i] = lower_limit + difference * curve(1 - i / fall)
+    return Waveform(table, fade_in_time + fade_out_time)
@@ -0,0 +1,137 @@
+"""
+Encodings of the ship's state sent to clients.
+
+JSON is the default. Clients may negotiate the binary format with "format binary 1",
+after which their state arrives as compact frames (and the connection switches to
+length-prefixed framing, as binary frames may contain newlines):
+
+    version   B   BINARY_VERSION
+    kind      B   FULL or DELTA, with REPLY set if answering get_state
+    seq       I   state sequence number
+    base      I   sequence number a delta applies on top of, 0 for full frames
+    fields    B   bitmask of the fields present below
+    flags     B   on/off bits for cabins, nacelles and blinkers (if any are present)
+    modes     B   cabins mode index in the low nibble, nacelles mode in the high one
+    lights    B + bitmask of cabin lights, light i at byte i // 8, bit i % 8
+
+A delta carries only the fields which differ from the state with sequence number base,
+which is the last one the client acknowledged with "ack <seq>".
+"""
+import json
+import struct
+
+JSON = "json"
+BINARY = "binary"
+WIRE_FORMATS = (JSON, BINARY)
+BINARY_VERSION = 1
+
+FULL = 0x00
+DELTA = 0x01
+REPLY = 0x80
+
+HEADER = struct.Struct("!BBIIB")
+
+# Field bits, in the order their values appear.
+CABINS = 0x01
+NACELLES = 0x02
+BLINKERS = 0x04
+CABINS_MODE = 0x08
+NACELLES_MODE = 0x10
+CABIN_LIGHTS = 0x20
+
+FLAG_FIELDS = ((CABINS, "cabins"), (NACELLES, "nacelles"), (BLINKERS, "blinkers"))
+CABINS_MODES = ("random", "static")
+NACELLES_MODES = ("pulse", "static")
+
+
+class StateSnapshot:
+    """The ship's state at one sequence number, encoding itself lazily and at most once per format."""
+    def __init__(self, seq, state):
+        self.seq = seq
+        self.state = state
+        self.__json_event = None
+        self.__json_state = None
+        self.__json_versioned = None
+        self.__full_frame = None
+        self.__empty_delta = None
+
+    @property
+    def json_event(self):
+        if self.__json_event is None:
+            self.__json_event = json.dumps({"event": "state", "seq": self.seq, "state": self.state}).encode()
+        return self.__json_event
+
+    @property
+    def json_state(self):
+        """The reply to a plain get_state: just the state."""
+        if self.__json_state is None:
+            self.__json_state = json.dumps(self.state).encode()
+        return self.__json_state
+
+    @property
+    def json_versioned(self):
+        """The reply to "get_state since=<seq>" from a client without this state: it, with its seq."""
+        if self.__json_versioned is None:
+            self.__json_versioned = json.dumps({"seq": self.seq, "state": self.state}).encode()
+        return self.__json_versioned
+
+    @property
+    def json_unchanged(self):
+        """The reply to "get_state since=<seq>" from a client which already has this state."""
+        return b'{"seq": %d, "unchanged": true}' % self.seq
+
+    @property
+    def empty_delta(self):
+        """A binary get_state reply carrying no fields, for a client which already has this state."""
+        if self.__empty_delta is None:
+            self.__empty_delta = encode_state(self.state, self.seq, self.state, self.seq, reply=True)
+        return self.__empty_delta
+
+    @property
+    def full_frame(self):
+        if self.__full_frame is None:
+            self.__full_frame = encode_state(self.state, self.seq)
+        return self.__full_frame
+
+
+def encode_state(state, seq, base_state=None, base_seq=0, reply=False):
+    """
+    Packs state into a binary frame. If base_state is given, only the fields which
+    differ from it are included.
+    :type state: dict
+    :type seq: int
+    """
+    if base_state is None:
+        kind = FULL
+        fields = CABINS | NACELLES | BLINKERS | CABINS_MODE | NACELLES_MODE | CABIN_LIGHTS
+        base_seq = 0
+    else:
+        kind = DELTA
+        fields = 0
+        for bit, name in FLAG_FIELDS + ((CABINS_MODE, "cabins_mode"), (NACELLES_MODE, "nacelles_mode"),
+                                        (CABIN_LIGHTS, "cabin_lights")):
+            if state[name] != base_state[name]:
+                fields |= bit
+    if reply:
+        kind |= REPLY
+
+    body = bytearray(HEADER.pack(BINARY_VERSION, kind, seq, base_seq, fields))
+    if fields & (CABINS | NACELLES | BLINKERS):
+        flags = 0
+        for bit, name in FLAG_FIELDS:
+            if state[name]:
+                flags |= bit
+        body.append(flags)
+    if fields & (CABINS_MODE | NACELLES_MODE):
+        body.append(
+            CABINS_MODES.index(state["cabins_mode"]) | NACELLES_MODES.index(state["nacelles_mode"]) << 4
+        )
+    if fields & CABIN_LIGHTS:
+        lights = state["cabin_lights"]
+        mask = bytearray((len(lights) + 7) // 8)
+        for i, lit in enumerate(lights):
+            if lit == "1":
+                mask[i // 8] |= 1 << (i % 8)
+        body.append(len(lights))
+        body += mask
+    return bytes(body)